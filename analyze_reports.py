@@ -7,7 +7,8 @@
 # @Description :
 from program_analyzer import PythonProgramAnalyzer
 from statistic import compare_report_sets
-from utils import read_jsonl, load_json, extract_tool_names
+from report_store import load_reports
+from utils import load_json, extract_tool_names
 import re
 
 def remove_code_fence(s: str) -> str:
@@ -23,10 +24,11 @@ if __name__ == "__main__":
     tool_names = extract_tool_names(tools_meta)
     analyzer = PythonProgramAnalyzer(tool_names)
 
-    reports_es = read_jsonl(p1)
-    reports_gt = read_jsonl(p2)
+    # 支持 .jsonl 与列式文件（.parquet / .arrow）
+    reports_es = load_reports(p1)
+    reports_gt = load_reports(p2)
     for report in reports_gt:
         workflow_clean = remove_code_fence(report["response_workflow"])
         analyzer_report_gt = analyzer.analyze(workflow_clean)
         report["report"] = analyzer_report_gt
-    summary = compare_report_sets(reports_gt, reports_es)
\ No newline at end of file
+    summary = compare_report_sets(reports_gt, reports_es, tool_names=tool_names)
\ No newline at end of file
@@ -0,0 +1,112 @@
+"""
+CPU 上的小模型自检：不下载任何权重，随机初始化一个 2 层 Qwen2 + 字符级 tokenizer，
+用真实的 swift PtEngine 跑一遍 evaluate 的推理路径。
+
+    python check_cpu_infer.py [model_dir]
+"""
+import builtins
+import keyword
+import os
+import re
+import string
+import sys
+import tempfile
+
+import torch
+from swift.llm import InferRequest, PtEngine, RequestConfig, get_template
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast, Qwen2Config, Qwen2ForCausalLM
+
+from evaluate import infer_batch
+from local_infer import LocalGenerator, WORKFLOW_WRAPPERS, binding_names, mask_literals
+
+# 字符级词表：chat 模板里的 <|im_start|> 等按普通字符编码
+CHARS = ["<pad>", "<eos>"] + list(string.printable)
+
+
+def build_tiny_model(model_dir: str, seed: int = 0, hidden_size: int = 64, num_layers: int = 2) -> str:
+    """随机初始化的小 Qwen2 模型与字符级 tokenizer，保存到 model_dir（已存在则直接复用）。"""
+    if os.path.exists(os.path.join(model_dir, "config.json")):
+        return model_dir
+    vocab = {c: i for i, c in enumerate(CHARS)}
+    tk = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<pad>"))
+    tk.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    tk.decoder = decoders.Fuse()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tk, pad_token="<pad>", eos_token="<eos>")
+    torch.manual_seed(seed)
+    config = Qwen2Config(vocab_size=len(vocab), hidden_size=hidden_size, intermediate_size=hidden_size * 2,
+                         num_hidden_layers=num_layers, num_attention_heads=4, num_key_value_heads=2,
+                         max_position_embeddings=4096, eos_token_id=1, pad_token_id=0, tie_word_embeddings=False)
+    Qwen2ForCausalLM(config).save_pretrained(model_dir)
+    tokenizer.save_pretrained(model_dir)
+    return model_dir
+
+
+def load_cpu_engine(model_dir: str, batch_size: int) -> PtEngine:
+    engine = PtEngine(model_dir, model_type="qwen2_5", torch_dtype=torch.float32, device_map="cpu",
+                      max_batch_size=batch_size)
+    engine.default_template = get_template(engine.model_meta.template, engine.processor)
+    return engine
+
+
+def check_infer_batch(model_dir: str, batch_size: int = 3, max_tokens: int = 16):
+    """
+    infer_batch 按长度分桶批量推理后，结果要按原始顺序返回，且与逐条推理（batch_size=1）一致（greedy）。
+    """
+    engine = load_cpu_engine(model_dir, batch_size)
+    queries = ["hi", "What time did I wake up today?", "walk", "How long did I sleep last night and why?",
+               "x" * 40, "Did I run on Monday?", "ok"]
+    requests = [InferRequest(messages=[{"role": "user", "content": q}]) for q in queries]
+    request_config = RequestConfig(max_tokens=max_tokens, temperature=0)
+    batched, stats = infer_batch(engine, requests, batch_size=batch_size, request_config=request_config)
+    single, _ = infer_batch(engine, requests, batch_size=1, request_config=request_config)
+    assert len(batched) == len(queries) and all(isinstance(r, str) for r in batched), batched
+    mismatched = [i for i, (a, b) in enumerate(zip(batched, single)) if a != b]
+    assert not mismatched, f"batched responses differ from single-request responses at {mismatched}"
+    assert stats["examples"] == len(queries) and stats["generated_tokens"] > 0, stats
+    print(f"[check_infer_batch] ok: {len(queries)} requests, batch_size={batch_size}, "
+          f"{stats['generated_tokens']} tokens, {stats['examples_per_sec']:.2f} examples/sec")
+
+
+def disallowed_calls(code: str, allowed: set) -> list:
+    """code 中字符串 / 注释之外、函数名不在 allowed 且未在 code 中绑定过的 name( 调用。"""
+    code = mask_literals(code)[0]
+    allowed = allowed | binding_names(code)
+    return [m.group(1) for m in re.finditer(r"(?<![.\w])([A-Za-z_]\w*)\(", code) if m.group(1) not in allowed]
+
+
+def check_constrained_decoding(model_dir: str, batch_size: int = 2, max_new_tokens: int = 200):
+    """
+    语法约束解码（WorkflowGrammarLogitsProcessor）：随机模型上调高 '(' / 'f' / 'x' / '"' 的 logit，
+    不加约束时会生成不合法的 name( 调用；加约束后输出以程序块开头，块内字符串 / 注释之外的每个 name(
+    都是 tool 名、builtins / 关键字或块内绑定过的名字。
+    """
+    engine = load_cpu_engine(model_dir, batch_size)
+    vocab = engine.processor.get_vocab()
+    with torch.no_grad():
+        for char, bias in (("(", 0.5), ("f", 0.4), ("x", 0.4), ('"', 0.2)):
+            engine.model.lm_head.weight[vocab[char]] += bias
+    generator = LocalGenerator.from_engine(engine, max_new_tokens=max_new_tokens)
+    tools = ["f"]
+    allowed = set(tools) | set(dir(builtins)) | set(keyword.kwlist)
+    requests = [InferRequest(messages=[{"role": "user", "content": f"query {i}: do stuff"}]) for i in range(4)]
+
+    free, _ = generator.infer(requests, prefix_cache=False, batch_size=batch_size)
+    free_bad = sum(len(disallowed_calls(r, allowed)) for r in free)
+    assert free_bad > 0, "unconstrained outputs contain no disallowed calls; the check would be vacuous"
+
+    responses, stats = generator.infer(requests, prefix_cache=False, batch_size=batch_size, constrain_tools=tools)
+    open_text, close_text = WORKFLOW_WRAPPERS["fenced"]
+    for response in responses:
+        assert response.startswith(open_text), response[:40]
+        bad = disallowed_calls(response[len(open_text):].split(close_text)[0], allowed)
+        assert not bad, f"disallowed calls {bad} in {response!r}"
+    print(f"[check_constrained_decoding] ok: {free_bad} disallowed calls without constraints, none with, "
+          f"{stats['tokens_per_sec']:.1f} tokens/sec")
+
+
+if __name__ == "__main__":
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(tempfile.gettempdir(), "mmbox_tiny_qwen2")
+    build_tiny_model(model_dir)
+    check_infer_batch(model_dir)
+    check_constrained_decoding(model_dir)
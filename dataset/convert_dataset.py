@@ -1,9 +1,24 @@
 import os
 import json
 import random
-from typing import List, Dict, Any, Tuple
+import hashlib
+from typing import List, Dict, Any, Tuple, Iterable, Optional, Sequence
 
-from utils import write_jsonl, read_jsonl
+from utils import write_jsonl, iter_jsonl, open_file, dumps_jsonl_line, save_dict_to_json, load_json
+
+DEFAULT_SPLITS = {"train": 0.8, "test": 0.2}
+# 黄金分割比的小数部分：Weyl 序列 frac(offset + j * φ) 的任意前缀都近似均匀分布
+GOLDEN_FRACTION = 0.6180339887498949
+
+
+def format_messages(obj: Dict[str, Any]) -> Dict[str, Any]:
+    """把一条 {prompt, response_workflow} 记录转换为 messages 格式。"""
+    return {
+        "messages": [
+            {"role": "user", "content": obj.get("prompt", "")},
+            {"role": "assistant", "content": "```Python\n" + obj.get("response_workflow", "") + "\n```"}
+        ]
+    }
 
 
 def convert_and_split_messages(
@@ -33,15 +48,7 @@ def convert_and_split_messages(
     (train_set, test_set)
     """
     # 转换格式
-    formatted = [
-        {
-            "messages": [
-                {"role": "user", "content": obj.get("prompt", "")},
-                {"role": "assistant", "content": "```Python\n" + obj.get("response_workflow", "") + "\n```"}
-            ]
-        }
-        for obj in data
-    ]
+    formatted = [format_messages(obj) for obj in data]
 
     # 随机划分
     random.seed(seed)
@@ -61,7 +68,134 @@ def convert_and_split_messages(
     return train_set, test_set
 
 
+def hash_fraction(text: str, seed: int = 42) -> float:
+    """seed + 文本的 sha1 映射到 [0, 1)，与记录顺序、数据集大小无关。"""
+    return int(hashlib.sha1(f"{seed}:{text}".encode("utf-8")).hexdigest()[:15], 16) / 16 ** 15
+
+
+def split_for_fraction(u: float, splits: Dict[str, float]) -> str:
+    """按 splits 的累计比例把 u ∈ [0, 1) 映射到 split 名。"""
+    acc = 0.0
+    for name, ratio in splits.items():
+        acc += ratio
+        if u < acc:
+            return name
+    return name
+
+
+def record_key(obj: Dict[str, Any], key_fields: Sequence[str] = ("query", "prompt")) -> str:
+    """记录的稳定 id：key_fields 中第一个非空字段的值。"""
+    for field in key_fields:
+        value = obj.get(field)
+        if value not in (None, ""):
+            return str(value)
+    raise KeyError(f"Record has none of the key fields {list(key_fields)}")
+
+
+def stream_split_messages(
+    records: Iterable[Dict[str, Any]],
+    save_dir: str,
+    save_name: str,
+    splits: Optional[Dict[str, float]] = None,
+    key_fields: Sequence[str] = ("query", "prompt"),
+    stratify_by: Optional[str] = None,
+    seed: int = 42,
+    balanced: bool = False,
+    keep_fields: Sequence[str] = ("query_type",),
+    suffix: str = ".jsonl",
+) -> Dict[str, Any]:
+    """
+    流式转换并划分数据集：逐条读入、转换为 messages 格式、直接追加到 <save_name>_<split><suffix>，
+    内存占用与数据集大小无关（只保存已划分记录的 key）。
+
+    划分规则：
+    - 默认按 hash(seed, key) 落入的累计比例区间决定 split，同一 seed 下与记录顺序无关；
+      给出 stratify_by（如 "query_type"）时同样按记录 hash 划分，各分层内的 split 比例在期望上等于目标比例，
+      并按分层统计计数（小分层的实际比例可能偏离目标）
+    - balanced=True：每个分层内第 j 条记录取 frac(offset + j·φ)（offset 由 seed 与分层名 hash 得到），
+      任意时刻各分层内的 split 比例都接近目标比例（小分层也不会整体落入同一 split）。
+      这是按到达顺序的划分：同一输入顺序 + 同一状态文件下结果可复现，但打乱输入顺序后从头重跑会得到不同的划分
+
+    增量：划分状态保存在 <save_name>_split_state.json（配置、各分层计数、已划分的 key）。
+    再次调用时追加写入，已划分过的 key 被跳过，已有记录的归属不变；因此可以直接对增长后的整个源文件重跑，
+    也可以只传入新的一批记录。配置（splits / seed / stratify_by / balanced / key_fields）与已有状态不一致时报错。
+    没有状态文件时视为全新划分，已存在的同名输出文件会被清空重写（不会追加到旧数据集后面）。
+
+    Parameters
+    ----------
+    records : Iterable[dict]
+        包含 prompt / response_workflow（以及 query、query_type）的记录，可以是 iter_jsonl 生成器。
+    splits : dict, optional
+        {split 名: 比例}，比例之和须为 1，例如 {"train": 0.8, "val": 0.1, "test": 0.1}。默认 train/test = 0.8/0.2。
+    key_fields : sequence of str
+        作为记录 id 的字段，依次取第一个非空值（默认 query，其次 prompt）。
+    balanced : bool
+        是否使用按到达顺序的 Weyl 序列划分（见上），默认 False（按记录 hash）。
+    keep_fields : sequence of str
+        原样保留到输出记录中的字段（默认 query_type，evaluate.load_query_types 会读取；swift 加载数据集时忽略多余字段）。
+    suffix : str
+        输出文件后缀，".jsonl.zst" 时压缩写入。
+
+    Returns
+    -------
+    dict
+        {"added": {split: n}, "skipped": 重复跳过的条数, "total": {split: n}, "strata": {分层: {split: n}}}
+    """
+    splits = dict(splits or DEFAULT_SPLITS)
+    if abs(sum(splits.values()) - 1.0) > 1e-6:
+        raise ValueError(f"Split ratios must sum to 1, got {splits}")
+    config = {"splits": splits, "seed": seed, "stratify_by": stratify_by, "balanced": balanced,
+              "key_fields": list(key_fields)}
+
+    os.makedirs(save_dir, exist_ok=True)
+    state_path = os.path.join(save_dir, f"{save_name}_split_state.json")
+    fresh = not os.path.exists(state_path)
+    state = {"config": config, "strata": {}, "keys": []} if fresh else load_json(state_path)
+    if state["config"] != config:
+        raise ValueError(f"Split config {config} does not match existing state {state['config']} in {state_path}")
+    seen = set(state["keys"])
+    strata: Dict[str, Dict[str, int]] = state["strata"]
+
+    added = {name: 0 for name in splits}
+    skipped = 0
+    paths = {name: os.path.join(save_dir, f"{save_name}_{name}{suffix}") for name in splits}
+    if fresh:
+        existing = [path for path in paths.values() if os.path.exists(path)]
+        if existing:
+            print(f"[split] no state file {state_path}; overwriting existing outputs {existing}")
+    # 全新划分时截断输出，否则在已有划分后追加
+    files = {name: open_file(path, "wb" if fresh else "ab") for name, path in paths.items()}
+    try:
+        for obj in records:
+            key = hashlib.sha1(record_key(obj, key_fields).encode("utf-8")).hexdigest()[:16]
+            if key in seen:
+                skipped += 1
+                continue
+            stratum = str(obj.get(stratify_by, "unknown")) if stratify_by else "all"
+            counts = strata.setdefault(stratum, {name: 0 for name in splits})
+            if balanced:
+                u = (hash_fraction(stratum, seed) + sum(counts.values()) * GOLDEN_FRACTION) % 1.0
+            else:
+                u = hash_fraction(key, seed)
+            name = split_for_fraction(u, splits)
+            out = format_messages(obj)
+            out.update({f: obj[f] for f in keep_fields if f in obj})
+            files[name].write(dumps_jsonl_line(out))
+            counts[name] += 1
+            added[name] += 1
+            seen.add(key)
+            state["keys"].append(key)
+    finally:
+        for f in files.values():
+            f.close()
+        # 输出文件与状态一起更新；中途出错时已写出的记录也记入状态，重跑不会重复写入
+        save_dict_to_json(state, state_path, indent=None)
+
+    total = {name: sum(c[name] for c in strata.values()) for name in splits}
+    print(f"[split] {save_name}: added {added}, skipped {skipped} duplicates, total {total}")
+    return {"added": added, "skipped": skipped, "total": total, "strata": strata}
+
+
 if __name__ == "__main__":
     input_file = f"qa_v3/results_generate_workflow.jsonl"
-    results = read_jsonl(input_file)
-    convert_and_split_messages(results, save_dir='.', save_name='v1')
\ No newline at end of file
+    stream_split_messages(iter_jsonl(input_file), save_dir='.', save_name='v1', stratify_by="query_type")
\ No newline at end of file
@@ -1,15 +1,29 @@
+import csv
+import glob
 import json
+import multiprocessing as mp
 import os
 import re
+import shutil
+import time
+from collections import Counter
+from typing import List, Optional
+
 import numpy as np
-from swift.llm import InferEngine, InferRequest, PtEngine, RequestConfig, get_template, load_dataset
+from swift.llm import AdapterRequest, InferEngine, InferRequest, PtEngine, RequestConfig, get_template, load_dataset
 
 from generate_workflow_from_query import extract_tool_names
+from local_infer import (LocalGenerator, ModelDraft, NGramDraft, batch_memory, compile_extractors, example_perf,
+                         load_cpu_model, peak_rss_bytes, reset_peak_memory, workflow_wrapper)
+from merge_adapter import resolve_model
+from metrics_history import DEFAULT_HISTORY_DB, MetricsHistory, content_hash, metric_drift, prompt_version
 from program_analyzer import PythonProgramAnalyzer
-from statistic import compare_report_sets
-from utils import write_jsonl, read_yaml_file, load_json
+from report_store import write_report_store
+from statistic import (ADAPTIVE_METRICS, compare_report_sets, export_error_positions, metric_intervals,
+                       per_example_metrics, perf_summary, stratified_order)
+from utils import write_jsonl, read_yaml_file, load_json, prompt_hash, save_dict_to_json, iter_jsonl
 
-os.environ['CUDA_VISIBLE_DEVICES'] = '0'
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '0')
 max_new_tokens = 1024
 temperature = 0
 
@@ -46,6 +60,64 @@ def infer(engine: InferEngine, infer_request: InferRequest):
     return response
 
 
+def infer_batch(engine: InferEngine, infer_requests: List[InferRequest], batch_size: int = 8,
+                request_config: Optional[RequestConfig] = None, adapter_request: Optional[AdapterRequest] = None):
+    """
+    批量推理：按 prompt 长度（字符数）降序排序后按 batch_size 分桶，
+    使同一 batch 内长度接近、减少 padding；结果按原始顺序返回。
+    最长的 batch 最先执行，显存不足会尽早暴露。
+    adapter_request 指定本次使用的 LoRA adapter（PtEngine 在同一个 base model 上按需加载并切换）。
+
+    Returns
+    -------
+    (responses, stats)
+        responses 与 infer_requests 一一对应；stats 含 examples / seconds / examples_per_sec 等吞吐信息。
+    """
+    if request_config is None:
+        request_config = RequestConfig(max_tokens=max_new_tokens, temperature=temperature)
+    n = len(infer_requests)
+    lengths = [sum(len(m['content']) for m in req.messages) for req in infer_requests]
+    order = sorted(range(n), key=lambda i: lengths[i], reverse=True)
+
+    responses = [None] * n
+    per_example = [None] * n
+    generated_tokens = 0
+    t0 = time.perf_counter()
+    for start in range(0, n, batch_size):
+        idx = order[start:start + batch_size]
+        reset_peak_memory()
+        t_batch = time.perf_counter()
+        resp_list = engine.infer([infer_requests[i] for i in idx], request_config, use_tqdm=False,
+                                 adapter_request=adapter_request)
+        batch_seconds = time.perf_counter() - t_batch
+        memory = batch_memory()
+        usages = [getattr(resp, 'usage', None) for resp in resp_list]
+        completions = [(usage.completion_tokens or 0) if usage is not None else 0 for usage in usages]
+        generated_tokens += sum(completions)
+        for i, resp, usage, completion in zip(idx, resp_list, usages, completions):
+            responses[i] = resp.choices[0].message.content
+            # 非流式批量推理拿不到逐条的首 token / 解码时间：逐条 tokens/sec 留空，只记 batch 级吞吐
+            per_example[i] = example_perf((usage.prompt_tokens or 0) if usage is not None else 0, completion,
+                                          None, None, len(idx), memory,
+                                          batch_seconds=batch_seconds, batch_generated_tokens=sum(completions))
+        print(f"[infer_batch] {min(start + batch_size, n)}/{n} done, {time.perf_counter() - t0:.1f}s")
+    elapsed = time.perf_counter() - t0
+
+    stats = {
+        "examples": n,
+        "batch_size": batch_size,
+        "seconds": elapsed,
+        "examples_per_sec": n / elapsed if elapsed > 0 else 0.0,
+        "generated_tokens": generated_tokens,
+        "avg_generated_tokens": generated_tokens / n if n else 0.0,
+        "tokens_per_sec": generated_tokens / elapsed if elapsed > 0 else 0.0,
+        "per_example": per_example,
+    }
+    print(f"[infer_batch] {n} examples in {elapsed:.1f}s -> {stats['examples_per_sec']:.3f} examples/sec, "
+          f"{stats['tokens_per_sec']:.1f} tokens/sec (batch_size={batch_size})")
+    return responses, stats
+
+
 def infer_stream(engine: InferEngine, infer_request: InferRequest):
     request_config = RequestConfig(max_tokens=max_new_tokens, temperature=temperature, stream=True)
     gen_list = engine.infer([infer_request], request_config)
@@ -88,12 +160,340 @@ def extract_workflow(response, response_target_pattern):
     return extracted[0]
 
 
-def evaluate(model, checkpoint, agent_prompt_meta, tools_meta, test_dataset=None, output_path=None, query_list=None, infer_backend='pt', stream=False):
-    # Get model and template, and load LoRA weights.
-    engine = PtEngine(model, adapters=[checkpoint])
-    template = get_template(engine.model_meta.template, engine.processor) # , default_system=system
-    # You can modify the `default_template` directly here, or pass it in during `engine.infer`.
-    engine.default_template = template
+def build_es_record(query, gt, response, response_target_pattern, analyzer):
+    """对一条模型输出做程序抽取与分析，返回带 prompt_hash 的 EST 记录（抽取失败时 report 为 {}）。"""
+    key = prompt_hash(query)
+    try:
+        workflow_generated = extract_workflow(response, response_target_pattern)
+        if workflow_generated:
+            analyzer_report = analyzer.analyze(workflow_generated)
+            return {
+                "prompt_hash": key,
+                "prompt": query,
+                "response_workflow": workflow_generated,
+                "report": analyzer_report,
+                "response": response
+            }
+        # 空程序块同样视为生成失败，保证每条 GT 都有对应的 EST 记录
+        return {
+            "prompt_hash": key,
+            "prompt": query,
+            "response_workflow": "",
+            "report": {},
+            "response": response
+        }
+    except:
+        return {
+            "prompt_hash": key,
+            "prompt": query,
+            "response_workflow": gt,
+            "report": {},
+            "response": response
+        }
+
+
+def build_gt_record(query, gt, response_target_pattern, analyzer):
+    """对 GT 回复做程序抽取与分析；抽取失败返回 None。"""
+    workflow_generated_gt = extract_workflow(gt, response_target_pattern)
+    if workflow_generated_gt:
+        analyzer_report_gt = analyzer.analyze(workflow_generated_gt)
+        return {
+            "prompt_hash": prompt_hash(query),
+            "prompt": query,
+            "response_workflow": workflow_generated_gt,
+            "report": analyzer_report_gt,
+            "response": gt
+        }
+    return None
+
+
+def analyze_example(query, gt, response, analyzer, response_target_pattern):
+    """
+    对一条样本的模型输出与 GT 做程序抽取与分析。
+    返回 (es_record, gt_record)，GT 抽取失败时 gt_record 为 None；两者都带 prompt_hash 作为关联 key。
+    """
+    return (build_es_record(query, gt, response, response_target_pattern, analyzer),
+            build_gt_record(query, gt, response_target_pattern, analyzer))
+
+
+def load_test_examples(test_dataset):
+    """读取测试集，返回 [(query, gt), ...]（跳过缺少 user / assistant 的样本）。"""
+    test_dataset, _ = load_dataset(test_dataset, split_dataset_ratio=0.0, num_proc=1, seed=42)
+    examples = []
+    for ex in test_dataset:
+        messages = ex['messages']
+        query, gt = extract_query_response_from_messages(messages)
+        if query and gt:
+            examples.append((query, gt))
+    return examples
+
+
+def build_draft(speculative, generator, draft_dataset=None):
+    """
+    speculative decoding 的草稿来源：
+    - "ngram"：由 draft_dataset（通常是训练集）中 GT workflow 的 n-gram 构建，未给出时只用 prompt / 已生成内容
+    - 其他字符串：与 base model 共享 tokenizer 的小模型路径（例如 Qwen/Qwen3-0.6B-Base）
+    """
+    if speculative == "ngram":
+        corpus = []
+        if draft_dataset is not None:
+            corpus = [generator.tokenizer.encode(gt, add_special_tokens=False)
+                      for _, gt in load_test_examples(draft_dataset)]
+        return NGramDraft(corpus)
+    return ModelDraft.from_pretrained(speculative, device=generator.device, dtype=generator.model.dtype)
+
+
+def dataset_label(test_dataset):
+    return ",".join(test_dataset) if isinstance(test_dataset, (list, tuple)) else str(test_dataset)
+
+
+def load_backend(model, checkpoint, infer_backend='pt', batch_size=8, merged='auto'):
+    """
+    按 infer_backend 加载模型，返回 (engine, local_generator, backend_info)：
+    'pt' 时 engine 为 swift PtEngine、local_generator 为 None；'cpu*' 时 engine 为 None。
+    """
+    load_model, load_adapter = resolve_model(model, checkpoint, merged)
+    if infer_backend.startswith('cpu'):
+        quantization = infer_backend.split('-', 1)[1] if '-' in infer_backend else None
+        cpu_model, processor, template, backend_info = load_cpu_model(load_model, load_adapter, quantization=quantization)
+        return None, LocalGenerator(cpu_model, processor, template, max_new_tokens=max_new_tokens), backend_info
+    if infer_backend == 'pt':
+        # Get model and template, and load LoRA weights.
+        engine = PtEngine(load_model, adapters=[load_adapter] if load_adapter else None, max_batch_size=batch_size)
+        template = get_template(engine.model_meta.template, engine.processor) # , default_system=system
+        # You can modify the `default_template` directly here, or pass it in during `engine.infer`.
+        engine.default_template = template
+        return engine, None, None
+    raise ValueError(f"Unknown infer_backend: {infer_backend!r}, expected 'pt', 'cpu', 'cpu-int8' or 'cpu-int4'.")
+
+
+def generate_responses(engine, local_generator, requests, agent_prompt_meta, tool_names, batch_size=8, stream=False,
+                       prefix_cache=False, stop_on_block=False, constrained=False, draft=None, speculative_baseline=0):
+    """按解码选项生成 requests 的回复，返回 (responses, infer_stats)；stream 时 infer_stats 为 None。"""
+    if stream:
+        return [infer_stream(engine, req) for req in requests], None
+    if local_generator is None and not (prefix_cache or stop_on_block or constrained or draft is not None):
+        return infer_batch(engine, requests, batch_size=batch_size)
+    # 所有 prompt 共享同一段指令 + tool catalog：只 prefill 一次，之后每条只 prefill query 后缀；
+    # stop_on_block 时程序块一闭合即停止解码（extract_workflow 只需要第一个匹配）；
+    # constrained 时用语法约束解码，只允许输出单个程序块，函数调用限定为 tool 名 / 已绑定的名字
+    generator = local_generator or LocalGenerator.from_engine(engine, max_new_tokens=max_new_tokens)
+    regex_extractors = agent_prompt_meta["target_output"]["regex_extractors"]
+    stop_patterns = compile_extractors(regex_extractors) if stop_on_block else None
+    return generator.infer(requests, prefix_cache=prefix_cache, batch_size=batch_size,
+                           stop_patterns=stop_patterns,
+                           constrain_tools=tool_names if constrained else None,
+                           wrapper=workflow_wrapper(regex_extractors["prog_block"]["pattern"]),
+                           draft=draft, speculative_baseline=speculative_baseline)
+
+
+def summarize_run(results_es, results_gt, model, checkpoint, agent_prompt_meta, tools_meta, test_dataset, output_path,
+                  tool_names, infer_stats=None, backend_info=None, infer_backend='pt', compact_errors=True,
+                  columnar_store=False, history_db=DEFAULT_HISTORY_DB, **history_extra):
+    """
+    由 EST / GT 记录计算 compare_report_sets 汇总，附上推理统计，写入历史库、summary.json
+    （以及可选的列式文件与紧凑错误位置），返回 summary。
+    summary.json 含逐对结果，大规模运行时体积可观，因此不缩进写出；compact_errors=False 时保留逐条错误位置。
+    """
+    if columnar_store:
+        write_report_store(results_es, os.path.join(output_path, "test_report_es.parquet"))
+        write_report_store(results_gt, os.path.join(output_path, "test_report_gt.parquet"))
+    summary = compare_report_sets(results_gt, results_es, tool_names=tool_names, compact_errors=compact_errors,
+                                  join_key="prompt_hash")
+    if infer_stats is not None:
+        summary["inference"] = infer_stats
+    if any("perf" in r for r in results_es):
+        summary["latency"] = perf_summary(results_es)
+    if backend_info is not None:
+        summary.setdefault("inference", {})["backend"] = {**backend_info, "peak_rss_mb": peak_rss_bytes() / 2 ** 20}
+    if history_db:
+        with MetricsHistory(history_db) as history:
+            if infer_backend != 'pt':
+                # 与同一 checkpoint / 测试集 / prompt / tools 下最近一次未量化（pt）run 对照
+                ref_run = history.latest_run(source="evaluate", model_id=model, checkpoint=checkpoint,
+                                             dataset_file=dataset_label(test_dataset),
+                                             prompt_version=prompt_version(agent_prompt_meta),
+                                             tools_hash=content_hash(tools_meta),
+                                             extra_defaults={"infer_backend": "pt"}, infer_backend="pt")
+                if ref_run is None:
+                    print(f"[{infer_backend}] no reference 'pt' run in {history_db}, metric drift not computed")
+                else:
+                    summary["drift"] = {"reference_run_id": ref_run,
+                                        "metrics": metric_drift(summary, history.run_metrics(ref_run))}
+                    for name, d in summary["drift"]["metrics"].items():
+                        print(f"[{infer_backend}] {name}: {d['reference']:.4f} -> {d['current']:.4f} "
+                              f"({d['delta']:+.4f})")
+            history.record(
+                summary,
+                source="evaluate",
+                output_dir=output_path,
+                model_id=model,
+                checkpoint=checkpoint,
+                dataset_file=dataset_label(test_dataset),
+                prompt_version=prompt_version(agent_prompt_meta),
+                tools_hash=content_hash(tools_meta),
+                infer_backend=infer_backend,
+                **history_extra,
+            )
+    if compact_errors:
+        # summary.json 只保留紧凑统计，完整位置信息另存为列式文件
+        export_error_positions(results_es, os.path.join(output_path, "error_positions_es.npz"))
+        export_error_positions(results_gt, os.path.join(output_path, "error_positions_gt.npz"))
+    save_dict_to_json(summary, os.path.join(output_path, 'summary.json'), indent=None)
+    return summary
+
+
+def decode_config_key(model, checkpoint, agent_prompt_meta, infer_backend='pt', stop_on_block=False,
+                      constrained=False):
+    """
+    决定生成结果的配置的短 hash：model / checkpoint / prompt 版本 / 后端（含量化）/ 解码约束 / 生成参数。
+    prefix_cache、speculative、batch_size 不改变 greedy 输出，不计入。
+    """
+    return content_hash({
+        "model": model,
+        "checkpoint": os.path.abspath(checkpoint) if checkpoint else None,
+        "prompt_version": prompt_version(agent_prompt_meta),
+        "infer_backend": infer_backend,
+        "stop_on_block": stop_on_block,
+        "constrained": constrained,
+        "max_new_tokens": max_new_tokens,
+        "temperature": temperature,
+    })
+
+
+def load_done_counts(es_path, gt_path, config_key):
+    """
+    读取已落盘的报告，返回 {prompt_hash: 已完成次数}（仅统计 config_key 一致的 EST 记录）。
+    每个 chunk 先写 GT 再写 EST，EST 记录即完成标记：配置不一致的旧记录、崩溃时写了一半的行，
+    以及没有对应 EST 记录的 GT 记录会被清理掉，保证续跑时 GT 既不重复也不缺失。
+    两个文件各自写到临时文件后用 os.replace 替换，重写过程中崩溃也不会丢失已有报告。
+    """
+    def _load(path):
+        if not os.path.exists(path):
+            return []
+        return [r for r in iter_jsonl(path, skip_invalid=True) if r.get("decode_config") == config_key]
+
+    es_records = _load(es_path)
+    done = Counter(r["prompt_hash"] for r in es_records)
+    kept_gt, gt_counts = [], Counter()
+    for r in _load(gt_path):
+        gt_counts[r["prompt_hash"]] += 1
+        if gt_counts[r["prompt_hash"]] <= done[r["prompt_hash"]]:
+            kept_gt.append(r)
+    for records, path in ((es_records, es_path), (kept_gt, gt_path)):
+        root, ext = os.path.splitext(path)
+        tmp = f"{root}.tmp{ext}"
+        write_jsonl(records, tmp)
+        os.replace(tmp, path)
+    return done
+
+
+def merge_infer_stats(chunk_stats):
+    """合并各 chunk 的推理统计（计数累加，速率按总量重新计算）。"""
+    seconds = sum(st["seconds"] for st in chunk_stats)
+    examples = sum(st["examples"] for st in chunk_stats)
+    generated_tokens = sum(st.get("generated_tokens", 0) for st in chunk_stats)
+    merged_stats = {**chunk_stats[0]}
+    merged_stats.update({
+        "examples": examples,
+        "seconds": seconds,
+        "examples_per_sec": examples / seconds if seconds > 0 else 0.0,
+        "generated_tokens": generated_tokens,
+        "avg_generated_tokens": generated_tokens / examples if examples else 0.0,
+        "tokens_per_sec": generated_tokens / seconds if seconds > 0 else 0.0,
+        "chunks": len(chunk_stats),
+    })
+    spec = [st["speculative"] for st in chunk_stats if "speculative" in st]
+    if spec:
+        totals = {k: sum(sp[k] for sp in spec) for k in ("drafted", "accepted", "target_forwards")}
+        merged_stats["speculative"] = {
+            **spec[0], **totals,
+            "acceptance_rate": totals["accepted"] / totals["drafted"] if totals["drafted"] else 0.0,
+            "tokens_per_target_forward": generated_tokens / totals["target_forwards"]
+            if totals["target_forwards"] else 0.0,
+        }
+    prefix = [st["prefix_cache"] for st in chunk_stats if "prefix_cache" in st]
+    if prefix:
+        merged_stats["prefix_cache"] = {
+            **prefix[0],
+            **{k: sum(p[k] for p in prefix)
+               for k in ("prefix_reused", "prefill_tokens_saved", "estimated_prefill_seconds_saved")},
+        }
+    return merged_stats
+
+
+def load_query_types(test_dataset, examples, type_source=None):
+    """
+    返回与 examples 对齐的 query_type 列表（未知时为 'unknown'）。
+    来源：测试集 JSONL 中记录自带的 query_type 字段，以及 type_source 中的 {prompt, query_type} 记录，按 prompt_hash 关联。
+    """
+    paths = list(test_dataset) if isinstance(test_dataset, (list, tuple)) else [test_dataset]
+    paths += list(type_source) if isinstance(type_source, (list, tuple)) else [type_source] if type_source else []
+    types = {}
+    for path in paths:
+        if not (isinstance(path, str) and path.endswith(".jsonl") and os.path.exists(path)):
+            continue
+        for rec in iter_jsonl(path, skip_invalid=True):
+            if not rec.get("query_type"):
+                continue
+            prompt = rec.get("prompt")
+            if prompt is None and isinstance(rec.get("messages"), list):
+                prompt = next((m.get("content") for m in rec["messages"] if m.get("role") == "user"), None)
+            if isinstance(prompt, str):
+                types[prompt_hash(prompt)] = rec["query_type"]
+    return [types.get(prompt_hash(query), "unknown") for query, _ in examples]
+
+
+def adaptive_should_stop(state, es_path, gt_path, config_key, tool_names, metrics=ADAPTIVE_METRICS, seed=0):
+    """
+    自适应评估的停止判断：由已落盘的记录计算各指标的置信区间并追加到 state['trace']；
+    满足停止条件时在 state 中记录原因与最终区间并返回 True。
+    """
+    results_es = [r for r in iter_jsonl(es_path, skip_invalid=True) if r.get("decode_config") == config_key]
+    results_gt = [r for r in iter_jsonl(gt_path, skip_invalid=True) if r.get("decode_config") == config_key]
+    n = len(results_es)
+    intervals = metric_intervals(per_example_metrics(results_gt, results_es, tool_names, metrics=metrics),
+                                 method=state["method"], seed=seed)
+    state["evaluated"] = n
+    state["intervals"] = intervals
+    state["trace"].append({"n": n, **{k: v["width"] for k, v in intervals.items()}})
+    print(f"[adaptive] n={n}: " + ", ".join(f"{k}={v['mean']:.3f} [{v['low']:.3f}, {v['high']:.3f}]"
+                                           for k, v in intervals.items()))
+    if n >= state["min_examples"] and all(v["width"] <= state["target_width"] for v in intervals.values()):
+        state["stopped"] = "target_width"
+    elif n >= state["max_examples"]:
+        state["stopped"] = "budget"
+    else:
+        return False
+    print(f"[adaptive] stop ({state['stopped']}) after {n}/{state['total_examples']} examples")
+    return True
+
+
+def evaluate(model, checkpoint, agent_prompt_meta, tools_meta, test_dataset=None, output_path=None, query_list=None, infer_backend='pt', stream=False,
+             compact_errors=True, columnar_store=False, history_db=DEFAULT_HISTORY_DB, batch_size=8,
+             prefix_cache=False, stop_on_block=False, constrained=False, speculative=None, draft_dataset=None,
+             speculative_baseline=8, merged='auto', resume=False, chunk_size=32, type_source=None, adaptive=False,
+             target_width=0.20, min_examples=30, max_examples=None, ci_method='wilson',
+             adaptive_metrics=ADAPTIVE_METRICS, seed=0):
+    """
+    infer_backend:
+    - 'pt'：GPU 上的 swift PtEngine（默认）
+    - 'cpu' / 'cpu-int8' / 'cpu-int4'：CPU 上加载 base model 并合并 adapter，可选动态 int8 / weight-only int4 量化，
+      使用 LocalGenerator 解码；summary 中额外记录权重内存、峰值 RSS，以及相对最近一次 'pt' run 的指标漂移
+    merged：'auto' 时若 merge_adapter 已为该 checkpoint 导出合并模型则直接加载（无 adapter 开销），
+    True 时缺失则先导出，False 时始终 base + adapter
+    resume：test_report_*.jsonl 每 chunk_size 条追加写入一次，记录带 prompt_hash 与解码配置 key；
+    resume=True 时跳过已用相同配置评估过的样本，最终 summary 由落盘文件计算
+    type_source：带 prompt / query_type 的 JSONL（如 results_generate_workflow.jsonl），用于给样本标注 query_type
+    adaptive：按 query_type 分层顺序评估，每个 chunk 后计算 adaptive_metrics 的置信区间（Wilson / bootstrap），
+    所有区间宽度 <= target_width（至少 min_examples 条后）或达到 max_examples 时停止；
+    95% Wilson 区间在 p≈0.5 时宽约 1.96/√n，默认 0.20 约需 96 条（0.10 约需 385 条，超过 321 条的测试集，永远不会提前停止）；
+    停止原因与区间变化轨迹写入 summary['inference']['adaptive']
+    compact_errors：默认 True，summary 中只保留模板化的错误统计，逐条位置另存为 error_positions_*.npz
+    """
+    if infer_backend.startswith('cpu') and (stream or query_list is not None):
+        raise ValueError("stream / query_list are only supported with infer_backend='pt'.")
+    engine, local_generator, backend_info = load_backend(model, checkpoint, infer_backend, batch_size, merged)
 
     tool_names = extract_tool_names(tools_meta)
     analyzer = PythonProgramAnalyzer(tool_names)
@@ -109,53 +509,377 @@ def evaluate(model, checkpoint, agent_prompt_meta, tools_meta, test_dataset=None
             # summary[i] = {"system": system, "query": query, "response": response}
             summary[i] = {"query": query, "response": response}
     elif test_dataset is not None:
-        test_dataset, _ = load_dataset(test_dataset, split_dataset_ratio=0.0, num_proc=1, seed=42)
-
-        n = 0
-        results_gt = []
-        results_es = []
-        for ex in test_dataset:
-            messages = ex['messages']
-            query, gt = extract_query_response_from_messages(messages)
-
-            if query and gt:
-                req = InferRequest(messages=[{'role': 'user', 'content': query}])
-                response = infer_func(engine, req)
-
-                try:
-                    workflow_generated = extract_workflow(response, response_target_pattern)
-                    if workflow_generated:
-                        analyzer_report = analyzer.analyze(workflow_generated)
-                        results_es.append({
-                            "prompt": query,
-                            "response_workflow": workflow_generated,
-                            "report": analyzer_report,
-                            "response": response
-                        })
-                except:
-                    results_es.append({
-                        "prompt": query,
-                        "response_workflow": gt,
-                        "report": {},
-                        "response": response
-                    })
-                workflow_generated_gt = extract_workflow(gt, response_target_pattern)
-                if workflow_generated_gt:
-                    analyzer_report_gt = analyzer.analyze(workflow_generated_gt)
-                    results_gt.append({
-                        "prompt": query,
-                        "response_workflow": workflow_generated_gt,
-                        "report": analyzer_report_gt,
-                        "response": gt
-                    })
-            n += 1
-        write_jsonl(results_es, os.path.join(output_path, "test_report_es.jsonl"))
-        write_jsonl(results_gt, os.path.join(output_path, "test_report_gt.jsonl"))
-        summary = compare_report_sets(results_gt, results_es)
+        examples = load_test_examples(test_dataset)
+        es_path = os.path.join(output_path, "test_report_es.jsonl")
+        gt_path = os.path.join(output_path, "test_report_gt.jsonl")
+        config_key = decode_config_key(model, checkpoint, agent_prompt_meta, infer_backend, stop_on_block, constrained)
+
+        # resume：跳过已用相同 checkpoint + 解码配置评估过的样本（按 prompt_hash 计数，兼容重复 query）
+        done = load_done_counts(es_path, gt_path, config_key) if resume else Counter()
+        if not resume:
+            for path in (es_path, gt_path):
+                write_jsonl([], path)
+        seen = Counter()
+        todo = []
+        query_types = load_query_types(test_dataset, examples, type_source)
+        for (query, gt), query_type in zip(examples, query_types):
+            key = prompt_hash(query)
+            seen[key] += 1
+            if seen[key] > done[key]:
+                todo.append((query, gt, query_type))
+        if resume:
+            print(f"[evaluate] resume: {len(examples) - len(todo)}/{len(examples)} examples already evaluated "
+                  f"with config {config_key}")
+        adaptive_state = None
+        if adaptive:
+            # 按 query_type 分层的顺序评估，区间足够窄或达到预算即停止
+            todo = [todo[i] for i in stratified_order([t[2] for t in todo], seed=seed)]
+            adaptive_state = {"target_width": target_width, "method": ci_method, "min_examples": min_examples,
+                              "max_examples": max_examples or len(examples), "total_examples": len(examples),
+                              "stopped": "exhausted", "trace": []}
+            todo = todo[:max(adaptive_state["max_examples"] - (len(examples) - len(todo)), 0)]
+
+        draft = None
+        if speculative and not stream and todo:
+            local_generator = local_generator or LocalGenerator.from_engine(engine, max_new_tokens=max_new_tokens)
+            draft = build_draft(speculative, local_generator, draft_dataset)
+        chunk_stats = []
+        for start in range(0, len(todo), chunk_size):
+            chunk = todo[start:start + chunk_size]
+            requests = [InferRequest(messages=[{'role': 'user', 'content': query}]) for query, _, _ in chunk]
+            responses, stats = generate_responses(engine, local_generator, requests, agent_prompt_meta, tool_names,
+                                                  batch_size=batch_size, stream=stream, prefix_cache=prefix_cache,
+                                                  stop_on_block=stop_on_block, constrained=constrained, draft=draft,
+                                                  speculative_baseline=speculative_baseline if start == 0 else 0)
+            per_example = stats.pop("per_example", None) if stats is not None else None
+            if stats is not None:
+                chunk_stats.append(stats)
+            # 每个 chunk 完成后立即追加写入，崩溃时最多丢失一个 chunk
+            results_es, results_gt = [], []
+            for j, ((query, gt, query_type), response) in enumerate(zip(chunk, responses)):
+                es_record, gt_record = analyze_example(query, gt, response, analyzer, response_target_pattern)
+                es_record.update(query_type=query_type, decode_config=config_key)
+                if per_example is not None and per_example[j] is not None:
+                    es_record["perf"] = per_example[j]
+                results_es.append(es_record)
+                if gt_record is not None:
+                    gt_record.update(query_type=query_type, decode_config=config_key)
+                    results_gt.append(gt_record)
+            # GT 先落盘，EST 作为完成标记后写：两次写入之间崩溃时，多出的 GT 会在续跑时被 load_done_counts 清理
+            write_jsonl(results_gt, gt_path, append=True)
+            write_jsonl(results_es, es_path, append=True)
+            if adaptive_state is not None and adaptive_should_stop(adaptive_state, es_path, gt_path, config_key,
+                                                                   tool_names, adaptive_metrics, seed):
+                break
+
+        if adaptive_state is not None and "intervals" not in adaptive_state:
+            adaptive_should_stop(adaptive_state, es_path, gt_path, config_key, tool_names, adaptive_metrics, seed)
+
+        # 汇总统一从落盘文件计算（包含之前运行中已完成的样本）
+        results_es = [r for r in iter_jsonl(es_path, skip_invalid=True) if r.get("decode_config") == config_key]
+        results_gt = [r for r in iter_jsonl(gt_path, skip_invalid=True) if r.get("decode_config") == config_key]
+        infer_stats = merge_infer_stats(chunk_stats) if chunk_stats else None
+        if infer_stats is not None or resume:
+            infer_stats = {**(infer_stats or {}), "resumed_examples": len(examples) - len(todo)}
+        if adaptive_state is not None:
+            infer_stats = {**(infer_stats or {}), "adaptive": adaptive_state}
+        summary = summarize_run(results_es, results_gt, model, checkpoint, agent_prompt_meta, tools_meta, test_dataset,
+                                output_path, tool_names, infer_stats=infer_stats, backend_info=backend_info,
+                                infer_backend=infer_backend, compact_errors=compact_errors,
+                                columnar_store=columnar_store, history_db=history_db)
+        return summary
     if output_path:
         with open(os.path.join(output_path, 'summary.json'), "w", encoding="utf-8") as f:
             json.dump(summary, f, ensure_ascii=False, indent=2)
 
+def shard_indices(num_examples, num_shards, shard):
+    """确定性切分：第 shard 个分片取下标 i % num_shards == shard 的样本（长短样本在各分片间均匀分布）。"""
+    return list(range(shard, num_examples, num_shards))
+
+
+def read_shard_records(path):
+    """读取分片 JSONL，返回 {index: record}；崩溃时写了一半的最后一行会被忽略。"""
+    if not os.path.exists(path):
+        return {}
+    return {rec["index"]: rec for rec in iter_jsonl(path, skip_invalid=True)}
+
+
+def shard_run_key(model, checkpoint, agent_prompt_meta, test_dataset, infer_backend='pt', decode_options=None):
+    """分片目录名：解码配置 key + 测试集；不同 checkpoint / 解码配置 / 测试集的分片结果互不混用。"""
+    decode_options = decode_options or {}
+    config_key = decode_config_key(model, checkpoint, agent_prompt_meta, infer_backend,
+                                   decode_options.get("stop_on_block", False), decode_options.get("constrained", False))
+    return content_hash({"config": config_key, "dataset": dataset_label(test_dataset)})
+
+
+def _shard_dir(output_path, run_key):
+    return os.path.join(output_path, "shards", run_key)
+
+
+def _shard_paths(output_path, shard, num_shards, run_key):
+    stem = os.path.join(_shard_dir(output_path, run_key), f"shard_{shard:03d}_of_{num_shards:03d}")
+    return stem + ".jsonl", stem + ".stats.json"
+
+
+def _evaluate_shard(shard, num_shards, model, checkpoint, agent_prompt_meta, tools_meta, test_dataset, output_path,
+                    run_key, infer_backend='pt', batch_size=8, chunk_size=32, merged='auto', decode_options=None):
+    """
+    子进程入口：加载自己的 engine，只处理本分片的样本，每完成 chunk_size 条就把
+    {"index", "es", "gt"} 追加到分片 JSONL。重试时跳过文件中已有的样本。
+    完成后写入 .stats.json 作为分片完成的标记。
+    """
+    decode_options = decode_options or {}
+    shard_file, stats_file = _shard_paths(output_path, shard, num_shards, run_key)
+    examples = load_test_examples(test_dataset)
+    done = read_shard_records(shard_file)
+    todo = [i for i in shard_indices(len(examples), num_shards, shard) if i not in done]
+    print(f"[shard {shard}/{num_shards}] {len(todo)} examples to run ({len(done)} already written)")
+
+    engine, local_generator, backend_info = load_backend(model, checkpoint, infer_backend, batch_size, merged)
+    tool_names = extract_tool_names(tools_meta)
+    analyzer = PythonProgramAnalyzer(tool_names)
+    response_target_pattern = agent_prompt_meta["target_output"]["regex_extractors"]["prog_block"]["pattern"]
+
+    generated_tokens = 0
+    t0 = time.perf_counter()
+    for start in range(0, len(todo), chunk_size):
+        idx = todo[start:start + chunk_size]
+        requests = [InferRequest(messages=[{'role': 'user', 'content': examples[i][0]}]) for i in idx]
+        responses, infer_stats = generate_responses(engine, local_generator, requests, agent_prompt_meta, tool_names,
+                                                    batch_size=batch_size, **decode_options)
+        generated_tokens += (infer_stats or {}).get("generated_tokens", 0)
+        per_example = (infer_stats or {}).pop("per_example", None)
+        lines = []
+        for j, (i, response) in enumerate(zip(idx, responses)):
+            query, gt = examples[i]
+            es_record, gt_record = analyze_example(query, gt, response, analyzer, response_target_pattern)
+            if per_example is not None and per_example[j] is not None:
+                es_record["perf"] = per_example[j]
+            lines.append({"index": i, "es": es_record, "gt": gt_record})
+        write_jsonl(lines, shard_file, append=True)
+    elapsed = time.perf_counter() - t0
+    stats = {
+        "shard": shard,
+        "run_key": run_key,
+        "examples": len(todo),
+        "resumed_examples": len(done),
+        "seconds": elapsed,
+        "generated_tokens": generated_tokens,
+        "tokens_per_sec": generated_tokens / elapsed if elapsed > 0 else 0.0,
+    }
+    if backend_info is not None:
+        stats["backend"] = {**backend_info, "peak_rss_mb": peak_rss_bytes() / 2 ** 20}
+    save_dict_to_json(stats, stats_file)
+
+
+def _shard_complete(output_path, shard, num_shards, num_examples, run_key):
+    shard_file, stats_file = _shard_paths(output_path, shard, num_shards, run_key)
+    if not os.path.exists(stats_file) or load_json(stats_file).get("run_key") != run_key:
+        return False
+    expected = set(shard_indices(num_examples, num_shards, shard))
+    return expected <= set(read_shard_records(shard_file))
+
+
+def evaluate_sharded(model, checkpoint, agent_prompt_meta, tools_meta, test_dataset, output_path, num_shards=2,
+                     devices=None, infer_backend='pt', batch_size=8, chunk_size=32, max_retries=2,
+                     compact_errors=True, columnar_store=False, history_db=DEFAULT_HISTORY_DB, merged='auto',
+                     prefix_cache=False, stop_on_block=False, constrained=False, resume=False):
+    """
+    数据并行的分片评估：测试集按下标确定性地切成 num_shards 份，每份由一个独立进程（各自加载 engine）处理。
+    - devices：每个分片使用的 CUDA 设备（如 ['0', '1']，按分片循环分配）；CPU 后端时各进程平分核心数
+    - 每个分片的报告逐 chunk 追加写入 output_path/shards/，失败的分片最多重试 max_retries 次，
+      已完成的分片不会重跑，重试的分片也只补跑缺失的样本
+    - 全部完成后按原始顺序合并为 test_report_es.jsonl / test_report_gt.jsonl，再统一做 compare_report_sets
+    - 分片目录为 output_path/shards/<shard_run_key>，按 checkpoint + 解码配置 + 测试集区分；
+      resume=False（默认）时先清空该目录，resume=True 时沿用上次中断留下的分片结果
+    """
+    examples = load_test_examples(test_dataset)
+    decode_options = dict(prefix_cache=prefix_cache, stop_on_block=stop_on_block, constrained=constrained)
+    run_key = shard_run_key(model, checkpoint, agent_prompt_meta, test_dataset, infer_backend, decode_options)
+    if not resume:
+        shutil.rmtree(_shard_dir(output_path, run_key), ignore_errors=True)
+    ctx = mp.get_context("spawn")
+    pending = list(range(num_shards))
+    attempts = {k: 0 for k in pending}
+    t0 = time.perf_counter()
+    while pending:
+        procs = {}
+        for shard in pending:
+            if _shard_complete(output_path, shard, num_shards, len(examples), run_key):
+                continue
+            attempts[shard] += 1
+            # 子进程在启动时继承环境变量，逐个设置后再恢复
+            env_backup = {k: os.environ.get(k) for k in ("CUDA_VISIBLE_DEVICES", "OMP_NUM_THREADS")}
+            if devices:
+                os.environ["CUDA_VISIBLE_DEVICES"] = str(devices[shard % len(devices)])
+            if infer_backend.startswith('cpu'):
+                os.environ["OMP_NUM_THREADS"] = str(max((os.cpu_count() or 1) // num_shards, 1))
+            proc = ctx.Process(target=_evaluate_shard, name=f"shard-{shard}", args=(
+                shard, num_shards, model, checkpoint, agent_prompt_meta, tools_meta, test_dataset, output_path,
+                run_key, infer_backend, batch_size, chunk_size, merged, decode_options))
+            proc.start()
+            for k, v in env_backup.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+            procs[shard] = proc
+        for proc in procs.values():
+            proc.join()
+
+        pending = [k for k in pending if not _shard_complete(output_path, k, num_shards, len(examples), run_key)]
+        for shard in pending:
+            print(f"[evaluate_sharded] shard {shard} failed (attempt {attempts[shard]}, "
+                  f"exitcode {procs[shard].exitcode if shard in procs else None})")
+            if attempts[shard] > max_retries:
+                raise RuntimeError(f"Shard {shard} failed after {attempts[shard]} attempts; "
+                                   f"completed shards are kept in {_shard_dir(output_path, run_key)} "
+                                   f"(rerun with resume=True to reuse them).")
+    elapsed = time.perf_counter() - t0
+
+    # 按原始顺序合并
+    merged_records = {}
+    shard_stats = []
+    for shard in range(num_shards):
+        shard_file, stats_file = _shard_paths(output_path, shard, num_shards, run_key)
+        merged_records.update(read_shard_records(shard_file))
+        shard_stats.append(load_json(stats_file))
+    results_es = [merged_records[i]["es"] for i in range(len(examples))]
+    results_gt = [merged_records[i]["gt"] for i in range(len(examples)) if merged_records[i]["gt"] is not None]
+    write_jsonl(results_es, os.path.join(output_path, "test_report_es.jsonl"))
+    write_jsonl(results_gt, os.path.join(output_path, "test_report_gt.jsonl"))
+
+    generated_tokens = sum(st["generated_tokens"] for st in shard_stats)
+    infer_stats = {
+        "examples": len(examples),
+        "num_shards": num_shards,
+        "seconds": elapsed,
+        "examples_per_sec": len(examples) / elapsed if elapsed > 0 else 0.0,
+        "generated_tokens": generated_tokens,
+        "tokens_per_sec": generated_tokens / elapsed if elapsed > 0 else 0.0,
+        "retries": sum(max(a - 1, 0) for a in attempts.values()),
+        "shards": shard_stats,
+    }
+    return summarize_run(results_es, results_gt, model, checkpoint, agent_prompt_meta, tools_meta, test_dataset,
+                         output_path, extract_tool_names(tools_meta), infer_stats=infer_stats,
+                         infer_backend=infer_backend, compact_errors=compact_errors, columnar_store=columnar_store,
+                         history_db=history_db, num_shards=num_shards)
+
+
+def list_checkpoints(output_dir):
+    """
+    返回 output_dir 下（含 mmb_sft 生成的 vN-xxx 子目录）所有 checkpoint-N 目录，
+    按 (所在 run 目录, step) 排序：output_dir 直属的 checkpoint 在前，各 vN-xxx 目录内按 step 升序。
+    """
+    ckpts = glob.glob(os.path.join(output_dir, "checkpoint-*")) + glob.glob(os.path.join(output_dir, "*", "checkpoint-*"))
+    ckpts = [c for c in ckpts if os.path.isdir(c) and re.search(r"checkpoint-(\d+)$", c)]
+    root = os.path.normpath(output_dir)
+    return sorted(ckpts, key=lambda c: (os.path.dirname(c) != root, os.path.dirname(c),
+                                        int(re.search(r"checkpoint-(\d+)$", c).group(1))))
+
+
+def checkpoint_names(checkpoints):
+    """
+    每个 checkpoint 的唯一名字：相对所有 checkpoint 公共父目录的路径（分隔符换成 "__"），
+    例如 v0-xxx__checkpoint-50 与 v1-yyy__checkpoint-50。用作 AdapterRequest 名（swift 按名字缓存 adapter）、
+    sweep 输出子目录名与指标表的行名。
+    """
+    paths = [os.path.abspath(c) for c in checkpoints]
+    root = os.path.commonpath(paths) if len(paths) > 1 else os.path.dirname(paths[0])
+    if root in paths:
+        root = os.path.dirname(root)
+    return [os.path.relpath(p, root).replace(os.sep, "__") for p in paths]
+
+
+SWEEP_TABLE_KEYS = ["exact_match_ratio", "avg_extra_tools", "avg_missing_tools"]
+SWEEP_SIMILARITY_KEYS = ["lcs_ratio", "levenshtein_sim", "set_f1", "ngram2_overlap"]
+
+
+def evaluate_sweep(model, checkpoints, agent_prompt_meta, tools_meta, test_dataset, output_path,
+                   batch_size=8, history_db=DEFAULT_HISTORY_DB):
+    """
+    多 checkpoint 扫描评估：base model 只加载一次，LoRA adapter 通过 AdapterRequest 原地切换。
+    GT 的抽取与分析只做一次，所有 checkpoint 复用；每个 checkpoint 的 EST 报告写入
+    output_path/sweep/<checkpoint_names 给出的唯一名>/，最终输出一张 compare_report_sets 指标表（sweep_table.json / .csv）。
+
+    checkpoints 可以是 checkpoint 路径列表，也可以是一个训练输出目录（自动查找 checkpoint-*）。
+    """
+    if isinstance(checkpoints, str):
+        checkpoints = list_checkpoints(checkpoints)
+    # 同一路径只评估一次（名字按绝对路径区分）
+    checkpoints = list(dict.fromkeys(os.path.normpath(c) for c in checkpoints))
+    if not checkpoints:
+        raise ValueError("No checkpoints to evaluate.")
+    names = checkpoint_names(checkpoints)
+
+    engine = PtEngine(model, max_batch_size=batch_size)
+    template = get_template(engine.model_meta.template, engine.processor)
+    engine.default_template = template
+
+    tool_names = extract_tool_names(tools_meta)
+    analyzer = PythonProgramAnalyzer(tool_names)
+    response_target_pattern = agent_prompt_meta["target_output"]["regex_extractors"]["prog_block"]["pattern"]
+
+    examples = load_test_examples(test_dataset)
+    requests = [InferRequest(messages=[{'role': 'user', 'content': query}]) for query, _ in examples]
+
+    # GT 分析只做一次
+    results_gt = []
+    for query, gt in examples:
+        gt_record = build_gt_record(query, gt, response_target_pattern, analyzer)
+        if gt_record is not None:
+            results_gt.append(gt_record)
+    write_jsonl(results_gt, os.path.join(output_path, "sweep", "test_report_gt.jsonl"))
+
+    history = MetricsHistory(history_db) if history_db else None
+    table = []
+    for ckpt, name in zip(checkpoints, names):
+        print(f"===== [sweep] {name} ({ckpt}) =====")
+        responses, infer_stats = infer_batch(engine, requests, batch_size=batch_size,
+                                             adapter_request=AdapterRequest(name, ckpt))
+        per_example = infer_stats.pop("per_example")
+        results_es = [build_es_record(query, gt, response, response_target_pattern, analyzer)
+                      for (query, gt), response in zip(examples, responses)]
+        for rec, perf in zip(results_es, per_example):
+            rec["perf"] = perf
+        ckpt_dir = os.path.join(output_path, "sweep", name)
+        write_jsonl(results_es, os.path.join(ckpt_dir, "test_report_es.jsonl"))
+
+        summary = compare_report_sets(results_gt, results_es, tool_names=tool_names, compact_errors=True,
+                                      join_key="prompt_hash")
+        summary["inference"] = infer_stats
+        summary["latency"] = perf_summary(results_es)
+        save_dict_to_json(summary, os.path.join(ckpt_dir, "summary.json"), indent=None)
+        if history is not None:
+            history.record(summary, source="evaluate_sweep", output_dir=ckpt_dir, model_id=model, checkpoint=ckpt,
+                           dataset_file=dataset_label(test_dataset), prompt_version=prompt_version(agent_prompt_meta),
+                           tools_hash=content_hash(tools_meta))
+
+        comparison = summary["comparison"]
+        row = {"checkpoint": name, "path": ckpt}
+        row.update({k: comparison[k] for k in SWEEP_TABLE_KEYS})
+        row.update({k: comparison["similarity"][k] for k in SWEEP_SIMILARITY_KEYS})
+        row["est_valid_ratio"] = summary["est_summary"].get("valid_ratio", 0.0)
+        row["est_error_ratio"] = summary["est_summary"].get("error_ratio", 0.0)
+        row["examples_per_sec"] = infer_stats["examples_per_sec"]
+        table.append(row)
+    if history is not None:
+        history.close()
+
+    save_dict_to_json({"checkpoints": table}, os.path.join(output_path, "sweep", "sweep_table.json"))
+    with open(os.path.join(output_path, "sweep", "sweep_table.csv"), "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(table[0].keys()))
+        writer.writeheader()
+        writer.writerows(table)
+
+    print("\n===== Checkpoint Sweep =====")
+    cols = ["checkpoint", "exact_match_ratio", "lcs_ratio", "est_valid_ratio", "est_error_ratio"]
+    print("  ".join(f"{c:>20s}" for c in cols))
+    for row in table:
+        print("  ".join(f"{row[c]:>20.4f}" if isinstance(row[c], float) else f"{row[c]:>20s}" for c in cols))
+    return table
+
+
 if __name__ == '__main__':
     # query_list = [
     #     'who are you?',
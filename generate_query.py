@@ -1,36 +1,29 @@
 import json
 import os
-from typing import List
+from typing import Dict, List, Union
 
 from utils import load_json, read_yaml_file, save_json_to_log, write_jsonl, string_to_json
 from utils_llm import LLMProxy, generate_and_extract
-import re
+from query_expansion import SLOT_PATTERN, QueryExpander
 import random
 
 QUERY_TYPES = ["Time", "Duration", "Frequency", "Existence", "Action", "Place", "Summary"]
 
 
-def render_query(template: str, tags_dict: List[dict]) -> str:
+def render_query(template: str, tags_dict: Union[List[dict], Dict[str, List[str]]]) -> str:
     """
     输入:
       template: 带有<tag>的query模板，比如 "How long was I at <place> on <time>?"
-      tags_dict: 一个dict，key是"tags"，value是包含(tag, description, examples)的列表
+      tags_dict: 包含(tag, description, examples)的列表，或已建好的 tag -> examples 字典（多次调用时避免重复建索引）
     输出:
-      替换后的query字符串
+      替换后的query字符串（单次随机渲染；批量生成不重复的 query 请用 QueryExpander.sample_template）
     """
     # 建立 tag -> examples 的索引
-    tag_map = {item["tag"]: item["examples"] for item in tags_dict}
+    tag_map = tags_dict if isinstance(tags_dict, dict) else {item["tag"]: item["examples"] for item in tags_dict}
 
-    # 找到所有 <...> 模式的tag
-    matches = re.findall(r"<[^<>]+>", template)
-
-    rendered = template
-    for tag in matches:
-        if tag in tag_map:
-            example = random.choice(tag_map[tag])  # 从例子中随机采样
-            rendered = rendered.replace(tag, example, 1)  # 只替换一次，避免多个相同tag都被替换成同一个例子
-
-    return rendered
+    # 每个 tag 独立采样，相同的 tag 出现多次时各自取值
+    return SLOT_PATTERN.sub(lambda m: random.choice(tag_map[m.group()]) if tag_map.get(m.group()) else m.group(),
+                            template)
 
 
 def generate_query(model, query_prompt_meta, query_meta, types_to_gen, config, output_path=None, log_dir=None, num_per_template=1):
@@ -39,7 +32,10 @@ def generate_query(model, query_prompt_meta, query_meta, types_to_gen, config, o
         types_to_gen = [q["type"] for q in query_meta.get("questions", [])]
 
     total = len(types_to_gen)
-    tags_values = query_meta["tags"]
+    # 模板只编译一次；每个模板在组合空间中不放回采样，同一条 query 不会被重复送去改写
+    expander = QueryExpander(query_meta)
+    rng = random.Random(config.get("seed"))
+    rendered_seen = set()
     num_per_template = config["num_per_template"]
     id = 0
     for idx, q_type in enumerate(types_to_gen, start=1):
@@ -51,9 +47,11 @@ def generate_query(model, query_prompt_meta, query_meta, types_to_gen, config, o
             templates = matched.get("templates", []) # + matched.get("templates_backup", [])
             for t, template in enumerate(templates):
                 print(f"[{t}/{len(templates)}] Processing template: {template}")
-                for n in range(num_per_template):
-                    query = render_query(template, tags_values)
-
+                queries = expander.sample_template(template, num_per_template, rng, query_type=q_type,
+                                                   exclude=rendered_seen)
+                if len(queries) < num_per_template:
+                    print(f"  [!] Only {len(queries)} unique queries available for this template")
+                for query in queries:
                     prompt_values = {}
                     prompt_values["user_query"] = query
 
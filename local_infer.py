@@ -0,0 +1,1056 @@
+import builtins
+import copy
+import keyword
+import os
+import re
+import sys
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+from swift.llm import InferRequest
+from transformers import DynamicCache, LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+
+def common_prefix_length(sequences: Sequence[Sequence[int]]) -> int:
+    """一组 token id 序列的最长公共前缀长度。"""
+    if not sequences:
+        return 0
+    first = sequences[0]
+    n = min(len(s) for s in sequences)
+    for s in sequences[1:]:
+        i = 0
+        while i < n and s[i] == first[i]:
+            i += 1
+        n = i
+        if n == 0:
+            break
+    return n
+
+
+def stop_token_ids(tokenizer, template=None) -> List[int]:
+    """
+    收集生成的终止 token：tokenizer 的 eos，加上模板 stop_words 中能编码为单个 token 的词
+    （例如 Qwen 的 <|im_end|>）。
+    """
+    ids = set()
+    if tokenizer.eos_token_id is not None:
+        ids.add(tokenizer.eos_token_id)
+    words = list(getattr(getattr(template, 'template_meta', None), 'stop_words', None) or [])
+    words.append('<|im_end|>')
+    for w in words:
+        if not isinstance(w, str):
+            continue
+        tok = tokenizer.encode(w, add_special_tokens=False)
+        if len(tok) == 1:
+            ids.add(tok[0])
+    return sorted(ids)
+
+
+def compile_extractors(regex_extractors: Dict[str, Dict[str, Any]],
+                       names: Sequence[str] = ("prog_block",)) -> List["re.Pattern"]:
+    """
+    把 agent_prompt_meta["target_output"]["regex_extractors"] 中 names 指定的项编译为正则列表，
+    flags 字段形如 'DOTALL' / 'DOTALL|MULTILINE'。
+    默认只取 prog_block：其余 extractor（如 v1 的 call_tag / run_tag / loop_block）会在程序块内部
+    提前命中，不能作为停止条件。
+    """
+    patterns = []
+    for spec in (regex_extractors[name] for name in names):
+        flags = 0
+        for name in str(spec.get("flags", "") or "").replace(",", "|").split("|"):
+            name = name.strip()
+            if name:
+                flags |= getattr(re, name)
+        patterns.append(re.compile(spec["pattern"], flags))
+    return patterns
+
+
+class IncrementalDetokenizer:
+    """
+    按行维护已生成文本，每步只解码新 token（沿用 TextStreamer 的 prefix/read offset 做法，
+    避免多字节字符被截断）。供 stopping criteria / logits processor 共用。
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.reset(0, 0)
+
+    def reset(self, prompt_length: int, batch_size: int):
+        self.prompt_length = prompt_length
+        self.texts = [""] * batch_size
+        self.prefix_offsets = [0] * batch_size
+        self.read_offsets = [0] * batch_size
+
+    def update(self, input_ids: torch.LongTensor, skip_rows: Sequence[bool] = ()) -> List[str]:
+        """解码每行新增的 token，返回各行新增的文本片段（无新增或字符不完整时为 ""）。"""
+        if len(self.texts) != input_ids.shape[0]:
+            self.reset(self.prompt_length, input_ids.shape[0])
+        pieces = [""] * input_ids.shape[0]
+        for row, ids in enumerate(input_ids[:, self.prompt_length:].tolist()):
+            if (skip_rows and skip_rows[row]) or len(ids) <= self.read_offsets[row]:
+                continue
+            prefix_text = self.tokenizer.decode(ids[self.prefix_offsets[row]:self.read_offsets[row]],
+                                                skip_special_tokens=True)
+            new_text = self.tokenizer.decode(ids[self.prefix_offsets[row]:], skip_special_tokens=True)
+            if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+                continue  # 多字节字符尚未完整，等下一步
+            pieces[row] = new_text[len(prefix_text):]
+            self.texts[row] += pieces[row]
+            self.prefix_offsets[row] = self.read_offsets[row]
+            self.read_offsets[row] = len(ids)
+        return pieces
+
+
+class RegexStoppingCriteria(StoppingCriteria):
+    """
+    一旦生成内容中出现 extract_workflow 所需的第一个完整匹配（例如 ```python ... ``` 程序块闭合），
+    立即结束该序列；batch 内各序列独立判断（返回逐行的 bool）。
+    只有新增文本中出现闭合分隔符的字符时才重新做正则匹配。
+    """
+
+    def __init__(self, tokenizer, patterns: Sequence["re.Pattern"]):
+        self.detok = IncrementalDetokenizer(tokenizer)
+        self.patterns = list(patterns)
+        # 闭合分隔符里可能出现的字符（``` 或 </Python>）；模式里都不含时每步都匹配
+        self.trigger_chars = {c for c in "`>" if any(c in p.pattern for p in self.patterns)}
+        self.reset(0, 0)
+
+    def reset(self, prompt_length: int, batch_size: int):
+        self.detok.reset(prompt_length, batch_size)
+        self.done = [False] * batch_size
+        # 各行命中时已生成的 token 数；之后 generate 会给该行补 pad，不能计入生成长度
+        self.stop_lengths: List[Optional[int]] = [None] * batch_size
+
+    def _matched(self, text: str) -> bool:
+        return any(p.search(text) for p in self.patterns)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if len(self.done) != input_ids.shape[0]:
+            self.reset(self.detok.prompt_length, input_ids.shape[0])
+        pieces = self.detok.update(input_ids, skip_rows=self.done)
+        for row, piece in enumerate(pieces):
+            if not piece or self.done[row]:
+                continue
+            if (not self.trigger_chars or any(c in piece for c in self.trigger_chars)) \
+                    and self._matched(self.detok.texts[row]):
+                self.done[row] = True
+                self.stop_lengths[row] = input_ids.shape[1] - self.detok.prompt_length
+        return torch.tensor(self.done, dtype=torch.bool, device=input_ids.device)
+
+
+# 程序块包裹形式：(开头, 闭合标记)
+WORKFLOW_WRAPPERS = {
+    "fenced": ("```Python\n", "```"),
+    "tag": ("<Python>\n", "</Python>"),
+    "prog": ("<prog>\n", "</prog>"),   # v1 模板
+}
+
+
+def workflow_wrapper(pattern: str) -> str:
+    """根据 prog_block 的正则选择 WORKFLOW_WRAPPERS 中对应的包裹形式。"""
+    if "<prog>" in pattern:
+        return "prog"
+    if "<Python>" in pattern:
+        return "tag"
+    return "fenced"
+
+
+_IDENT_TAIL = re.compile(r"[A-Za-z_][A-Za-z0-9_]*$")
+_BINDING_PATTERNS = [
+    re.compile(r"(?m)^[ \t]*([A-Za-z_][\w \t,]*?)[ \t]*(?:\+|-|\*|/|//|%)?=(?!=)"),  # a = / a, b = / a += ...
+    re.compile(r"\bfor\s+([\w\s,()]+?)\s+in\b"),                                 # for x in / 推导式
+    re.compile(r"\bdef\s+(\w+)\s*\(([^)]*)\)"),                                   # def f(a, b)
+    re.compile(r"\blambda\s+([\w\s,=]*):"),
+    re.compile(r"\b(?:as|import)\s+(\w+)"),
+    re.compile(r"\bclass\s+(\w+)"),
+]
+_QUOTES = "'\""
+
+
+def binding_names(code: str) -> set:
+    """代码片段（字符串 / 注释已被 mask_literals 抹掉）中赋值、for、def、lambda、import、class 绑定的名字。"""
+    names = set()
+    for pat in _BINDING_PATTERNS:
+        for m in pat.finditer(code):
+            for group in m.groups():
+                names.update(re.findall(r"[A-Za-z_]\w*", group or ""))
+    return names
+
+
+def mask_literals(text: str, state: Tuple[Optional[str], bool, bool] = (None, False, False)
+                  ) -> Tuple[str, Tuple[Optional[str], bool, bool]]:
+    """
+    把 text 中字符串字面量与注释的内容替换为空格（引号与换行保留），返回 (代码文本, 结束时的状态)。
+    state = (未闭合的引号 ' / " / \'\'\' / \"\"\", 是否在注释中, 上一个字符是否为转义符)，
+    可以把上一段的状态传入，对逐步生成的文本做增量处理。
+    """
+    quote, comment, escape = state
+    out: List[str] = []
+    i, n = 0, len(text)
+    while i < n:
+        c = text[i]
+        if comment:
+            comment = c != "\n"
+            out.append(c if c == "\n" else " ")
+            i += 1
+        elif quote:
+            if escape:
+                escape = False
+                out.append(" ")
+                i += 1
+            elif c == "\\":
+                escape = True
+                out.append(" ")
+                i += 1
+            elif text.startswith(quote, i):
+                out.append(quote)
+                i += len(quote)
+                quote = None
+            else:
+                if c == "\n" and len(quote) == 1:
+                    quote = None  # 单引号字符串不跨行
+                out.append(c if c == "\n" else " ")
+                i += 1
+        elif c == "#":
+            comment = True
+            out.append(" ")
+            i += 1
+        elif c in _QUOTES:
+            quote = c * 3 if text.startswith(c * 3, i) else c
+            out.append(quote)
+            i += len(quote)
+        else:
+            out.append(c)
+            i += 1
+    return "".join(out), (quote, comment, escape)
+
+
+class WorkflowGrammarLogitsProcessor(LogitsProcessor):
+    """
+    约束本地解码输出为单个程序块：
+    - open：逐字符强制包裹开头（默认 ```Python\n），每个位置允许的 token 集在初始化时预计算
+    - body：出现 '(' 的 token 只有在其前面的函数名是 tool 名、已绑定的名字、builtins / 关键字，
+      或属于 obj.method( 形式时才允许（字符串字面量与注释内不限制，其中的名字也不算绑定）；
+      body 阶段禁止 eos，避免程序块未闭合就结束
+    - done：闭合标记出现后只允许 eos
+
+    词表索引（每个 token 的文本、含 '(' 的 token 及其 '(' 前的标识符片段）只在构造时计算一次，
+    每步只做集合查询，并按 (当前标识符, 已绑定名字版本) 缓存 mask；已绑定名字按新增文本增量扫描。
+    """
+
+    def __init__(self, tokenizer, tool_names: Sequence[str], eos_token_id: Sequence[int], wrapper: str = "fenced"):
+        self.detok = IncrementalDetokenizer(tokenizer)
+        self.open_text, self.close_text = WORKFLOW_WRAPPERS[wrapper]
+        self.eos_token_id = list(eos_token_id)
+        self.base_allowed = set(tool_names) | set(dir(builtins)) | set(keyword.kwlist)
+
+        vocab_size = len(tokenizer)
+        texts = tokenizer.batch_decode([[i] for i in range(vocab_size)], skip_special_tokens=False)
+        special = set(tokenizer.all_special_ids)
+        self.vocab_size = vocab_size
+
+        # open 阶段：已输出 open_text[:k] 时允许的 token（恰好是剩余部分的前缀，或覆盖剩余部分后进入 body）
+        self.open_allowed: List[torch.LongTensor] = []
+        for k in range(len(self.open_text)):
+            rest = self.open_text[k:]
+            ids = [i for i, t in enumerate(texts)
+                   if t and i not in special and "\ufffd" not in t and (rest.startswith(t) or t.startswith(rest))]
+            self.open_allowed.append(torch.tensor(ids, dtype=torch.long))
+
+        # body 阶段：含 '(' 的 token。pure: '(' 前全是标识符字符，函数名需与已生成文本末尾的标识符拼接；
+        # static: token 内部就能确定函数名（或 '(' 前不是标识符，如 '((' / ' = ('），method 调用直接放行
+        self.pure: Dict[str, List[int]] = {}
+        self.static: Dict[str, List[int]] = {}
+        for i, t in enumerate(texts):
+            if "(" not in t or i in special:
+                continue
+            pre = t[:t.index("(")]
+            if re.fullmatch(r"[A-Za-z0-9_]*", pre):
+                self.pure.setdefault(pre, []).append(i)
+                continue
+            m = _IDENT_TAIL.search(pre)
+            if m is None or pre[:m.start()].endswith("."):
+                continue  # 非函数调用 / 方法调用
+            self.static.setdefault(m.group(0), []).append(i)
+        self._mask_cache: Dict[Tuple[str, bool, int], torch.LongTensor] = {}
+        self.reset(0, 0)
+
+    def reset(self, prompt_length: int, batch_size: int):
+        self.detok.reset(prompt_length, batch_size)
+        self.bound = [set() for _ in range(batch_size)]
+        self.bound_version = [0] * batch_size
+        # 增量扫描状态：body 已处理的字符数、mask_literals 的状态、当前未结束行（已抹掉字面量）
+        self.consumed = [0] * batch_size
+        self.lex_state = [(None, False, False)] * batch_size
+        self.line = [""] * batch_size
+        self._mask_cache.clear()
+
+    def _add_row(self):
+        self.bound.append(set())
+        self.bound_version.append(0)
+        self.consumed.append(0)
+        self.lex_state.append((None, False, False))
+        self.line.append("")
+
+    def _update_bindings(self, row: int, body: str) -> bool:
+        """
+        只处理 body 中新增的文本：字符串 / 注释内容先抹掉，已结束的行扫描一次后丢弃，
+        每步只重新扫描当前未结束的一行。返回当前位置是否在字符串字面量或注释中。
+        """
+        new = body[self.consumed[row]:]
+        # 末尾 1-2 个相同的引号可能是三引号的一部分（被切在两个 token 里），留到下一步与后续字符一起处理；
+        # 留下的引号之后要么在字符串内、要么紧跟在字符串之后，约束时按字符串内处理
+        held = len(new) - len(new.rstrip(new[-1])) if new and new[-1] in _QUOTES else 0
+        if held < 3:
+            new = new[:len(new) - held]
+        else:
+            held = 0
+        code, self.lex_state[row] = mask_literals(new, self.lex_state[row])
+        self.consumed[row] += len(new)
+        line = self.line[row] + code
+        names = set()
+        if "\n" in line:
+            done, line = line.rsplit("\n", 1)
+            names |= binding_names(done + "\n")
+        self.line[row] = line
+        names |= binding_names(line)
+        if names - self.bound[row]:
+            self.bound[row] |= names
+            self.bound_version[row] = hash(frozenset(self.bound[row]))
+        quote, comment, _ = self.lex_state[row]
+        return bool(quote or comment or held)
+
+    def _disallowed(self, row: int, body: str) -> torch.LongTensor:
+        """body 阶段当前位置禁止的 token id（函数名不合法的 '(' token）。"""
+        m = _IDENT_TAIL.search(body)
+        cur = m.group(0) if m else ""
+        after_dot = body[:m.start()].endswith(".") if m else body.endswith(".")
+        key = (cur, after_dot, self.bound_version[row])
+        cached = self._mask_cache.get(key)
+        if cached is not None:
+            return cached
+        allowed = self.base_allowed | self.bound[row]
+        banned: List[int] = []
+        if not after_dot:
+            for pre, ids in self.pure.items():
+                name = cur + pre
+                # name 为空：'(' 前不是标识符（如 '= (' 之后直接 '('），不限制
+                if name and not name[0].isdigit() and name not in allowed:
+                    banned.extend(ids)
+        for name, ids in self.static.items():
+            if name not in allowed:
+                banned.extend(ids)
+        mask = torch.tensor(banned, dtype=torch.long)
+        self._mask_cache[key] = mask
+        return mask
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        self.detok.update(input_ids)
+        scores = scores.clone()
+        for row, text in enumerate(self.detok.texts):
+            if len(self.bound) <= row:
+                self._add_row()
+            if len(text) < len(self.open_text) and self.open_text.startswith(text):
+                allowed = self.open_allowed[len(text)].to(scores.device)
+                keep = scores[row, allowed]
+                scores[row] = -float("inf")
+                scores[row, allowed] = keep
+                continue
+            body = text[len(self.open_text):]
+            if self.close_text in body:
+                keep = scores[row, self.eos_token_id]
+                scores[row] = -float("inf")
+                scores[row, self.eos_token_id] = keep
+                continue
+            in_literal = self._update_bindings(row, body)
+            scores[row, self.eos_token_id] = -float("inf")
+            if in_literal:
+                continue  # 字符串 / 注释里的 name( 不是函数调用，不做限制
+            banned = self._disallowed(row, body)
+            if banned.numel():
+                scores[row, banned.to(scores.device)] = -float("inf")
+        return scores
+
+
+class NGramDraft:
+    """
+    n-gram 草稿：用训练集 workflow（以及当前 prompt / 已生成内容）中出现过的 n-gram 预测后续 token。
+    workflow 由固定的 tool 名与少量语法组成，重复度很高，简单的查表即可给出较长的草稿。
+    """
+
+    def __init__(self, sequences: Sequence[Sequence[int]] = (), n: int = 3, num_draft_tokens: int = 8):
+        self.n = n
+        self.num_draft_tokens = num_draft_tokens
+        counts: Dict[Tuple[int, ...], Dict[int, int]] = {}
+        for seq in sequences:
+            for i in range(len(seq) - n):
+                nxt = counts.setdefault(tuple(seq[i:i + n]), {})
+                nxt[seq[i + n]] = nxt.get(seq[i + n], 0) + 1
+        # 每个上下文只保留出现次数最多的后继
+        self.table: Dict[Tuple[int, ...], int] = {k: max(v, key=v.get) for k, v in counts.items()}
+        self.local: Dict[Tuple[int, ...], int] = {}
+        self.indexed = 0
+
+    def reset(self):
+        self.local = {}
+        self.indexed = 0
+
+    def _index(self, seq: Sequence[int]):
+        """把当前序列（prompt + 已生成）中的 n-gram 增量加入局部表，后出现的覆盖先出现的。"""
+        for i in range(max(self.indexed - self.n, 0), len(seq) - self.n):
+            self.local[tuple(seq[i:i + self.n])] = seq[i + self.n]
+        self.indexed = len(seq)
+
+    def propose(self, seq: Sequence[int]) -> List[int]:
+        self._index(seq)
+        ctx = list(seq[-self.n:])
+        out: List[int] = []
+        while len(out) < self.num_draft_tokens:
+            key = tuple(ctx[-self.n:])
+            nxt = self.table.get(key, self.local.get(key))
+            if nxt is None:
+                break
+            out.append(nxt)
+            ctx.append(nxt)
+        return out
+
+    def rollback(self, valid_length: int):
+        pass
+
+    def describe(self) -> str:
+        return f"ngram(n={self.n}, contexts={len(self.table)})"
+
+
+class ModelDraft:
+    """小模型草稿：与目标模型共享 tokenizer，自带 KV cache，验证失败时 crop 回已确认的长度。"""
+
+    def __init__(self, model, num_draft_tokens: int = 4, name: Optional[str] = None):
+        self.model = model
+        self.num_draft_tokens = num_draft_tokens
+        self.name = name or getattr(model.config, "_name_or_path", None) or "draft"
+        self.reset()
+
+    @classmethod
+    def from_pretrained(cls, path: str, device=None, dtype=None, num_draft_tokens: int = 4) -> "ModelDraft":
+        from transformers import AutoModelForCausalLM
+        model = AutoModelForCausalLM.from_pretrained(path, torch_dtype=dtype or "auto").eval()
+        if device is not None:
+            model = model.to(device)
+        return cls(model, num_draft_tokens=num_draft_tokens, name=path)
+
+    def reset(self):
+        self.cache = DynamicCache()
+        self.cached = 0
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    @torch.inference_mode()
+    def propose(self, seq: Sequence[int]) -> List[int]:
+        inp = torch.tensor([list(seq[self.cached:])], device=self.device)
+        out: List[int] = []
+        for _ in range(self.num_draft_tokens):
+            logits = self.model(input_ids=inp, past_key_values=self.cache, use_cache=True).logits
+            self.cached += inp.shape[1]
+            tok = int(logits[0, -1].argmax())
+            out.append(tok)
+            inp = torch.tensor([[tok]], device=self.device)
+        return out
+
+    def rollback(self, valid_length: int):
+        # cache 中最后一个草稿 token 尚未喂入，因此有效长度不超过 self.cached
+        self.cached = min(self.cached, valid_length)
+        self.cache.crop(self.cached)
+
+    def describe(self) -> str:
+        return f"model({self.name}, k={self.num_draft_tokens})"
+
+
+class StepTimer(StoppingCriteria):
+    """不做停止判断，只在每个解码步记录时间戳（generate 每生成一个 token 调用一次），用于 TTFT / 逐条解码耗时。"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.step_times: List[float] = []
+
+    def reset(self, prompt_length: int = 0, batch_size: int = 0):
+        self.start = time.perf_counter()
+        self.step_times = []
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        self.step_times.append(time.perf_counter())
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+    def row_timing(self, count: int) -> Dict[str, Optional[float]]:
+        """
+        生成了 count 个 token 的那一行：首 token 延迟（含 prefill），以及首 token 之后到该行最后一个 token 的
+        解码耗时（不含 TTFT，对应 count - 1 个 token）。
+        """
+        if not self.step_times or count <= 0:
+            return {"ttft": None, "decode_seconds": 0.0}
+        last = self.step_times[min(count, len(self.step_times)) - 1]
+        return {"ttft": self.step_times[0] - self.start, "decode_seconds": last - self.step_times[0]}
+
+
+def reset_peak_memory(device=None):
+    if torch.cuda.is_available() and (device is None or torch.device(device).type == 'cuda'):
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def batch_memory(device=None) -> Dict[str, Optional[float]]:
+    """
+    内存快照：process_peak_rss_mb 是进程启动以来的峰值 RSS（ru_maxrss 无法按 batch 重置，只增不减），
+    batch_peak_allocated_mb 是（CUDA 下）自上次 reset_peak_memory 以来、即本 batch 的峰值显存分配。
+    """
+    allocated = None
+    if torch.cuda.is_available() and (device is None or torch.device(device).type == 'cuda'):
+        allocated = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return {"process_peak_rss_mb": peak_rss_bytes() / 2 ** 20, "batch_peak_allocated_mb": allocated}
+
+
+def example_perf(prompt_tokens: int, generated_tokens: int, ttft: Optional[float], decode_seconds: Optional[float],
+                 batch_size: int, memory: Dict[str, Optional[float]],
+                 batch_seconds: Optional[float] = None, batch_generated_tokens: Optional[int] = None
+                 ) -> Dict[str, Any]:
+    """
+    单条样本的性能记录（evaluate 写入 results_es 的 perf 字段）。
+    decode_seconds 不含 TTFT，tokens_per_sec 按首 token 之后的 generated_tokens - 1 个 token 计算；
+    拿不到逐条时间时（PtEngine 批量推理）decode_seconds / tokens_per_sec 为 None，
+    只记录 batch 级的 batch_seconds / batch_tokens_per_sec。
+    """
+    tokens_per_sec = None
+    if decode_seconds is not None:
+        tokens_per_sec = (generated_tokens - 1) / decode_seconds if decode_seconds > 0 and generated_tokens > 1 else 0.0
+    perf = {
+        "prompt_tokens": prompt_tokens,
+        "generated_tokens": generated_tokens,
+        "ttft": ttft,
+        "decode_seconds": decode_seconds,
+        "tokens_per_sec": tokens_per_sec,
+        "batch_size": batch_size,
+        **memory,
+    }
+    if batch_seconds is not None:
+        perf["batch_seconds"] = batch_seconds
+        perf["batch_tokens_per_sec"] = (batch_generated_tokens or 0) / batch_seconds if batch_seconds > 0 else 0.0
+    return perf
+
+
+class LocalGenerator:
+    """
+    直接在 PtEngine 加载的 HF 模型上做 generate 的本地解码器，
+    用于 swift InferEngine 不支持的解码优化（公共前缀 KV cache 复用等）。
+    prompt 通过训练时同一个 swift template 编码，保证与 engine.infer 的输入一致。
+    """
+
+    def __init__(self, model, tokenizer, template, max_new_tokens: int = 1024):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.template = template
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_id = stop_token_ids(tokenizer, template)
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else self.eos_token_id[0]
+        self.prefix_ids: List[int] = []
+        self.prefix_cache = None
+        self.prefix_prefill_seconds = 0.0
+        self.prefix_stats: Dict[str, Any] = {}
+        # 当前是否使用前缀 cache；infer 每次调用按其 prefix_cache 参数设置，避免沿用上一次调用留下的 cache
+        self.use_prefix_cache = True
+
+    @classmethod
+    def from_engine(cls, engine, max_new_tokens: int = 1024) -> "LocalGenerator":
+        return cls(engine.model, engine.processor, engine.default_template, max_new_tokens=max_new_tokens)
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def encode(self, infer_request: InferRequest) -> List[int]:
+        """用 swift template 把请求编码为 input_ids（含 generation prompt）。"""
+        return list(self.template.encode(infer_request)['input_ids'])
+
+    def decode(self, ids: Sequence[int]) -> str:
+        return self.tokenizer.decode(list(ids), skip_special_tokens=True)
+
+    # ---------------- 公共前缀 KV cache ----------------
+
+    @torch.inference_mode()
+    def build_prefix_cache(self, prompt_ids_list: Sequence[Sequence[int]], min_prefix_tokens: int = 16) -> int:
+        """
+        自动检测数据集中所有 prompt 的公共前缀（指令 + tool catalog），对其做一次 prefill 并保存 KV。
+        至少保留 1 个 token 不进入 cache，保证每条请求都有需要 prefill 的后缀。
+        返回前缀长度；前缀过短（< min_prefix_tokens）时不启用。
+        已有的前缀 cache 若仍是所有 prompt 的前缀（例如 evaluate 分 chunk 调用 infer），直接复用不再 prefill。
+        """
+        k = len(self.prefix_ids)
+        if self.prefix_cache is not None and prompt_ids_list and \
+                all(len(p) > k and list(p[:k]) == self.prefix_ids for p in prompt_ids_list):
+            # 本次没有 prefill，节省的时间不需要扣除构建开销
+            self.prefix_stats = {"prefix_tokens": k, "prefix_prefill_seconds": self.prefix_prefill_seconds,
+                                 "prefix_reused": 0, "prefilled": False}
+            return k
+        n = common_prefix_length(prompt_ids_list)
+        n = min(n, min(len(p) for p in prompt_ids_list) - 1) if prompt_ids_list else 0
+        if n < min_prefix_tokens:
+            self.prefix_ids, self.prefix_cache = [], None
+            self.prefix_stats = {"prefix_tokens": 0}
+            return 0
+
+        self.prefix_ids = list(prompt_ids_list[0][:n])
+        input_ids = torch.tensor([self.prefix_ids], device=self.device)
+        t0 = time.perf_counter()
+        out = self.model(input_ids=input_ids, use_cache=True)
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - t0
+        self.prefix_cache = out.past_key_values
+        self.prefix_prefill_seconds = elapsed
+        self.prefix_stats = {
+            "prefix_tokens": n,
+            "prefix_prefill_seconds": elapsed,
+            "prefix_reused": 0,
+            "prefilled": True,
+        }
+        print(f"[prefix_cache] shared prefix: {n} tokens, prefill {elapsed:.3f}s")
+        return n
+
+    def _cache_for(self, input_ids: Sequence[int]):
+        """若 input_ids 以缓存的前缀开头，返回可直接交给 generate 的 cache，否则返回 None。"""
+        n = len(self.prefix_ids)
+        if not self.use_prefix_cache or self.prefix_cache is None or len(input_ids) <= n \
+                or list(input_ids[:n]) != self.prefix_ids:
+            return None
+        if hasattr(self.prefix_cache, 'crop'):
+            # DynamicCache：generate 会在其后追加，结束后 crop 回前缀长度即可复用，无需拷贝
+            self.prefix_cache.crop(n)
+            return self.prefix_cache
+        return copy.deepcopy(self.prefix_cache)
+
+    # ---------------- 生成 ----------------
+
+    @torch.inference_mode()
+    def generate_batch(self, ids_list: Sequence[Sequence[int]], **generate_kwargs
+                       ) -> List[Tuple[List[int], int, Dict[str, Any]]]:
+        """
+        greedy 批量生成（左侧 padding）。batch 为 1 且命中公共前缀时只对后缀做 prefill。
+        返回每条的 (新生成的 token id（截掉终止符及其后的 padding）, 实际生成的 token 数, 性能记录)，
+        性能记录含 prompt / 生成 token 数、TTFT、该条的解码耗时与 tokens/sec，以及 batch 级峰值内存。
+        """
+        cache = self._cache_for(ids_list[0]) if len(ids_list) == 1 else None
+        max_len = max(len(x) for x in ids_list)
+        input_ids = torch.tensor([[self.pad_token_id] * (max_len - len(x)) + list(x) for x in ids_list],
+                                 device=self.device)
+        attention_mask = torch.tensor([[0] * (max_len - len(x)) + [1] * len(x) for x in ids_list],
+                                      device=self.device)
+        kwargs = dict(
+            max_new_tokens=self.max_new_tokens,
+            do_sample=False,
+            eos_token_id=self.eos_token_id,
+            pad_token_id=self.pad_token_id,
+        )
+        kwargs.update(generate_kwargs)
+        timer = StepTimer()
+        kwargs['stopping_criteria'] = StoppingCriteriaList(list(kwargs.get('stopping_criteria') or []) + [timer])
+        for hook in list(kwargs['stopping_criteria']) + list(kwargs.get('logits_processor') or []):
+            if hasattr(hook, 'reset'):
+                hook.reset(max_len, len(ids_list))
+        if cache is not None:
+            kwargs['past_key_values'] = cache
+            self.prefix_stats["prefix_reused"] += 1
+        reset_peak_memory(self.device)
+        out = self.model.generate(input_ids=input_ids, attention_mask=attention_mask, **kwargs)
+        memory = batch_memory(self.device)
+        if cache is not None and hasattr(cache, 'crop'):
+            cache.crop(len(self.prefix_ids))
+
+        stop_ids = set(self.eos_token_id) | {self.pad_token_id}
+        regex_stops = next((hook.stop_lengths for hook in kwargs['stopping_criteria']
+                            if isinstance(hook, RegexStoppingCriteria)), None)
+        results = []
+        for r, (ids, row) in enumerate(zip(ids_list, out[:, max_len:].tolist())):
+            if regex_stops is not None and regex_stops[r] is not None:
+                # 正则停止：匹配后的位置都是 pad，不是生成的 token
+                new_ids, count = row[:regex_stops[r]], regex_stops[r]
+            else:
+                end = next((i for i, t in enumerate(row) if t in stop_ids), None)
+                # eos 本身是生成出来的，计入 count
+                new_ids, count = (row, len(row)) if end is None else (row[:end], end + 1)
+            timing = timer.row_timing(count)
+            results.append((new_ids, count, example_perf(len(ids), count, timing["ttft"], timing["decode_seconds"],
+                                                         len(ids_list), memory)))
+        return results
+
+    def generate_ids(self, input_ids: Sequence[int], **generate_kwargs) -> List[int]:
+        """单条 greedy 生成，返回新生成的 token id。"""
+        return self.generate_batch([input_ids], **generate_kwargs)[0][0]
+
+    # ---------------- speculative decoding ----------------
+
+    @torch.inference_mode()
+    def speculative_generate(self, input_ids: Sequence[int], draft, stopping_criteria=None
+                             ) -> Tuple[List[int], int, Dict[str, int]]:
+        """
+        greedy speculative decoding（单条）：draft 提出若干 token，目标模型一次前向验证，
+        接受与目标 argmax 一致的最长前缀，再追加目标模型在第一个分歧处的 token。
+        每一步输出都是目标模型的 argmax，因此与 generate_batch 的 greedy 结果一致（仅受浮点误差影响）。
+        返回 (新生成的 token id, 生成 token 数, {"drafted", "accepted", "target_forwards"}, 性能记录)。
+        """
+        t0 = time.perf_counter()
+        reset_peak_memory(self.device)
+        ttft = None
+        prompt = list(input_ids)
+        stop_ids = set(self.eos_token_id)
+        cache = self._cache_for(prompt)
+        cached = len(self.prefix_ids) if cache is not None else 0
+        if cache is None:
+            cache = DynamicCache()
+        else:
+            self.prefix_stats["prefix_reused"] += 1
+        if len(prompt) - 1 > cached:
+            # 目标 cache 始终覆盖到倒数第二个 token，最后一个 token 随草稿一起喂入
+            self.model(input_ids=torch.tensor([prompt[cached:-1]], device=self.device),
+                       past_key_values=cache, use_cache=True)
+        for criteria in stopping_criteria or []:
+            if hasattr(criteria, 'reset'):
+                criteria.reset(len(prompt), 1)
+        draft.reset()
+
+        seq = list(prompt)
+        generated: List[int] = []
+        stats = {"drafted": 0, "accepted": 0, "target_forwards": 0}
+        finished = False
+        while not finished and len(generated) < self.max_new_tokens:
+            budget = self.max_new_tokens - len(generated)
+            proposal = draft.propose(seq)[:max(budget - 1, 0)]
+            logits = self.model(input_ids=torch.tensor([[seq[-1]] + proposal], device=self.device),
+                                past_key_values=cache, use_cache=True).logits[0]
+            preds = logits.argmax(-1).tolist()
+            if ttft is None:
+                ttft = time.perf_counter() - t0
+            accepted = 0
+            while accepted < len(proposal) and proposal[accepted] == preds[accepted]:
+                accepted += 1
+            stats["drafted"] += len(proposal)
+            stats["accepted"] += accepted
+            stats["target_forwards"] += 1
+
+            base = len(seq)
+            for tok in proposal[:accepted] + [preds[accepted]]:
+                seq.append(tok)
+                generated.append(tok)
+                if tok in stop_ids or any(bool(c(torch.tensor([seq], device=self.device), None)[0])
+                                          for c in stopping_criteria or []):
+                    finished = True
+                    break
+            # 只保留已确认 token 的 KV（最后一个 token 下一轮随草稿喂入）
+            cache.crop(base + accepted)
+            draft.rollback(base + accepted)
+        if cache is not None and self.prefix_cache is cache:
+            cache.crop(len(self.prefix_ids))
+
+        count = len(generated)
+        if generated and generated[-1] in stop_ids:
+            generated = generated[:-1]
+        decode_seconds = time.perf_counter() - t0 - ttft if ttft is not None else 0.0
+        perf = example_perf(len(prompt), count, ttft, decode_seconds, 1, batch_memory(self.device))
+        return generated, count, stats, perf
+
+    def infer(self, infer_requests: List[InferRequest], prefix_cache: bool = True, batch_size: int = 1,
+              stop_patterns: Optional[Sequence["re.Pattern"]] = None,
+              constrain_tools: Optional[Sequence[str]] = None, wrapper: str = "fenced",
+              draft=None, speculative_baseline: int = 0, **generate_kwargs
+              ) -> Tuple[List[str], Dict[str, Any]]:
+        """
+        生成 infer_requests 的回复，结果按输入顺序返回。
+        - prefix_cache=True：先在整个请求集合上检测公共前缀并缓存其 KV（此时逐条生成，batch_size 视为 1）
+        - batch_size > 1：按 prompt 长度降序分桶批量生成
+        - stop_patterns：regex_extractors 编译后的正则，程序块一闭合即结束该序列（batch 内逐条独立）
+        - constrain_tools：tool 名列表（extract_tool_names(tools_meta)），启用 WorkflowGrammarLogitsProcessor，
+          输出限定为单个 wrapper 形式的程序块，函数调用只能是 tool 名或已绑定的名字
+        - draft：NGramDraft / ModelDraft，启用 speculative decoding（逐条生成）；
+          speculative_baseline > 0 时对前若干条再跑一遍普通 greedy，报告加速比并核对输出是否一致
+        返回 (responses, stats)，stats 含吞吐、平均生成 token 数，以及节省的 prefill token / 时间估计。
+        """
+        prompt_ids = [self.encode(req) for req in infer_requests]
+        # 统计只反映本次调用；prefix_cache=False 时也不使用之前调用留下的 cache
+        self.prefix_stats = {}
+        self.use_prefix_cache = prefix_cache
+        if prefix_cache:
+            self.build_prefix_cache(prompt_ids)
+            if self.prefix_cache is not None and batch_size > 1:
+                print("[local_infer] prefix cache enabled, falling back to batch_size=1")
+                batch_size = 1
+        if stop_patterns:
+            generate_kwargs['stopping_criteria'] = StoppingCriteriaList(
+                [RegexStoppingCriteria(self.tokenizer, stop_patterns)])
+        if constrain_tools is not None:
+            t_index = time.perf_counter()
+            generate_kwargs['logits_processor'] = LogitsProcessorList([WorkflowGrammarLogitsProcessor(
+                self.tokenizer, constrain_tools, self.eos_token_id, wrapper=wrapper)])
+            print(f"[local_infer] grammar vocab index built in {time.perf_counter() - t_index:.2f}s")
+        if draft is not None:
+            if constrain_tools is not None:
+                raise ValueError("speculative decoding cannot be combined with constrained decoding.")
+            batch_size = 1
+
+        n = len(prompt_ids)
+        order = sorted(range(n), key=lambda i: len(prompt_ids[i]), reverse=True)
+        responses: List[Optional[str]] = [None] * n
+        generated_counts = [0] * n
+        per_example: List[Optional[Dict[str, Any]]] = [None] * n
+        spec_totals = {"drafted": 0, "accepted": 0, "target_forwards": 0}
+        spec_seconds: Dict[int, float] = {}
+        t0 = time.perf_counter()
+        for start in range(0, n, batch_size):
+            idx = order[start:start + batch_size]
+            if draft is not None:
+                t_spec = time.perf_counter()
+                new_ids, count, spec, perf = self.speculative_generate(
+                    prompt_ids[idx[0]], draft, generate_kwargs.get('stopping_criteria'))
+                spec_seconds[idx[0]] = time.perf_counter() - t_spec
+                for k, v in spec.items():
+                    spec_totals[k] += v
+                outputs = [(new_ids, count, perf)]
+            else:
+                outputs = self.generate_batch([prompt_ids[i] for i in idx], **generate_kwargs)
+            for i, (new_ids, count, perf) in zip(idx, outputs):
+                responses[i] = self.decode(new_ids)
+                generated_counts[i] = count
+                per_example[i] = perf
+            done = min(start + batch_size, n)
+            if done % 10 < batch_size or done == n:
+                print(f"[local_infer] {done}/{n} done, {time.perf_counter() - t0:.1f}s")
+        elapsed = time.perf_counter() - t0
+
+        generated_tokens = sum(generated_counts)
+        stats = {
+            "examples": n,
+            "batch_size": batch_size,
+            "seconds": elapsed,
+            "examples_per_sec": n / elapsed if elapsed > 0 else 0.0,
+            "generated_tokens": generated_tokens,
+            "avg_generated_tokens": generated_tokens / n if n else 0.0,
+            "tokens_per_sec": generated_tokens / elapsed if elapsed > 0 else 0.0,
+            "prompt_tokens": sum(len(p) for p in prompt_ids),
+            "stop_on_block": bool(stop_patterns),
+            "constrained": constrain_tools is not None,
+            # 逐条性能记录，evaluate 取出后写入 results_es，不进入 summary
+            "per_example": per_example,
+        }
+        if self.prefix_stats.get("prefix_tokens"):
+            reused = self.prefix_stats["prefix_reused"]
+            # 每次复用省掉一次前缀 prefill；本次调用构建了前缀时减去这一次 prefill 的开销
+            builds = 1 if self.prefix_stats.get("prefilled") else 0
+            stats["prefix_cache"] = {
+                **self.prefix_stats,
+                "prefill_tokens_saved": self.prefix_stats["prefix_tokens"] * max(reused - builds, 0),
+                "estimated_prefill_seconds_saved": self.prefix_stats["prefix_prefill_seconds"] * max(reused - builds, 0),
+            }
+            print(f"[prefix_cache] reused {reused} times, saved ~{stats['prefix_cache']['prefill_tokens_saved']} "
+                  f"prefill tokens (~{stats['prefix_cache']['estimated_prefill_seconds_saved']:.1f}s)")
+        if draft is not None:
+            stats["speculative"] = {
+                "draft": draft.describe(),
+                **spec_totals,
+                "acceptance_rate": spec_totals["accepted"] / spec_totals["drafted"] if spec_totals["drafted"] else 0.0,
+                "tokens_per_target_forward": generated_tokens / spec_totals["target_forwards"]
+                if spec_totals["target_forwards"] else 0.0,
+            }
+            if speculative_baseline > 0:
+                stats["speculative"]["baseline"] = self._speculative_baseline(
+                    prompt_ids, responses, spec_seconds, order[:speculative_baseline], **generate_kwargs)
+            print(f"[speculative] {stats['speculative']['draft']}: acceptance "
+                  f"{stats['speculative']['acceptance_rate']:.2%}, "
+                  f"{stats['speculative']['tokens_per_target_forward']:.2f} tokens / target forward")
+        print(f"[local_infer] avg generated tokens per example: {stats['avg_generated_tokens']:.1f}")
+        return responses, stats
+
+    def _speculative_baseline(self, prompt_ids: List[List[int]], responses: List[str], spec_seconds: Dict[int, float],
+                              idx: Sequence[int], **generate_kwargs) -> Dict[str, Any]:
+        """对 idx 中的请求用普通 greedy 重新生成，返回端到端加速比以及与 speculative 输出的一致性。"""
+        greedy_seconds = 0.0
+        mismatched = []
+        for i in idx:
+            t = time.perf_counter()
+            new_ids = self.generate_batch([prompt_ids[i]], **generate_kwargs)[0][0]
+            greedy_seconds += time.perf_counter() - t
+            if self.decode(new_ids) != responses[i]:
+                mismatched.append(i)
+        speculative_seconds = sum(spec_seconds[i] for i in idx)
+        result = {
+            "examples": len(idx),
+            "greedy_seconds": greedy_seconds,
+            "speculative_seconds": speculative_seconds,
+            "speedup": greedy_seconds / speculative_seconds if speculative_seconds > 0 else 0.0,
+            "identical_outputs": not mismatched,
+            "mismatched_indices": mismatched,
+        }
+        print(f"[speculative] baseline on {len(idx)} examples: speedup {result['speedup']:.2f}x, "
+              f"identical outputs: {result['identical_outputs']}")
+        return result
+
+
+# ---------------- CPU 量化后端 ----------------
+
+# torch 的 CPU int4 矩阵乘 kernel 支持的分组大小；另要求 out_features 是 16 的倍数
+INT4_KERNEL_GROUP_SIZES = (32, 64, 128, 256)
+
+
+def int4_kernel_available() -> bool:
+    return hasattr(torch.ops.aten, "_weight_int4pack_mm_for_cpu") \
+        and hasattr(torch.ops.aten, "_convert_weight_to_int4pack_for_cpu")
+
+
+class Int4WeightOnlyLinear(torch.nn.Module):
+    """
+    weight-only int4 线性层：权重按 group_size 分组做非对称量化（w ≈ q·scale + w_min，q ∈ [0, 15]），
+    两个 4bit 值打包进一个 uint8。
+    - fused=True：torch 支持且形状满足 kernel 要求时，权重按 _convert_weight_to_int4pack_for_cpu 的布局打包，
+      前向直接调用 _weight_int4pack_mm_for_cpu（bf16 激活，kernel 内按块反量化），不展开完整权重，
+      解码时比 float32 nn.Linear 更快
+    - fused=False：不满足条件时退回逐次反量化为激活 dtype 再做 F.linear，只节省内存、不会更快，
+      load_cpu_model 的 info["int4_fused_layers"] 记录实际走 kernel 的层数，比较速度时需留意
+    """
+
+    def __init__(self, linear: torch.nn.Linear, group_size: int = 128):
+        super().__init__()
+        self.in_features, self.out_features = linear.in_features, linear.out_features
+        w = linear.weight.detach().float()
+        self.group_size = group_size if self.in_features % group_size == 0 else self.in_features
+        g = w.reshape(self.out_features, -1, self.group_size)
+        w_min, w_max = g.amin(-1, keepdim=True), g.amax(-1, keepdim=True)
+        scale = ((w_max - w_min) / 15).clamp(min=1e-8)
+        q = ((g - w_min) / scale).round().clamp(0, 15).reshape(self.out_features, -1)
+        self.fused = int4_kernel_available() and self.group_size in INT4_KERNEL_GROUP_SIZES \
+            and self.out_features % 16 == 0
+        if self.fused:
+            # kernel 的反量化形式为 (q - 8)·scale + zero，因此 zero = w_min + 8·scale；布局 [K / group, N, 2]
+            self.register_buffer("packed", torch.ops.aten._convert_weight_to_int4pack_for_cpu(q.to(torch.int32), 1))
+            scales_and_zeros = torch.stack([scale.squeeze(-1), (w_min + 8 * scale).squeeze(-1)], dim=-1)
+            self.register_buffer("scales_and_zeros", scales_and_zeros.transpose(0, 1).contiguous().to(torch.bfloat16))
+        else:
+            q = q.to(torch.uint8)
+            if q.shape[1] % 2:
+                q = F.pad(q, (0, 1))
+            self.register_buffer("packed", q[:, 0::2] | (q[:, 1::2] << 4))
+            self.register_buffer("scale", scale.squeeze(-1).to(torch.bfloat16))
+            self.register_buffer("w_min", w_min.squeeze(-1).to(torch.bfloat16))
+        self.bias = None if linear.bias is None else torch.nn.Parameter(linear.bias.detach().clone(),
+                                                                        requires_grad=False)
+
+    def _int4_mm(self, x: torch.Tensor) -> torch.Tensor:
+        return torch.ops.aten._weight_int4pack_mm_for_cpu(x.to(torch.bfloat16).contiguous(), self.packed,
+                                                          self.group_size, self.scales_and_zeros)
+
+    def dequantize(self, dtype) -> torch.Tensor:
+        if self.fused:
+            # kernel 布局不便直接解包：用单位矩阵做一次乘法得到 W^T
+            return self._int4_mm(torch.eye(self.in_features)).t().to(dtype)
+        q = torch.stack([self.packed & 0x0F, self.packed >> 4], dim=-1).reshape(self.out_features, -1)
+        q = q[:, :self.in_features].reshape(self.out_features, -1, self.group_size).to(dtype)
+        w = q * self.scale.to(dtype).unsqueeze(-1) + self.w_min.to(dtype).unsqueeze(-1)
+        return w.reshape(self.out_features, self.in_features)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if not self.fused:
+            return F.linear(x, self.dequantize(x.dtype), self.bias)
+        out = self._int4_mm(x.reshape(-1, self.in_features)).to(x.dtype)
+        out = out.reshape(*x.shape[:-1], self.out_features)
+        return out if self.bias is None else out + self.bias
+
+
+def quantize_int4_weight_only(model: torch.nn.Module, group_size: int = 128,
+                              skip: Sequence[str] = ("lm_head",)) -> torch.nn.Module:
+    """把模型中的 nn.Linear（lm_head 除外）原地替换为 Int4WeightOnlyLinear。"""
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, torch.nn.Linear) and child_name not in skip:
+                setattr(module, child_name, Int4WeightOnlyLinear(child, group_size))
+    return model
+
+
+def quantize_for_cpu(model: torch.nn.Module, quantization: Optional[str]) -> torch.nn.Module:
+    """
+    quantization:
+    - None：不量化（float32）
+    - "int8"：torch 动态量化，nn.Linear 权重 int8、激活逐 batch 动态量化
+    - "int4"：weight-only int4（分组量化；形状满足要求时走 torch 的 CPU int4 kernel，见 Int4WeightOnlyLinear）
+    """
+    if quantization is None:
+        return model
+    if quantization == "int8":
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if quantization == "int4":
+        return quantize_int4_weight_only(model)
+    raise ValueError(f"Unsupported quantization: {quantization!r}, expected None, 'int8' or 'int4'.")
+
+
+def model_memory_bytes(model: torch.nn.Module) -> int:
+    """模型权重占用的字节数，包含动态量化层中打包的 int8 权重（它们不在 parameters() 中）。"""
+    total = sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+    for module in model.modules():
+        packed = getattr(module, "_packed_params", None)
+        if packed is not None and hasattr(packed, "_weight_bias"):
+            weight, bias = packed._weight_bias()
+            total += weight.numel() * weight.element_size()
+            total += 0 if bias is None else bias.numel() * bias.element_size()
+    return total
+
+
+def peak_rss_bytes() -> int:
+    """
+    当前进程的峰值常驻内存（Linux 下 ru_maxrss 单位为 KB，macOS 下为字节）。
+    resource 只在 Unix 上可用；Windows 下尝试 psutil 的 peak_wset，都不可用时返回 0。
+    """
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return getattr(psutil.Process().memory_info(), "peak_wset", 0)
+        except ImportError:
+            return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def load_cpu_model(model_id: str, checkpoint: Optional[str] = None, quantization: Optional[str] = "int8",
+                   num_threads: Optional[int] = None):
+    """
+    在 CPU 上加载 base model（float32），合并 LoRA adapter 后做量化，用满所有核心。
+    返回 (model, processor, template, info)，info 含量化方式、线程数、加载耗时与权重内存。
+    """
+    from swift.llm import get_model_tokenizer, get_template
+    from swift.tuners import Swift
+
+    # evaluate_sharded 的 CPU 分片通过 OMP_NUM_THREADS 平分核心
+    num_threads = num_threads or int(os.environ.get("OMP_NUM_THREADS", 0)) or os.cpu_count()
+    torch.set_num_threads(num_threads)
+    t0 = time.perf_counter()
+    model, processor = get_model_tokenizer(model_id, torch_dtype=torch.float32, device_map="cpu")
+    template = get_template(model.model_meta.template, processor)
+    if checkpoint:
+        # 量化前先把 LoRA 合并进 base 权重，量化后的 Linear 不再支持 adapter
+        model = Swift.from_pretrained(model, checkpoint)
+        if hasattr(model, "merge_and_unload"):
+            model = model.merge_and_unload()
+    fp32_bytes = model_memory_bytes(model)
+    model = quantize_for_cpu(model.eval(), quantization)
+    info = {
+        "backend": "cpu",
+        "quantization": quantization or "none",
+        "num_threads": num_threads,
+        "load_seconds": time.perf_counter() - t0,
+        "fp32_weight_mb": fp32_bytes / 2 ** 20,
+        "weight_mb": model_memory_bytes(model) / 2 ** 20,
+    }
+    if quantization == "int4":
+        int4_layers = [m for m in model.modules() if isinstance(m, Int4WeightOnlyLinear)]
+        info["int4_fused_layers"] = sum(m.fused for m in int4_layers)
+        info["int4_layers"] = len(int4_layers)
+    print(f"[cpu_backend] {model_id} ({info['quantization']}) loaded in {info['load_seconds']:.1f}s, "
+          f"weights {info['weight_mb']:.0f} MB (fp32 {info['fp32_weight_mb']:.0f} MB), {num_threads} threads")
+    return model, processor, template, info
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+
+DEFAULT_MERGED_DIR = "output/merged"
+# checkpoint 目录中决定 adapter 权重的文件（optimizer / scheduler 状态不影响合并结果）
+ADAPTER_FILES = ("adapter_config.json", "adapter_model.safetensors", "adapter_model.bin")
+MERGE_INFO = "merge_info.json"
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def checkpoint_hash(model_id: str, checkpoint: str, dtype: str = "bfloat16", length: int = 16) -> str:
+    """base model id + adapter 文件内容 + dtype 的 hash；checkpoint 被覆盖重训后 hash 随之变化。"""
+    h = hashlib.sha256(f"{model_id}\n{dtype}\n".encode("utf-8"))
+    found = False
+    for name in ADAPTER_FILES:
+        path = os.path.join(checkpoint, name)
+        if os.path.isfile(path):
+            h.update(f"{name}:{file_sha256(path)}\n".encode("utf-8"))
+            found = True
+    if not found:
+        raise FileNotFoundError(f"No adapter files ({', '.join(ADAPTER_FILES)}) found in {checkpoint}")
+    return h.hexdigest()[:length]
+
+
+def merged_model_dir(model_id: str, checkpoint: str, cache_dir: str = DEFAULT_MERGED_DIR,
+                     dtype: str = "bfloat16") -> str:
+    """合并后模型的缓存目录：<cache_dir>/<checkpoint 名>-<hash>。"""
+    name = os.path.basename(os.path.normpath(checkpoint))
+    return os.path.join(cache_dir, f"{name}-{checkpoint_hash(model_id, checkpoint, dtype)}")
+
+
+def find_merged_model(model_id: str, checkpoint: Optional[str], cache_dir: str = DEFAULT_MERGED_DIR,
+                      dtype: str = "bfloat16") -> Optional[str]:
+    """若该 checkpoint 已导出过合并模型（merge_info.json 存在且 hash 一致），返回其目录，否则返回 None。"""
+    if not checkpoint or not os.path.isdir(checkpoint):
+        return None
+    try:
+        out_dir = merged_model_dir(model_id, checkpoint, cache_dir, dtype)
+    except FileNotFoundError:
+        return None
+    return out_dir if os.path.isfile(os.path.join(out_dir, MERGE_INFO)) else None
+
+
+def export_merged_model(model_id: str, checkpoint: str, cache_dir: str = DEFAULT_MERGED_DIR,
+                        dtype: str = "bfloat16", max_shard_size: str = "2GB", overwrite: bool = False) -> str:
+    """
+    把 LoRA checkpoint 合并进 base 权重并保存为 safetensors 分片（from_pretrained 加载时 mmap），
+    同时保存 tokenizer，使合并后的目录可以直接作为 PtEngine 的 model。
+    按 checkpoint_hash 缓存：已导出时直接返回目录。先写入临时目录，完成后再改名，中途失败不会留下半成品。
+    """
+    from swift.llm import get_model_tokenizer
+    from swift.tuners import Swift
+
+    out_dir = merged_model_dir(model_id, checkpoint, cache_dir, dtype)
+    if os.path.isfile(os.path.join(out_dir, MERGE_INFO)) and not overwrite:
+        print(f"[merge_adapter] cache hit: {out_dir}")
+        return out_dir
+
+    t0 = time.perf_counter()
+    model, processor = get_model_tokenizer(model_id, torch_dtype=getattr(torch, dtype), device_map="cpu")
+    model = Swift.from_pretrained(model, checkpoint)
+    model = model.merge_and_unload()
+
+    tmp_dir = out_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    model.save_pretrained(tmp_dir, safe_serialization=True, max_shard_size=max_shard_size)
+    processor.save_pretrained(tmp_dir)
+    info: Dict[str, Any] = {
+        "model_id": model_id,
+        "checkpoint": os.path.abspath(checkpoint),
+        "checkpoint_hash": os.path.basename(out_dir).rsplit("-", 1)[-1],
+        "dtype": dtype,
+        "max_shard_size": max_shard_size,
+        "created_at": time.time(),
+        "export_seconds": time.perf_counter() - t0,
+    }
+    with open(os.path.join(tmp_dir, MERGE_INFO), "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    print(f"[merge_adapter] merged {checkpoint} into {model_id} -> {out_dir} ({info['export_seconds']:.1f}s)")
+    return out_dir
+
+
+def resolve_model(model_id: str, checkpoint: Optional[str], merged: Any = "auto",
+                  cache_dir: str = DEFAULT_MERGED_DIR) -> Tuple[str, Optional[str]]:
+    """
+    evaluate 用：决定加载哪个模型。
+    - merged="auto"：已有合并缓存则使用，否则按原方式 base + adapter
+    - merged=True：没有缓存时先导出
+    - merged=False：始终 base + adapter
+    返回 (model 路径, adapter checkpoint 或 None)。
+    """
+    if not merged or not checkpoint:
+        return model_id, checkpoint
+    path = find_merged_model(model_id, checkpoint, cache_dir)
+    if path is None and merged is True:
+        path = export_merged_model(model_id, checkpoint, cache_dir)
+    if path is None:
+        return model_id, checkpoint
+    print(f"[merge_adapter] using merged model {path}")
+    return path, None
+
+
+if __name__ == "__main__":
+    export_merged_model("Qwen/Qwen3-8B-Base", "output/t1/checkpoint-240")
@@ -0,0 +1,263 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_HISTORY_DB = "output/metrics_history.sqlite"
+# 这些字段随数据量线性增长，不写入指标表（summary 仍保存在 runs.summary_json）
+SKIP_KEYS = {"per_pair", "error_summary", "positions", "examples"}
+# 逐条样本的对比结果，runs.summary_json 中也不保存（每次 run 都有数百条，报告文件里已有）
+SUMMARY_SKIP_KEYS = {"per_pair"}
+# 量化 / 换后端时需要对照的核心指标
+DRIFT_METRICS = [
+    "comparison.exact_match_ratio",
+    "comparison.avg_extra_tools",
+    "comparison.avg_missing_tools",
+    "comparison.similarity.lcs_ratio",
+    "comparison.similarity.set_f1",
+    "est_summary.valid_ratio",
+    "est_summary.error_ratio",
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at      REAL NOT NULL,
+    source          TEXT,
+    output_dir      TEXT,
+    model_id        TEXT,
+    checkpoint      TEXT,
+    checkpoint_step INTEGER,
+    dataset_file    TEXT,
+    prompt_version  TEXT,
+    tools_hash      TEXT,
+    extra_json      TEXT,
+    summary_json    TEXT
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+    name   TEXT NOT NULL,
+    value  REAL,
+    PRIMARY KEY (run_id, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_metrics_name ON metrics(name, run_id);
+CREATE INDEX IF NOT EXISTS idx_runs_dataset_ckpt ON runs(dataset_file, checkpoint_step);
+CREATE INDEX IF NOT EXISTS idx_runs_model ON runs(model_id, checkpoint);
+CREATE INDEX IF NOT EXISTS idx_runs_prompt ON runs(prompt_version);
+CREATE INDEX IF NOT EXISTS idx_runs_tools ON runs(tools_hash);
+"""
+
+
+def strip_summary(obj: Any, skip_keys=SUMMARY_SKIP_KEYS) -> Any:
+    """去掉 summary 中任意层级的 skip_keys 字段（不修改原对象）。"""
+    if isinstance(obj, dict):
+        return {k: strip_summary(v, skip_keys) for k, v in obj.items() if k not in skip_keys}
+    if isinstance(obj, list):
+        return [strip_summary(v, skip_keys) for v in obj]
+    return obj
+
+
+def content_hash(obj: Any, length: int = 12) -> str:
+    """对 dict/list（规范化 JSON）或字符串计算短 sha256，用于 tools JSON / prompt YAML 的版本标识。"""
+    if not isinstance(obj, (str, bytes)):
+        obj = json.dumps(obj, ensure_ascii=False, sort_keys=True)
+    if isinstance(obj, str):
+        obj = obj.encode("utf-8")
+    return hashlib.sha256(obj).hexdigest()[:length]
+
+
+def prompt_version(agent_prompt_meta: Dict[str, Any]) -> str:
+    """
+    prompt YAML 的版本标识："<version>-<内容hash>"。
+    v2 / v3 模板的 version 字段相同（4.2），因此附加内容 hash 以区分。
+    """
+    return f"{agent_prompt_meta.get('version', 'unknown')}-{content_hash(agent_prompt_meta, 8)}"
+
+
+def checkpoint_step(checkpoint: Optional[str]) -> Optional[int]:
+    """'output/t1/checkpoint-240' -> 240；无法识别时返回 None。"""
+    if not checkpoint:
+        return None
+    m = re.search(r"checkpoint-(\d+)", str(checkpoint))
+    return int(m.group(1)) if m else None
+
+
+def metric_drift(current: Dict[str, Any], reference: Dict[str, float],
+                 names: Optional[List[str]] = None) -> Dict[str, Dict[str, float]]:
+    """current（嵌套 summary）相对 reference（展平后的指标）的差值：{name: {reference, current, delta}}。"""
+    flat = dict(flatten_metrics(current))
+    out = {}
+    for name in names or DRIFT_METRICS:
+        if name in flat and name in reference:
+            out[name] = {"reference": reference[name], "current": flat[name], "delta": flat[name] - reference[name]}
+    return out
+
+
+def flatten_metrics(obj: Any, prefix: str = "") -> Iterator[Tuple[str, float]]:
+    """把嵌套 summary 中的数值叶子展开为 ('comparison.exact_match_ratio', 0.85) 形式。"""
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            if k in SKIP_KEYS:
+                continue
+            yield from flatten_metrics(v, f"{prefix}.{k}" if prefix else str(k))
+    elif isinstance(obj, (int, float)):  # bool 记为 0/1
+        yield prefix, float(obj)
+
+
+class MetricsHistory:
+    """
+    基于 SQLite 的跨 run 指标历史库。
+    每次 evaluate / compare_report_sets 的 summary 写入一行 runs（含运行元数据）
+    和若干行 metrics（展平后的数值指标），按指标名与 dataset/checkpoint 建索引。
+    """
+
+    def __init__(self, db_path: str = DEFAULT_HISTORY_DB):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(
+        self,
+        summary: Dict[str, Any],
+        source: str = "compare_report_sets",
+        output_dir: Optional[str] = None,
+        model_id: Optional[str] = None,
+        checkpoint: Optional[str] = None,
+        dataset_file: Optional[str] = None,
+        prompt_version: Optional[str] = None,
+        tools_hash: Optional[str] = None,
+        store_summary: bool = True,
+        **extra: Any,
+    ) -> int:
+        """写入一次 run 的 summary，返回 run_id。store_summary=True 时保存去掉 per_pair 的 summary JSON。"""
+        with self.conn:
+            cur = self.conn.execute(
+                "INSERT INTO runs (created_at, source, output_dir, model_id, checkpoint, checkpoint_step, "
+                "dataset_file, prompt_version, tools_hash, extra_json, summary_json) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), source, output_dir, model_id, checkpoint, checkpoint_step(checkpoint),
+                 dataset_file, prompt_version, tools_hash,
+                 json.dumps(extra, ensure_ascii=False, default=str) if extra else None,
+                 json.dumps(strip_summary(summary), ensure_ascii=False, default=str) if store_summary else None),
+            )
+            run_id = cur.lastrowid
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO metrics (run_id, name, value) VALUES (?, ?, ?)",
+                ((run_id, name, value) for name, value in flatten_metrics(summary)),
+            )
+        return run_id
+
+    def query(
+        self,
+        metric: str,
+        dataset_file: Optional[str] = None,
+        model_id: Optional[str] = None,
+        prompt_version: Optional[str] = None,
+        tools_hash: Optional[str] = None,
+        group_by: str = "checkpoint",
+        latest_only: bool = True,
+    ) -> List[Dict[str, Any]]:
+        """
+        查询某个指标的历史，例如
+        ``history.query("comparison.exact_match_ratio", dataset_file="v2_test", group_by="checkpoint")``。
+        dataset_file 做子串匹配；latest_only=True 时每个 group 只保留写入时间最新的一次 run
+        （与 checkpoint_step 无关，group_by 不是 checkpoint 时也不会误取 step 最大的 run）。
+        结果按 checkpoint_step、写入时间排序。
+        """
+        allowed = {"checkpoint", "model_id", "dataset_file", "prompt_version", "tools_hash", "output_dir"}
+        if group_by not in allowed:
+            raise ValueError(f"group_by must be one of {sorted(allowed)}, got {group_by!r}")
+        where, params = ["m.name = ?"], [metric]
+        if dataset_file:
+            where.append("r.dataset_file LIKE ?")
+            params.append(f"%{dataset_file}%")
+        for col, val in (("model_id", model_id), ("prompt_version", prompt_version), ("tools_hash", tools_hash)):
+            if val:
+                where.append(f"r.{col} = ?")
+                params.append(val)
+        sql = (
+            f"SELECT r.{group_by} AS grp, m.value, r.run_id, r.created_at, r.checkpoint_step "
+            f"FROM metrics m JOIN runs r ON r.run_id = m.run_id WHERE {' AND '.join(where)} "
+            f"ORDER BY r.checkpoint_step, r.created_at"
+        )
+        rows = self.conn.execute(sql, params).fetchall()
+        out: Dict[Any, Dict[str, Any]] = {}
+        result = []
+        for grp, value, run_id, created_at, step in rows:
+            rec = {group_by: grp, metric: value, "run_id": run_id, "created_at": created_at}
+            if latest_only:
+                # 行按 step 排序，最新与否单独按 created_at（相同时按 run_id）比较
+                prev = out.get(grp)
+                if prev is None or (created_at, run_id) >= (prev["created_at"], prev["run_id"]):
+                    out[grp] = rec
+            else:
+                result.append(rec)
+        return list(out.values()) if latest_only else result
+
+    def latest_run(
+        self,
+        source: Optional[str] = None,
+        model_id: Optional[str] = None,
+        checkpoint: Optional[str] = None,
+        dataset_file: Optional[str] = None,
+        prompt_version: Optional[str] = None,
+        tools_hash: Optional[str] = None,
+        extra_defaults: Optional[Dict[str, Any]] = None,
+        **extra: Any,
+    ) -> Optional[int]:
+        """
+        满足条件的最新 run_id（各字段精确匹配）。extra 按 extra_json 中的字段过滤，
+        extra_defaults 给出旧记录缺失该字段时的取值，例如
+        ``latest_run(..., extra_defaults={"infer_backend": "pt"}, infer_backend="pt")``。
+        """
+        extra_defaults = extra_defaults or {}
+        where, params = [], []
+        for col, val in (("source", source), ("model_id", model_id), ("checkpoint", checkpoint),
+                         ("dataset_file", dataset_file), ("prompt_version", prompt_version),
+                         ("tools_hash", tools_hash)):
+            if val is not None:
+                where.append(f"{col} = ?")
+                params.append(val)
+        for key, val in extra.items():
+            where.append(f"COALESCE(json_extract(extra_json, '$.{key}'), ?) = ?")
+            params.extend([extra_defaults.get(key), val])
+        sql = "SELECT run_id FROM runs" + (f" WHERE {' AND '.join(where)}" if where else "") + \
+              " ORDER BY run_id DESC LIMIT 1"
+        row = self.conn.execute(sql, params).fetchone()
+        return row[0] if row else None
+
+    def run_metrics(self, run_id: int) -> Dict[str, float]:
+        """某次 run 的全部展平指标。"""
+        return dict(self.conn.execute("SELECT name, value FROM metrics WHERE run_id = ?", (run_id,)))
+
+    def runs(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """最近的 run 元数据（不含 summary_json）。"""
+        cur = self.conn.execute(
+            "SELECT run_id, created_at, source, output_dir, model_id, checkpoint, dataset_file, prompt_version, "
+            "tools_hash FROM runs ORDER BY run_id DESC LIMIT ?", (limit,))
+        names = [d[0] for d in cur.description]
+        return [dict(zip(names, row)) for row in cur.fetchall()]
+
+    def metric_names(self) -> List[str]:
+        return [r[0] for r in self.conn.execute("SELECT DISTINCT name FROM metrics ORDER BY name")]
+
+
+if __name__ == "__main__":
+    history = MetricsHistory(DEFAULT_HISTORY_DB)
+    for row in history.query("comparison.exact_match_ratio", dataset_file="v2_test", group_by="checkpoint"):
+        print(row)
@@ -1,19 +1,74 @@
 # import some libraries
 import os
+import time
 import multiprocessing as mp
 
 from evaluate import evaluate
+from sft_callbacks import WorkflowEvalCallback
+from sft_data import (BATCHING_MODES, DEFAULT_ENCODE_CACHE, LengthGroupedDataset, batch_padding_stats,
+                      gradient_accumulation_for, load_encoded_dataset)
 from utils import read_yaml_file, load_json
 
 os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 
-from swift.llm import get_model_tokenizer, load_dataset, get_template, EncodePreprocessor
+from swift.llm import get_model_tokenizer, get_template
+from swift.llm.dataset import PackingDataset
 from swift.utils import get_logger, find_all_linears, get_model_parameter_info, seed_everything, plot_images
 from swift.tuners import Swift, LoraConfig
 from swift.trainers import Seq2SeqTrainer, Seq2SeqTrainingArguments
 
 
-def main(model_id_or_path, dataset, output_dir, agent_prompt_meta, tools_meta, dataset_test=None):
+class ThroughputSeq2SeqTrainer(Seq2SeqTrainer):
+    """
+    在训练日志中附加 tokens_per_sec（非 padding token）与 padding_ratio，
+    统计区间为两次 train log 之间的 training_step。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._reset_throughput()
+
+    def _reset_throughput(self):
+        self._tp_start = None
+        self._tp_tokens = 0
+        self._tp_padded = 0
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        if self._tp_start is None:
+            self._tp_start = time.perf_counter()
+        input_ids = inputs.get('input_ids')
+        if input_ids is not None:
+            mask = inputs.get('attention_mask')
+            self._tp_padded += input_ids.numel()
+            # packing（padding_free）时没有 attention_mask，整行都是真实 token
+            self._tp_tokens += int(mask.sum()) if mask is not None and mask.dim() == 2 else input_ids.numel()
+        return super().training_step(model, inputs, *args, **kwargs)
+
+    def log(self, logs, *args, **kwargs):
+        if 'loss' in logs and self._tp_start is not None and self._tp_padded:
+            elapsed = time.perf_counter() - self._tp_start
+            logs['tokens_per_sec'] = round(self._tp_tokens / elapsed, 2) if elapsed > 0 else 0.0
+            logs['padding_ratio'] = round(1 - self._tp_tokens / self._tp_padded, 4)
+            self._reset_throughput()
+        return super().log(logs, *args, **kwargs)
+
+
+def main(model_id_or_path, dataset, output_dir, agent_prompt_meta, tools_meta, dataset_test=None,
+         batching='pad', max_length=2048, group_batch_size=4, samples_per_step=16,
+         encode_cache_dir=DEFAULT_ENCODE_CACHE, workflow_eval_examples=64, type_source=None):
+    """
+    batching:
+    - 'pad'：原方式，batch 1 + 梯度累积
+    - 'packing'：多条样本拼接到 max_length（swift PackingDataset，position_ids 每条样本从 0 开始，
+      注意力按 position_ids 划分、样本间互不可见）
+    - 'group_by_length'：每个 batch 由 group_batch_size 条长度相近的样本组成
+    两种新模式都会调整梯度累积步数，使每个 optimizer step 覆盖的样本数约为 samples_per_step。
+    编码后的数据集缓存在 encode_cache_dir（为 None 时不缓存），配置不变时重新启动不再 tokenize。
+    workflow_eval_examples > 0 且给出 dataset_test 时，每次 eval 在测试集的 workflow_eval_examples 条分层子集上
+    生成并打分（WorkflowEvalCallback），best checkpoint 按 workflow_exact_match_ratio 选择，训练结束后评估 best checkpoint。
+    """
+    if batching not in BATCHING_MODES:
+        raise ValueError(f"batching must be one of {BATCHING_MODES}, got {batching!r}")
     logger = get_logger()
     seed_everything(42)
 
@@ -22,34 +77,81 @@ def main(model_id_or_path, dataset, output_dir, agent_prompt_meta, tools_meta, d
 
     # ====== dataset（本地）======
     data_seed = 42
-    max_length = 2048
     split_dataset_ratio = 0.01  # 验证集比例
-    num_proc = 1
+    num_proc = os.cpu_count() or 1  # 缓存未命中时用全部 CPU 核编码
 
 
-    # ====== load local dataset ======
+    # ====== lora ======
+    lora_rank = 8
+    lora_alpha = 32
+    output_dir = os.path.abspath(os.path.expanduser(output_dir))
+    logger.info(f'output_dir: {output_dir}')
+    #
+    # # ====== model & template & lora ======
+    model, tokenizer = get_model_tokenizer(model_id_or_path)
+    logger.info(f'model_info: {model.model_info}')
+    template = get_template(model.model_meta.template, tokenizer, max_length=max_length) #  default_system=system,
+    template.set_mode('train')
+
+    target_modules = find_all_linears(model)
+    lora_config = LoraConfig(task_type='CAUSAL_LM', r=lora_rank, lora_alpha=lora_alpha,
+                             target_modules=target_modules)
+    model = Swift.prepare_model(model, lora_config)
+    logger.info(f'lora_config: {lora_config}')
+
+    logger.info(f'model: {model}')
+    model_parameter_info = get_model_parameter_info(model)
+    logger.info(f'model_parameter_info: {model_parameter_info}')
+
+
+    # ====== load local dataset & encode ======
     # ✅ 直接把本地路径传给 load_dataset 即可；SWIFT 会自动识别 json/jsonl/csv/txt/目录
-    train_dataset, val_dataset = load_dataset(
-        dataset,
-        split_dataset_ratio=split_dataset_ratio,
-        num_proc=num_proc,
-        seed=data_seed,                 # ✅ 删除了 model_name/model_author 的占位
+    # 编码结果按 数据文件 hash + template + tokenizer + max_length 缓存为 Arrow（mmap 读取）
+    train_dataset, val_dataset, encode_info = load_encoded_dataset(
+        dataset, template, model.model_meta.template, max_length,
+        split_dataset_ratio=split_dataset_ratio, seed=data_seed, num_proc=num_proc,
+        cache_dir=encode_cache_dir, logger=logger,
     )
-
     logger.info(f'train_dataset: {train_dataset}')
     logger.info(f'val_dataset: {val_dataset}')
-    logger.info(f'train_dataset[0]: {train_dataset[0]}')
+    logger.info(f'encoded_train_dataset[0]: {train_dataset[0]}')
 
+    # 打印一条样本的模板化输入（可检查 EOS、role 拼接是否符合预期）
+    template.print_inputs(train_dataset[0])
+
+    # ====== batching ======
+    lengths = list(train_dataset['length'])
+    if batching == 'packing':
+        train_dataset = PackingDataset(template, train_dataset, num_proc=num_proc, packing_length=max_length)
+        # padding_free 的 collator 需要 length 字段，验证集也按 pack 组织（与 swift sft --packing 一致）
+        val_dataset = PackingDataset(template, val_dataset, num_proc=num_proc, packing_length=max_length)
+        # transformers 只在没有 KV cache 时按 position_ids 划分注意力，eval loss 的前向也必须关闭 cache
+        model.config.use_cache = False
+        stats = batch_padding_stats(lengths, train_dataset.packed_idx, capacity=max_length)
+    elif batching == 'group_by_length':
+        train_dataset = LengthGroupedDataset(template, train_dataset, batch_size=group_batch_size, seed=data_seed)
+        stats = batch_padding_stats(lengths, train_dataset.groups)
+    else:
+        stats = {'samples_per_group': 1}
+    gradient_accumulation_steps = gradient_accumulation_for(samples_per_step, stats['samples_per_group'])
+    logger.info(f'batching={batching}: {stats}, gradient_accumulation_steps={gradient_accumulation_steps}')
+
+    # ====== in-training workflow eval ======
+    callbacks = []
+    if dataset_test is not None and workflow_eval_examples > 0:
+        # 推理模式的模板（训练模板处于 train 模式，且可能被 packing 修改）
+        eval_template = get_template(model.model_meta.template, tokenizer, max_length=max_length)
+        callbacks.append(WorkflowEvalCallback(eval_template, agent_prompt_meta, tools_meta, dataset_test,
+                                              num_examples=workflow_eval_examples, type_source=type_source,
+                                              seed=data_seed))
+    metric_for_best_model = 'workflow_exact_match_ratio' if callbacks else 'loss'
 
-    # ====== lora ======
-    lora_rank = 8
-    lora_alpha = 32
     #
     # # ====== training_args ======
     training_args = Seq2SeqTrainingArguments(
         output_dir=output_dir,
         learning_rate=2e-5,
-        per_device_train_batch_size=1,
+        per_device_train_batch_size=1,  # packing / group_by_length 时每个元素本身就是一个 batch
         per_device_eval_batch_size=1,
         gradient_checkpointing=True,
         weight_decay=0.1,
@@ -61,57 +163,34 @@ def main(model_id_or_path, dataset, output_dir, agent_prompt_meta, tools_meta, d
         save_steps=50,
         eval_strategy='steps',
         eval_steps=50,
-        gradient_accumulation_steps=16,
+        gradient_accumulation_steps=gradient_accumulation_steps,
         num_train_epochs=2,
-        metric_for_best_model='loss',
+        metric_for_best_model=metric_for_best_model,
+        greater_is_better=metric_for_best_model != 'loss',
         save_total_limit=2,
         logging_steps=5,
         dataloader_num_workers=1,
         data_seed=data_seed,
     )
 
-    output_dir = os.path.abspath(os.path.expanduser(output_dir))
-    logger.info(f'output_dir: {output_dir}')
-    #
-    # # ====== model & template & lora ======
-    model, tokenizer = get_model_tokenizer(model_id_or_path)
-    logger.info(f'model_info: {model.model_info}')
-    template = get_template(model.model_meta.template, tokenizer, max_length=max_length) #  default_system=system,
-    template.set_mode('train')
-
-    target_modules = find_all_linears(model)
-    lora_config = LoraConfig(task_type='CAUSAL_LM', r=lora_rank, lora_alpha=lora_alpha,
-                             target_modules=target_modules)
-    model = Swift.prepare_model(model, lora_config)
-    logger.info(f'lora_config: {lora_config}')
-
-    logger.info(f'model: {model}')
-    model_parameter_info = get_model_parameter_info(model)
-    logger.info(f'model_parameter_info: {model_parameter_info}')
-
-
-    # ====== encode ======
-    train_dataset = EncodePreprocessor(template=template)(train_dataset, num_proc=num_proc)
-    val_dataset = EncodePreprocessor(template=template)(val_dataset, num_proc=num_proc)
-    logger.info(f'encoded_train_dataset[0]: {train_dataset[0]}')
-
-    # 打印一条样本的模板化输入（可检查 EOS、role 拼接是否符合预期）
-    template.print_inputs(train_dataset[0])
-
     # ====== train ======
     model.enable_input_require_grads()  # 兼容 gradient checkpointing
-    trainer = Seq2SeqTrainer(
+    trainer = ThroughputSeq2SeqTrainer(
         model=model,
         args=training_args,
         data_collator=template.data_collator,
         train_dataset=train_dataset,
         eval_dataset=val_dataset,
         template=template,
+        callbacks=callbacks,
     )
     trainer.train()
 
     last_model_checkpoint = trainer.state.last_model_checkpoint
     logger.info(f'last_model_checkpoint: {last_model_checkpoint}')
+    best_model_checkpoint = trainer.state.best_model_checkpoint
+    logger.info(f'best_model_checkpoint: {best_model_checkpoint} '
+                f'({training_args.metric_for_best_model}={trainer.state.best_metric})')
 
     images_dir = os.path.join(output_dir, 'images')
     logger.info(f'images_dir: {images_dir}')
@@ -119,7 +198,8 @@ def main(model_id_or_path, dataset, output_dir, agent_prompt_meta, tools_meta, d
 
 
     if dataset_test is not None:
-        evaluate(model_id_or_path, last_model_checkpoint, agent_prompt_meta, tools_meta,
+        eval_checkpoint = best_model_checkpoint if callbacks and best_model_checkpoint else last_model_checkpoint
+        evaluate(model_id_or_path, eval_checkpoint, agent_prompt_meta, tools_meta,
                  test_dataset=dataset_test, output_path=output_dir)
 
 if __name__ == "__main__":
@@ -131,7 +211,8 @@ if __name__ == "__main__":
     dataset_test = ['./dataset/v2_test.jsonl']
     agent_prompt_meta = read_yaml_file("prompt/agent_workflow_template_v3.yaml")
     tools_meta = load_json("dataset/tools/tools_v1.json")
-    main(model_id_or_path, dataset_train, output_dir, agent_prompt_meta, tools_meta, dataset_test=dataset_test)
+    main(model_id_or_path, dataset_train, output_dir, agent_prompt_meta, tools_meta, dataset_test=dataset_test,
+         batching='group_by_length')
 
     # Visualize the training loss.
     # You can also use the TensorBoard visualization interface during training by entering
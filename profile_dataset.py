@@ -0,0 +1,289 @@
+import glob
+import multiprocessing as mp
+import os
+import random
+import re
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from merge_adapter import file_sha256
+from metrics_history import content_hash
+from sft_data import batch_padding_stats, length_grouped_indices, tokenizer_fingerprint
+from utils import iter_jsonl, read_yaml_file, save_dict_to_json
+
+DEFAULT_PROFILE_DIR = "output/length_profile"
+DEFAULT_PROMPT_TEMPLATES = "prompt/agent_workflow_template_v*.yaml"
+CANDIDATE_MAX_LENGTHS = (1024, 2048, 3072, 4096, 6144, 8192)
+# 每条样本的 token 分解：total 为模板编码后的完整长度（与训练时一致），
+# chat_markup = total - prompt - program（system prompt、role 标记等）
+SEGMENTS = ("total", "tool_catalog", "query", "instructions", "other_fields", "program", "chat_markup")
+HIST_BIN = 256
+
+_worker: Dict[str, Any] = {}
+
+
+def compile_prompt_template(prompt_template: str) -> "re.Pattern":
+    """
+    把 agent prompt YAML 的 prompt_template（{{name}} 占位符）编译为正则：
+    字面文本中的空白折叠为 \\s*（YAML 块文本的行尾空格不影响匹配），占位符变成命名分组。
+    """
+    parts = re.split(r"\{\{(\w+)\}\}", prompt_template.strip())
+    regex, seen = [], set()
+    for i, part in enumerate(parts):
+        if i % 2:
+            # 同名占位符重复出现时只捕获第一次
+            regex.append(f"(?P<{part}>.*?)" if part not in seen else ".*?")
+            seen.add(part)
+        else:
+            regex.append(r"\s*".join(re.escape(chunk) for chunk in re.split(r"\s+", part)))
+    return re.compile(r"\s*" + "".join(regex) + r"\s*", re.DOTALL)
+
+
+def split_prompt(text: str, patterns: Sequence["re.Pattern"]) -> Optional[Dict[str, str]]:
+    """
+    按 prompt 模板把 user prompt 拆成 tool_catalog / query / other_fields / instructions 四段文本；
+    所有模板都不匹配时返回 None。
+    """
+    for pattern in patterns:
+        m = pattern.fullmatch(text)
+        if m is None:
+            continue
+        fields = m.groupdict()
+        instructions, last = [], 0
+        for name in fields:
+            start, end = m.span(name)
+            instructions.append(text[last:start])
+            last = end
+        instructions.append(text[last:])
+        return {
+            "tool_catalog": "\n".join(v for k, v in fields.items() if k.endswith("_tools")),
+            "query": fields.get("user_query", ""),
+            "other_fields": "\n".join(v for k, v in fields.items() if k != "user_query" and not k.endswith("_tools")),
+            "instructions": "".join(instructions),
+        }
+    return None
+
+
+def _init_worker(model_id: str, model_type: Optional[str], template_paths: Sequence[str]):
+    from swift.llm import get_model_tokenizer, get_template
+    _, tokenizer = get_model_tokenizer(model_id, load_model=False, model_type=model_type)
+    template = get_template(tokenizer.model_meta.template, tokenizer)
+    template.set_mode('train')
+    # get_template 的 max_length=None 会回退到模型的 max_model_len；这里要完整长度，不截断也不丢弃
+    template.max_length = None
+    _worker.update(tokenizer=tokenizer, template=template,
+                   patterns=[compile_prompt_template(read_yaml_file(p)["prompt_template"]) for p in template_paths])
+
+
+def _count_tokens(texts: List[str]) -> List[int]:
+    # fast tokenizer 的批量编码在 Rust 侧并行
+    return [len(ids) for ids in _worker["tokenizer"](texts, add_special_tokens=False)["input_ids"]]
+
+
+def _profile_batch(records: List[Dict[str, Any]]) -> Tuple[np.ndarray, int]:
+    """在 worker 中处理一批记录，返回 (len(records), len(SEGMENTS)) 的 int 矩阵与未能按模板拆分的条数。"""
+    out = np.zeros((len(records), len(SEGMENTS)), dtype=np.int64)
+    prompts, programs, parts = [], [], []
+    unsegmented = 0
+    for i, rec in enumerate(records):
+        messages = rec.get("messages") or []
+        prompt = next((m["content"] for m in messages if m.get("role") == "user"), "")
+        program = next((m["content"] for m in messages if m.get("role") == "assistant"), "")
+        try:
+            out[i, 0] = _worker["template"].encode({"messages": messages}, return_length=True)["length"]
+        except Exception:
+            out[i, 0] = -1  # 无法编码（缺少 assistant 等），统计时跳过
+        split = split_prompt(prompt, _worker["patterns"])
+        if split is None:
+            unsegmented += 1
+            split = {"tool_catalog": "", "query": "", "other_fields": "", "instructions": prompt}
+        prompts.append(prompt)
+        programs.append(program)
+        parts.append(split)
+    for col, name in enumerate(SEGMENTS):
+        if name in ("tool_catalog", "query", "instructions", "other_fields"):
+            out[:, col] = _count_tokens([p[name] for p in parts])
+    out[:, SEGMENTS.index("program")] = _count_tokens(programs)
+    prompt_tokens = np.asarray(_count_tokens(prompts), dtype=np.int64)
+    markup = out[:, 0] - prompt_tokens - out[:, SEGMENTS.index("program")]
+    out[:, SEGMENTS.index("chat_markup")] = np.where(out[:, 0] >= 0, markup, 0)
+    return out, unsegmented
+
+
+def profile_cache_key(path: str, tokenizer, template_name: str, template_paths: Sequence[str]) -> str:
+    """数据文件内容 + tokenizer 指纹 + chat template + prompt 模板内容的 hash。"""
+    return content_hash({
+        "file": file_sha256(path),
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "template": template_name,
+        "prompt_templates": [read_yaml_file(p)["prompt_template"] for p in template_paths],
+    }, 16)
+
+
+def token_lengths(path: str, model_id: str, model_type: Optional[str] = None,
+                  prompt_templates: str = DEFAULT_PROMPT_TEMPLATES, num_proc: Optional[int] = None,
+                  batch_size: int = 256, cache_dir: Optional[str] = DEFAULT_PROFILE_DIR) -> Tuple[np.ndarray, Dict[str, Any]]:
+    """
+    逐条 token 长度分解，返回 ((N, len(SEGMENTS)) 矩阵, info)。
+    结果按 profile_cache_key 缓存为 <cache_dir>/<key>.npz，数据文件或 tokenizer 不变时直接读取。
+    未命中时按 batch_size 条一批分发到 num_proc 个进程（spawn，每个进程各自加载 tokenizer / template）。
+    """
+    from swift.llm import get_model_tokenizer
+
+    template_paths = sorted(glob.glob(prompt_templates))
+    _, tokenizer = get_model_tokenizer(model_id, load_model=False, model_type=model_type)
+    template_name = tokenizer.model_meta.template
+    key = profile_cache_key(path, tokenizer, template_name, template_paths)
+    cache_path = os.path.join(cache_dir, f"{key}.npz") if cache_dir else None
+    info: Dict[str, Any] = {"dataset": path, "model_id": model_id, "template": template_name, "cache_key": key}
+    if cache_path and os.path.isfile(cache_path):
+        with np.load(cache_path) as data:
+            lengths, unsegmented = data["lengths"], int(data["unsegmented"])
+        print(f"[profile] cache hit: {cache_path}")
+        return lengths, {**info, "cache": "hit", "unsegmented": unsegmented}
+
+    t0 = time.perf_counter()
+    batches, batch = [], []
+    for rec in iter_jsonl(path, skip_invalid=True):
+        batch.append(rec)
+        if len(batch) == batch_size:
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+    num_proc = max(1, min(num_proc or os.cpu_count() or 1, len(batches)))
+    if num_proc > 1:
+        ctx = mp.get_context("spawn")
+        with ctx.Pool(num_proc, initializer=_init_worker, initargs=(model_id, model_type, template_paths)) as pool:
+            results = pool.map(_profile_batch, batches)
+    else:
+        _init_worker(model_id, model_type, template_paths)
+        results = [_profile_batch(b) for b in batches]
+    lengths = np.concatenate([r[0] for r in results]) if results else np.zeros((0, len(SEGMENTS)), dtype=np.int64)
+    unsegmented = sum(r[1] for r in results)
+    elapsed = time.perf_counter() - t0
+    print(f"[profile] tokenized {len(lengths)} records from {path} in {elapsed:.1f}s (num_proc={num_proc})")
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez_compressed(cache_path, lengths=lengths, unsegmented=unsegmented)
+    return lengths, {**info, "cache": "miss", "unsegmented": unsegmented, "tokenize_seconds": elapsed,
+                     "num_proc": num_proc}
+
+
+def _describe(values: np.ndarray) -> Dict[str, float]:
+    if values.size == 0:
+        return {"count": 0}
+    p50, p90, p95, p99 = np.percentile(values, [50, 90, 95, 99])
+    return {"count": int(values.size), "mean": float(values.mean()), "min": int(values.min()), "p50": float(p50),
+            "p90": float(p90), "p95": float(p95), "p99": float(p99), "max": int(values.max())}
+
+
+def length_histogram(values: np.ndarray, bin_size: int = HIST_BIN) -> Dict[str, int]:
+    """按 bin_size 个 token 一档统计样本数：{'0-255': n, '256-511': n, ...}。"""
+    if values.size == 0:
+        return {}
+    counts = np.bincount(values // bin_size)
+    return {f"{i * bin_size}-{(i + 1) * bin_size - 1}": int(c) for i, c in enumerate(counts) if c}
+
+
+def batching_estimates(lengths: Sequence[int], max_length: int, batch_sizes: Sequence[int] = (2, 4, 8),
+                       seed: int = 42) -> Dict[str, Any]:
+    """
+    max_length 下各 batch 组织方式的 token 效率估计（超长样本按 swift 默认 'delete' 策略丢弃）：
+    - pad：batch 1，无 padding，前向次数 = 样本数
+    - random_bB：随机组 batch，按组内最长样本 padding
+    - group_bB：按长度分组（sft_data.LengthGroupedDataset 的分组方式）
+    - packing：binpacking 拼接到 max_length（与 swift PackingDataset 相同），不做 padding（padding_free），
+      fill_ratio 为 pack 平均填充率
+    efficiency = 真实 token / 计算的 token，forwards 为前向次数（相对 pad 的减少即 batch 化收益）。
+    """
+    kept = [int(x) for x in lengths if 0 <= x <= max_length]
+    if not kept:
+        return {}
+    out: Dict[str, Any] = {"pad": {"forwards": len(kept), "efficiency": 1.0}}
+    order = list(range(len(kept)))
+    random.Random(seed).shuffle(order)
+    for b in batch_sizes:
+        random_stats = batch_padding_stats(kept, [order[i:i + b] for i in range(0, len(order), b)])
+        group_stats = batch_padding_stats(kept, length_grouped_indices(kept, b, seed=seed))
+        out[f"random_b{b}"] = {"forwards": random_stats["groups"], "efficiency": 1 - random_stats["padding_ratio"]}
+        out[f"group_b{b}"] = {"forwards": group_stats["groups"], "efficiency": 1 - group_stats["padding_ratio"]}
+    import binpacking
+    packs = binpacking.to_constant_volume(list(enumerate(kept)), max_length, weight_pos=1)
+    pack_stats = batch_padding_stats(kept, [[i for i, _ in p] for p in packs], capacity=max_length)
+    out["packing"] = {"forwards": pack_stats["groups"], "efficiency": 1.0,
+                      "samples_per_pack": pack_stats["samples_per_group"],
+                      "fill_ratio": 1 - pack_stats["padding_ratio"]}
+    return out
+
+
+def profile_report(lengths: np.ndarray, info: Dict[str, Any],
+                   max_lengths: Sequence[int] = CANDIDATE_MAX_LENGTHS) -> Dict[str, Any]:
+    """由逐条长度矩阵生成报告：分段统计与占比、直方图、各 max_length 的截断数与 batching 估计。"""
+    valid = lengths[lengths[:, 0] >= 0]
+    total = valid[:, 0]
+    total_tokens = int(total.sum())
+    report: Dict[str, Any] = {
+        **info,
+        "records": int(len(lengths)),
+        "unencodable": int(len(lengths) - len(valid)),
+        "segments": {name: {**_describe(valid[:, i]),
+                            "share": float(valid[:, i].sum() / total_tokens) if total_tokens else 0.0}
+                     for i, name in enumerate(SEGMENTS)},
+        "histogram": length_histogram(total),
+        "max_length": {},
+    }
+    for max_length in max_lengths:
+        over = total > max_length
+        report["max_length"][str(max_length)] = {
+            "truncated": int(over.sum()),
+            "truncated_ratio": float(over.mean()) if total.size else 0.0,
+            "tokens_over": int((total[over] - max_length).sum()),
+            "batching": batching_estimates(total, max_length),
+        }
+    return report
+
+
+def print_profile(report: Dict[str, Any]):
+    print(f"\n=== Token Length Profile: {report['dataset']} ({report['records']} records) ===")
+    for name, s in report["segments"].items():
+        if s.get("count"):
+            print(f"{name:15s}: mean={s['mean']:8.1f}  p50={s['p50']:8.0f}  p99={s['p99']:8.0f}  "
+                  f"max={s['max']:6d}  share={s['share']:.1%}")
+    print("--- histogram (total tokens) ---")
+    for bucket, count in report["histogram"].items():
+        print(f"{bucket:>12s}: {count}")
+    print("--- max_length ---")
+    for max_length, s in report["max_length"].items():
+        b = s["batching"]
+        extra = ""
+        if b:
+            extra = (f"  group_b4 eff={b['group_b4']['efficiency']:.2f}  random_b4 eff={b['random_b4']['efficiency']:.2f}"
+                     f"  packing {b['packing']['samples_per_pack']:.2f}/pack fill={b['packing']['fill_ratio']:.2f}")
+        print(f"{max_length:>6s}: truncated={s['truncated']} ({s['truncated_ratio']:.1%}){extra}")
+    print("==========================================\n")
+
+
+def profile_dataset(paths: Sequence[str], model_id: str, model_type: Optional[str] = None,
+                    max_lengths: Sequence[int] = CANDIDATE_MAX_LENGTHS, prompt_templates: str = DEFAULT_PROMPT_TEMPLATES,
+                    num_proc: Optional[int] = None, cache_dir: Optional[str] = DEFAULT_PROFILE_DIR,
+                    output_path: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    对数据集文件（messages 格式的 JSONL，如 v1_train / v2_test）做 token 长度剖析，
+    返回 {path: report}，output_path 给出时把报告写入 JSON。
+    """
+    reports = {}
+    for path in paths:
+        lengths, info = token_lengths(path, model_id, model_type, prompt_templates, num_proc, cache_dir=cache_dir)
+        reports[path] = profile_report(lengths, info, max_lengths)
+        print_profile(reports[path])
+    if output_path:
+        save_dict_to_json(reports, output_path)
+    return reports
+
+
+if __name__ == "__main__":
+    profile_dataset(["dataset/v1_train.jsonl", "dataset/v2_test.jsonl"], "Qwen/Qwen3-8B-Base",
+                    output_path="output/length_profile/report.json")
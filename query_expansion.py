@@ -0,0 +1,318 @@
+import bisect
+import random
+import re
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from utils import load_json, write_jsonl
+
+# query_meta 中的 <tag>，question_family 中的 <A1> 活动槽与 [R1] / [C1] 关系、连接词槽
+SLOT_PATTERN = re.compile(r"<[^<>]+>|\[[^\[\]]+\]")
+# 需要的样本数超过空间的一半（且空间不太大）时直接生成随机排列，否则拒绝采样
+DENSE_LIMIT = 1 << 22
+
+# question_family 的活动槽：(原形, 第三人称单数现在时, 过去式, 现在分词)，与 SensorQA 的活动标签对应
+FAMILY_ACTIVITIES = [
+    ("sleep", "sleeps", "slept", "sleeping"),
+    ("walk", "walks", "walked", "walking"),
+    ("run", "runs", "ran", "running"),
+    ("sit", "sits", "sat", "sitting"),
+    ("stand", "stands", "stood", "standing"),
+    ("lie down", "lies down", "lay down", "lying down"),
+    ("ride a bicycle", "rides a bicycle", "rode a bicycle", "riding a bicycle"),
+    ("drive", "drives", "drove", "driving"),
+    ("eat", "eats", "ate", "eating"),
+    ("cook", "cooks", "cooked", "cooking"),
+    ("clean", "cleans", "cleaned", "cleaning"),
+    ("shop", "shops", "shopped", "shopping"),
+    ("do laundry", "does laundry", "did laundry", "doing laundry"),
+    ("wash dishes", "washes dishes", "washed dishes", "washing dishes"),
+    ("watch TV", "watches TV", "watched TV", "watching TV"),
+    ("surf the internet", "surfs the internet", "surfed the internet", "surfing the internet"),
+    ("talk with friends", "talks with friends", "talked with friends", "talking with friends"),
+    ("exercise", "exercises", "exercised", "exercising"),
+    ("attend a meeting", "attends a meeting", "attended a meeting", "attending a meeting"),
+    ("go to class", "goes to class", "went to class", "going to class"),
+    ("be at home", "is at home", "was at home", "being at home"),
+    ("be at work", "is at work", "was at work", "being at work"),
+]
+FAMILY_RELATIONS = ["before", "after", "while"]
+FAMILY_CONNECTORS = ["and", "or"]
+# 助动词 do / does / did + 主语 紧接在活动槽之前（"Does the user <A1>"），此时动词只能用原形
+DO_SUPPORT = re.compile(r"\b(?:do|does|did)\s+(?:the\s+)?\w+\s*$", re.IGNORECASE)
+
+
+def inflect(activity: Sequence[str], spec: Sequence[Any], do_support: bool = False) -> str:
+    """
+    按 question_family 的 [时态, 人称, 单复数] 取活动短语的对应形式。
+    do_support=True（槽前是 does the user 之类）时一律用原形，避免 "Does the user sleeps?"。
+    """
+    if do_support:
+        return activity[0]
+    tense, person, number = spec
+    if tense == "past":
+        return activity[2]
+    if tense == "participle":
+        return activity[3]
+    return activity[1] if person == 3 and number == "singular" else activity[0]
+
+
+def _unique(values: Iterable[str]) -> List[str]:
+    return list(dict.fromkeys(values))
+
+
+class CompiledTemplate:
+    """
+    预编译的模板：字面文本片段 literals（比槽多一个）+ 每个槽的候选值列表。
+    组合空间大小为各槽候选数之积，组合下标 index ∈ [0, size) 按混合进制解码为每个槽的取值，
+    因此不同下标一定渲染出不同的 query（候选值在编译时已去重）。
+    """
+
+    __slots__ = ("template", "query_type", "literals", "slots", "values", "size", "missing")
+
+    def __init__(self, template: str, query_type: str, literals: List[str], slots: List[str],
+                 values: List[List[str]], missing: Optional[List[str]] = None):
+        self.template = template
+        self.query_type = query_type
+        self.literals = literals
+        self.slots = slots
+        self.values = values
+        # 没有候选值、按字面保留的 <tag>；非空时渲染结果里会带着原始 tag，QueryExpander 不会采样这类模板
+        self.missing = missing or []
+        self.size = 1
+        for v in values:
+            self.size *= len(v)
+
+    def render(self, index: int) -> str:
+        parts = [self.literals[0]]
+        for values, literal in zip(self.values, self.literals[1:]):
+            index, k = divmod(index, len(values))
+            parts.append(values[k])
+            parts.append(literal)
+        return "".join(parts)
+
+    def __repr__(self) -> str:
+        return f"CompiledTemplate({self.template!r}, size={self.size})"
+
+
+def compile_template(template: str, query_type: str, slot_values: Dict[str, List[str]]) -> CompiledTemplate:
+    """
+    把模板切成字面文本与槽；每次出现的槽独立取值（与 render_query 的逐个替换一致）。
+    slot_values 中没有的槽（例如 query_meta 里未定义的 <category>）按字面文本保留，并记入 missing。
+    """
+    literals, slots, values, missing = [], [], [], []
+    pos, literal = 0, ""
+    for m in SLOT_PATTERN.finditer(template):
+        literal += template[pos:m.start()]
+        pos = m.end()
+        if m.group() in slot_values and slot_values[m.group()]:
+            literals.append(literal)
+            slots.append(m.group())
+            values.append(slot_values[m.group()])
+            literal = ""
+        else:
+            literal += m.group()
+            if m.group().startswith("<"):
+                missing.append(m.group())
+    literals.append(literal + template[pos:])
+    return CompiledTemplate(template, query_type, literals, slots, values, _unique(missing))
+
+
+def compile_family_text(text: str, specs: Sequence[Sequence[Any]], query_type: str,
+                        activities: Sequence[Sequence[str]] = FAMILY_ACTIVITIES,
+                        relations: Sequence[str] = FAMILY_RELATIONS,
+                        connectors: Sequence[str] = FAMILY_CONNECTORS) -> CompiledTemplate:
+    """
+    question_family 的一条句式：<Ak> 按第 k 个时态/人称规格变形，[Rk] 取关系词，[Ck] 取连接词。
+    个别句式的规格比 <A> 槽少一个，缺少的沿用最后一个规格；槽前是 do / does / did + 主语时用原形。
+    """
+    slot_values: Dict[str, List[str]] = {}
+    for slot in set(SLOT_PATTERN.findall(text)):
+        name, k = slot[1], int(slot[2:-1]) if slot[2:-1].isdigit() else 0
+        if slot.startswith("<") and name == "A" and k >= 1 and specs:
+            do_support = bool(DO_SUPPORT.search(text[:text.index(slot)]))
+            # "Does the user be at home" 不成立：助动词之后不用 be 开头的活动
+            candidates = [a for a in activities if not (do_support and a[0].startswith("be "))]
+            slot_values[slot] = _unique(inflect(a, specs[min(k, len(specs)) - 1], do_support) for a in candidates)
+        elif name == "R":
+            slot_values[slot] = list(relations)
+        elif name == "C":
+            slot_values[slot] = list(connectors)
+    return compile_template(text, query_type, slot_values)
+
+
+def sample_indices(n: int, rng: random.Random, k: Optional[int] = None) -> Iterator[int]:
+    """
+    从 [0, n) 中不放回均匀抽取下标的生成器（k 为预计需要的数量，None 表示可能取完）。
+    k 接近 n 时生成随机排列，否则拒绝采样（只记录已抽到的下标，内存与 k 成正比，n 可以远大于内存）。
+    """
+    if n <= 0:
+        return
+    if n <= DENSE_LIMIT and (k is None or 2 * k >= n):
+        yield from rng.sample(range(n), n)
+        return
+    used: Set[int] = set()
+    while len(used) < n:
+        i = rng.randrange(n)
+        if i not in used:
+            used.add(i)
+            yield i
+
+
+class QueryExpander:
+    """
+    query_meta（{questions: [{type, templates, templates_backup}], tags: [{tag, examples}]}）与
+    question_family（{questions: [{index, texts: [[句式, 规格...], ...]}]}）的组合展开引擎。
+    所有模板在构造时编译一次；采样在全部模板的组合空间（各模板空间首尾相接）上不放回均匀进行，
+    渲染结果按字符串去重，可以快速生成大量互不重复的 query，不会把同一条 query 重复送去 LLM 改写。
+
+    Examples
+    --------
+    >>> expander = QueryExpander.from_files("dataset/query_meta_v2.json", "dataset/ref/question_family.json")
+    >>> expander.combination_counts()[:2]
+    >>> queries = list(expander.sample(100000, seed=0))
+    """
+
+    def __init__(self, query_meta: Optional[Dict[str, Any]] = None,
+                 question_family: Optional[Dict[str, Any]] = None, include_backup: bool = False,
+                 activities: Sequence[Sequence[str]] = FAMILY_ACTIVITIES):
+        self.tag_values: Dict[str, List[str]] = {}
+        self.templates: List[CompiledTemplate] = []
+        # 含 query_meta 中未定义的 tag 的模板：不参与采样
+        self.skipped: List[CompiledTemplate] = []
+        self._by_text: Dict[Tuple[str, str], CompiledTemplate] = {}
+        if query_meta:
+            self.tag_values = {t["tag"]: _unique(t["examples"]) for t in query_meta.get("tags", [])}
+            for q in query_meta.get("questions", []):
+                texts = q.get("templates", []) + (q.get("templates_backup", []) if include_backup else [])
+                for text in _unique(texts):
+                    self._add(compile_template(text, q["type"], self.tag_values))
+        if question_family:
+            for q in question_family.get("questions", []):
+                for text, *specs in q.get("texts", []):
+                    self._add(compile_family_text(text, specs, f"family_{q['index']}", activities))
+        if self.skipped:
+            missing = _unique(tag for t in self.skipped for tag in t.missing)
+            print(f"[query_expansion] skipped {len(self.skipped)} templates with tags not defined in query_meta: "
+                  f"{', '.join(missing)}")
+        self._reindex()
+
+    @classmethod
+    def from_files(cls, query_meta_path: Optional[str] = "dataset/query_meta_v2.json",
+                   question_family_path: Optional[str] = "dataset/ref/question_family.json",
+                   **kwargs) -> "QueryExpander":
+        return cls(load_json(query_meta_path) if query_meta_path else None,
+                   load_json(question_family_path) if question_family_path else None, **kwargs)
+
+    def _reindex(self):
+        """各模板组合空间在全局下标中的起点。"""
+        self._offsets, self.total = [], 0
+        for t in self.templates:
+            self._offsets.append(self.total)
+            self.total += t.size
+
+    def _add(self, compiled: CompiledTemplate):
+        key = (compiled.query_type, compiled.template)
+        if compiled.missing:
+            if key not in self._by_text:
+                self._by_text[key] = compiled
+                self.skipped.append(compiled)
+            return
+        if key not in self._by_text:
+            self._by_text[key] = compiled
+            self.templates.append(compiled)
+
+    def compiled(self, template: str, query_type: str = "") -> CompiledTemplate:
+        """取已编译的模板；不在 query_meta 中的模板按 tag_values 即时编译并缓存。"""
+        key = (query_type, template)
+        if key not in self._by_text:
+            found = next((t for t in self.templates if t.template == template), None)
+            self._by_text[key] = found or compile_template(template, query_type, self.tag_values)
+        return self._by_text[key]
+
+    def combination_counts(self) -> List[Dict[str, Any]]:
+        """每个模板的槽列表与组合数。"""
+        return [{"query_type": t.query_type, "template": t.template, "slots": t.slots,
+                 "combinations": t.size} for t in self.templates]
+
+    def counts_by_type(self) -> Dict[str, int]:
+        out: Dict[str, int] = {}
+        for t in self.templates:
+            out[t.query_type] = out.get(t.query_type, 0) + t.size
+        return out
+
+    def render(self, index: int) -> Tuple[CompiledTemplate, str]:
+        """全局组合下标 -> (模板, 渲染后的 query)。"""
+        i = bisect.bisect_right(self._offsets, index) - 1
+        t = self.templates[i]
+        return t, t.render(index - self._offsets[i])
+
+    def sample_template(self, template: str, k: int, rng: random.Random, query_type: str = "",
+                        exclude: Optional[Set[str]] = None) -> List[str]:
+        """
+        在单个模板的组合空间中不放回抽取至多 k 条互不相同的 query（空间不足 k 时全部返回）。
+        模板含未定义的 tag 时给出警告并返回空列表，不会把带原始 <tag> 的 query 交给下游。
+        """
+        compiled = self.compiled(template, query_type)
+        if compiled.missing:
+            print(f"[query_expansion] skip template with undefined tags {compiled.missing}: {template}")
+            return []
+        out = []
+        for index in sample_indices(compiled.size, rng, k):
+            query = compiled.render(index)
+            if exclude is not None:
+                if query in exclude:
+                    continue
+                exclude.add(query)
+            out.append(query)
+            if len(out) >= k:
+                break
+        return out
+
+    def sample(self, k: Optional[int] = None, seed: int = 0, query_types: Optional[Sequence[str]] = None,
+               exclude: Optional[Set[str]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        在全部模板（或 query_types 指定类型的模板）的组合空间上不放回均匀采样，逐条产出
+        {"query_type", "query_template", "query"}；k=None 时遍历整个空间。
+        exclude 为已生成过的 query 集合（例如之前的 query.jsonl），命中的会被跳过，产出的 query 也会加入其中。
+        """
+        expander = self if query_types is None else self.subset(query_types)
+        seen = exclude if exclude is not None else set()
+        rng = random.Random(seed)
+        n = 0
+        for index in sample_indices(expander.total, rng, k):
+            template, query = expander.render(index)
+            if query in seen:
+                continue
+            seen.add(query)
+            yield {"query_type": template.query_type, "query_template": template.template, "query": query}
+            n += 1
+            if k is not None and n >= k:
+                break
+
+    def subset(self, query_types: Sequence[str]) -> "QueryExpander":
+        sub = QueryExpander()
+        sub.tag_values = self.tag_values
+        for t in self.templates:
+            if t.query_type in query_types:
+                sub._add(t)
+        sub._reindex()
+        return sub
+
+
+def print_combination_counts(expander: QueryExpander, top: int = 10):
+    print(f"\n=== Template Combination Space ({len(expander.templates)} templates, total {expander.total:,}) ===")
+    for query_type, n in expander.counts_by_type().items():
+        print(f"{query_type:12s}: {n:,}")
+    print("--- largest templates ---")
+    for row in sorted(expander.combination_counts(), key=lambda r: -r["combinations"])[:top]:
+        print(f"{row['combinations']:>14,}  [{row['query_type']}] {row['template']}")
+    print("==========================================\n")
+
+
+if __name__ == "__main__":
+    expander = QueryExpander.from_files(include_backup=True)
+    print_combination_counts(expander)
+    t0 = time.perf_counter()
+    n = write_jsonl(expander.sample(1_000_000, seed=0), "output/query_expansion/queries.jsonl.zst")
+    print(f"Sampled {n:,} unique queries in {time.perf_counter() - t0:.1f}s")
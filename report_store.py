@@ -0,0 +1,218 @@
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from utils import read_jsonl
+
+# 顶层文本字段（test_report_*.jsonl / results_generate_workflow.jsonl 中出现的字段）
+TEXT_FIELDS = ["prompt_hash", "prompt", "query", "query_type", "query_template", "response_workflow", "response"]
+DICT_LIST = pa.list_(pa.dictionary(pa.int32(), pa.string()))
+
+REPORT_SCHEMA = pa.schema([
+    ("query_id", pa.int64()),
+    *[(f, pa.string()) for f in TEXT_FIELDS],
+    # report 展平后的列
+    ("report_present", pa.bool_()),      # report 是否为 dict（缺失或 {} 也算，与 evaluate_from_reports 一致）
+    ("report_empty", pa.bool_()),        # report 为 {}（生成/抽取失败）
+    ("validity", pa.bool_()),
+    ("tool_sequence", DICT_LIST),
+    ("tool_sequence_len", pa.int32()),
+    ("functions", pa.list_(pa.string())),
+    ("vars_all", pa.list_(pa.string())),
+    ("vars_invalid", pa.list_(pa.string())),
+    ("n_vars_all", pa.int32()),
+    ("n_vars_invalid", pa.int32()),
+    ("n_errors", pa.int32()),
+    ("n_syntax_errors", pa.int32()),
+    ("n_name_errors", pa.int32()),
+    ("error_types", DICT_LIST),
+    ("errors_json", pa.string()),        # 原始 errors 列表，保证可无损还原
+    ("extra_json", pa.string()),         # 其余未知顶层字段
+])
+IPC_SUFFIXES = (".arrow", ".feather", ".ipc")
+
+
+def _as_list(v: Any) -> List[Any]:
+    return v if isinstance(v, list) else []
+
+
+def flatten_record(rec: Dict[str, Any]) -> Dict[str, Any]:
+    """把一条含嵌套 report 的记录展平为 REPORT_SCHEMA 的一行。"""
+    report = rec.get("report", {})
+    present = isinstance(report, dict)
+    empty = present and not report
+    report = report if present else {}
+    variables = report.get("variables", {}) if isinstance(report.get("variables"), dict) else {}
+    errors = _as_list(report.get("errors", []))
+    error_types = [str(e.get("type", "Error")) if isinstance(e, dict) else "Error" for e in errors]
+    tools = [str(t) for t in _as_list(report.get("tool_sequence", []))]
+
+    known = {"query_id", "report", *TEXT_FIELDS}
+    extra = {k: v for k, v in rec.items() if k not in known}
+    query_id = rec.get("query_id")
+    return {
+        "query_id": int(query_id) if isinstance(query_id, (int, str)) and str(query_id).lstrip("-").isdigit() else None,
+        **{f: (None if rec.get(f) is None else str(rec.get(f))) for f in TEXT_FIELDS},
+        "report_present": present,
+        "report_empty": empty,
+        "validity": bool(report.get("validity", False)),
+        "tool_sequence": tools,
+        "tool_sequence_len": len(tools),
+        "functions": [str(x) for x in _as_list(report.get("functions", []))],
+        "vars_all": [str(x) for x in _as_list(variables.get("all", []))],
+        "vars_invalid": [str(x) for x in _as_list(variables.get("invalid", []))],
+        "n_vars_all": len(_as_list(variables.get("all", []))),
+        "n_vars_invalid": len(_as_list(variables.get("invalid", []))),
+        "n_errors": len(errors),
+        "n_syntax_errors": error_types.count("SyntaxError"),
+        "n_name_errors": error_types.count("NameError"),
+        "error_types": error_types,
+        "errors_json": json.dumps(errors, ensure_ascii=False) if present and not empty else None,
+        "extra_json": json.dumps(extra, ensure_ascii=False) if extra else None,
+    }
+
+
+def records_to_table(records: Iterable[Dict[str, Any]]) -> pa.Table:
+    """记录列表 -> pa.Table（列式，tool_sequence / error_types 为 list<dictionary>）。"""
+    rows = [flatten_record(r) for r in records]
+    columns = {}
+    for field in REPORT_SCHEMA:
+        values = [row[field.name] for row in rows]
+        if field.type == DICT_LIST:
+            columns[field.name] = pa.array(values, type=pa.list_(pa.string())).cast(DICT_LIST)
+        else:
+            columns[field.name] = pa.array(values, type=field.type)
+    return pa.table(columns, schema=REPORT_SCHEMA)
+
+
+def write_report_store(records: Iterable[Dict[str, Any]], path: str, row_group_size: int = 64 * 1024) -> str:
+    """
+    把 report 记录写为列式文件。
+    - .parquet：zstd 压缩，按 row_group_size 分组，适合归档
+    - .arrow / .feather / .ipc：未压缩的 Arrow IPC 文件，读取时可零拷贝 mmap
+    若路径不存在，会自动创建目录。
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    table = records_to_table(records)
+    if path.endswith(IPC_SUFFIXES):
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=row_group_size)
+    else:
+        pq.write_table(table, path, compression="zstd", row_group_size=row_group_size)
+    return path
+
+
+def read_report_table(path: str, columns: Optional[List[str]] = None) -> pa.Table:
+    """
+    读取列式 report 文件，只加载 columns 中的列（projection pushdown），文件以 mmap 方式打开。
+    旧文件中不存在的列会被忽略。
+    """
+    if path.endswith(IPC_SUFFIXES):
+        reader = pa.ipc.open_file(pa.memory_map(path, "r"))
+        table = reader.read_all()
+        return table.select([c for c in columns if c in table.schema.names]) if columns else table
+    if columns:
+        names = pq.read_schema(path, memory_map=True).names
+        columns = [c for c in columns if c in names]
+    return pq.read_table(path, columns=columns, memory_map=True)
+
+
+def table_to_records(table: pa.Table) -> List[Dict[str, Any]]:
+    """
+    把（可能只含部分列的）列式表还原为原来的嵌套记录，
+    即 {'prompt': ..., 'report': {'validity', 'functions', 'tool_sequence', 'variables', 'errors'}}。
+    """
+    names = set(table.column_names)
+    cols = {n: table.column(n).to_pylist() for n in names}
+    records = []
+    for i in range(table.num_rows):
+        rec: Dict[str, Any] = {}
+        if cols.get("extra_json") and cols["extra_json"][i]:
+            rec.update(json.loads(cols["extra_json"][i]))
+        if "query_id" in names and cols["query_id"][i] is not None:
+            rec["query_id"] = cols["query_id"][i]
+        for f in TEXT_FIELDS:
+            if f in names and cols[f][i] is not None:
+                rec[f] = cols[f][i]
+
+        report_cols = names & {"validity", "functions", "tool_sequence", "vars_all", "vars_invalid", "errors_json"}
+        if report_cols:
+            if "report_present" in names and not cols["report_present"][i]:
+                rec["report"] = None
+            elif "report_empty" in names and cols["report_empty"][i]:
+                rec["report"] = {}
+            else:
+                report: Dict[str, Any] = {}
+                if "validity" in names:
+                    report["validity"] = cols["validity"][i]
+                if "functions" in names:
+                    report["functions"] = cols["functions"][i] or []
+                if "tool_sequence" in names:
+                    report["tool_sequence"] = cols["tool_sequence"][i] or []
+                if "vars_all" in names or "vars_invalid" in names:
+                    report["variables"] = {"all": (cols["vars_all"][i] if "vars_all" in names else None) or [],
+                                           "invalid": (cols["vars_invalid"][i] if "vars_invalid" in names else None) or []}
+                if "errors_json" in names:
+                    report["errors"] = json.loads(cols["errors_json"][i]) if cols["errors_json"][i] else []
+                rec["report"] = report
+        records.append(rec)
+    return records
+
+
+def read_report_store(path: str, columns: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """读取列式 report 文件并还原为嵌套记录列表。"""
+    return table_to_records(read_report_table(path, columns))
+
+
+def load_reports(path: str, columns: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """
+    按扩展名读取 report 记录：.jsonl 用 read_jsonl，列式文件用 read_report_store。
+    供 statistic / analyze_reports 等分析脚本统一调用。
+    """
+    if path.endswith(".jsonl"):
+        return read_jsonl(path)
+    return read_report_store(path, columns)
+
+
+def convert_jsonl_to_store(jsonl_path: str, out_path: Optional[str] = None) -> str:
+    """把已有的 JSONL（test_report_*.jsonl / results_generate_workflow.jsonl）转换为列式文件。"""
+    out_path = out_path or os.path.splitext(jsonl_path)[0] + ".parquet"
+    return write_report_store(read_jsonl(jsonl_path), out_path)
+
+
+SUMMARY_COLUMNS = ["report_present", "validity", "tool_sequence_len", "n_vars_all", "n_vars_invalid", "n_errors"]
+
+
+def summarize_report_table(table: pa.Table) -> Dict[str, Any]:
+    """
+    直接在列上计算 evaluate_from_reports 的汇总指标（不含 error_summary），
+    只需要 SUMMARY_COLUMNS 中的六列。
+    """
+    total = table.num_rows
+    if total == 0:
+        return {"count": 0, "message": "Empty data"}
+
+    def _sum(name: str) -> int:
+        return int(pc.sum(table.column(name)).as_py() or 0)
+
+    valid_count = int(pc.sum(pc.cast(table.column("validity"), pa.int32())).as_py() or 0)
+    error_report_count = int(pc.sum(pc.cast(pc.greater(table.column("n_errors"), 0), pa.int32())).as_py() or 0)
+    # evaluate_from_reports 中：report 为 dict（含 {}）即计入各平均值的分母
+    n_dict = int(pc.sum(pc.cast(table.column("report_present"), pa.int32())).as_py() or 0)
+    vars_all_sum = _sum("n_vars_all")
+    return {
+        "total_reports": total,
+        "valid_reports": valid_count,
+        "valid_ratio": valid_count / total,
+        "error_reports": error_report_count,
+        "error_ratio": error_report_count / total,
+        "avg_tool_sequence_length": _sum("tool_sequence_len") / n_dict if n_dict else 0,
+        "avg_variables_total": vars_all_sum / n_dict if n_dict else 0,
+        "avg_variables_invalid": _sum("n_vars_invalid") / n_dict if n_dict else 0,
+        "avg_invalid_ratio": _sum("n_vars_invalid") / vars_all_sum if vars_all_sum > 0 else 0,
+    }
+
@@ -0,0 +1,195 @@
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+PAD_GT = -1   # GT 侧填充值
+PAD_EST = -2  # EST 侧填充值（与 GT 不同，保证填充位永不匹配）
+
+
+def build_tool_vocab(tool_names: Optional[List[str]], sequences: Sequence[List[Any]] = ()) -> Dict[str, int]:
+    """
+    构建 tool 名 -> int id 的词表。
+    先按 tool_names（例如 extract_tool_names(tools_v1.json)）的顺序编号，
+    再把 sequences 中出现但不在词表里的名字按首次出现顺序追加。
+    """
+    vocab: Dict[str, int] = {}
+    for name in tool_names or []:
+        vocab.setdefault(name, len(vocab))
+    for seq in sequences:
+        for name in seq:
+            vocab.setdefault(str(name), len(vocab))
+    return vocab
+
+
+def encode_sequences(sequences: Sequence[List[Any]], vocab: Dict[str, int], pad: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    把一组 tool_sequence 编码为 (B, L) 的 int32 矩阵（右侧用 pad 填充）以及长度向量。
+    """
+    lengths = np.fromiter((len(s) for s in sequences), dtype=np.int64, count=len(sequences))
+    max_len = int(lengths.max()) if len(lengths) else 0
+    codes = np.full((len(sequences), max_len), pad, dtype=np.int32)
+    flat = np.fromiter((vocab[str(t)] for s in sequences for t in s), dtype=np.int32, count=int(lengths.sum()))
+    if flat.size:
+        rows = np.repeat(np.arange(len(sequences)), lengths)
+        cols = np.arange(flat.size) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        codes[rows, cols] = flat
+    return codes, lengths
+
+
+def _batched_levenshtein_lcs(a: np.ndarray, la: np.ndarray, b: np.ndarray, lb: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    对 B 对序列同时计算 Levenshtein 距离与 LCS 长度。
+    按行推进 DP，每行内部的左向依赖用 minimum/maximum.accumulate 消去，
+    因此 Python 层循环次数只与 a 的最大长度有关，与 pair 数无关。
+    """
+    n, len_a = a.shape
+    len_b = b.shape[1]
+    cols = np.arange(len_b + 1, dtype=np.int64)
+    rows_idx = np.arange(n)
+
+    lev = np.broadcast_to(cols, (n, len_b + 1)).copy()
+    lcs = np.zeros((n, len_b + 1), dtype=np.int64)
+    lev_out = lb.astype(np.int64).copy()   # la == 0 时距离即 lb
+    lcs_out = np.zeros(n, dtype=np.int64)
+
+    for i in range(1, len_a + 1):
+        match = b == a[:, i - 1:i]  # (n, len_b)
+
+        # Levenshtein: tmp[j] = min(上方+1, 左上+cost)，再沿行做前缀最小值处理插入
+        tmp = np.empty_like(lev)
+        tmp[:, 0] = i
+        tmp[:, 1:] = np.minimum(lev[:, 1:] + 1, lev[:, :-1] + (~match))
+        lev = np.minimum.accumulate(tmp - cols, axis=1) + cols
+
+        # LCS: tmp[j] = max(上方, 左上+match)，行内单调不减，前缀最大值即为结果
+        tmp = np.empty_like(lcs)
+        tmp[:, 0] = 0
+        tmp[:, 1:] = np.maximum(lcs[:, 1:], lcs[:, :-1] + match)
+        lcs = np.maximum.accumulate(tmp, axis=1)
+
+        done = la == i
+        if done.any():
+            lev_out[done] = lev[rows_idx[done], lb[done]]
+            lcs_out[done] = lcs[rows_idx[done], lb[done]]
+    return lev_out, lcs_out
+
+
+def _keyed_overlap(n: int, pair_g: np.ndarray, key_g: np.ndarray, pair_e: np.ndarray, key_e: np.ndarray,
+                   multiset: bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    以 (pair, key) 为单位统计两侧的元素个数及交集大小。
+    multiset=True 时交集按 min(count) 截断（用于 n-gram），否则按集合去重（用于 set precision/recall）。
+    返回 (gt_size, est_size, overlap)，均为长度 n 的向量。
+    """
+    width = int(max(key_g.max(initial=0), key_e.max(initial=0))) + 1
+    uk_g, cnt_g = np.unique(pair_g.astype(np.int64) * width + key_g, return_counts=True)
+    uk_e, cnt_e = np.unique(pair_e.astype(np.int64) * width + key_e, return_counts=True)
+    if not multiset:
+        cnt_g = np.ones_like(cnt_g)
+        cnt_e = np.ones_like(cnt_e)
+    common, ig, ie = np.intersect1d(uk_g, uk_e, assume_unique=True, return_indices=True)
+    g_size = np.bincount(uk_g // width, weights=cnt_g, minlength=n)
+    e_size = np.bincount(uk_e // width, weights=cnt_e, minlength=n)
+    overlap = np.bincount(common // width, weights=np.minimum(cnt_g[ig], cnt_e[ie]), minlength=n)
+    return g_size, e_size, overlap
+
+
+def _ngrams(codes: np.ndarray, lengths: np.ndarray, n: int, base: int) -> Tuple[np.ndarray, np.ndarray]:
+    """返回每条序列中所有 n-gram 的 (pair_index, gram_id)，gram_id 以词表大小 base 做进制编码。"""
+    if codes.shape[1] < n:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    codes = np.where(codes < 0, 0, codes).astype(np.int64)
+    gram = np.zeros((codes.shape[0], codes.shape[1] - n + 1), dtype=np.int64)
+    for k in range(n):
+        gram = gram * base + codes[:, k:codes.shape[1] - n + 1 + k]
+    valid = np.arange(gram.shape[1]) < (lengths[:, None] - n + 1)
+    pair = np.nonzero(valid)[0]
+    return pair, gram[valid]
+
+
+def _safe_ratio(num: np.ndarray, den: np.ndarray, both_empty: np.ndarray) -> np.ndarray:
+    """den 为 0 时：两侧皆空记 1.0，否则记 0.0。"""
+    out = np.where(both_empty, 1.0, 0.0)
+    np.divide(num, den, out=out, where=den > 0)
+    return out
+
+
+def sequence_similarity(
+    gt_sequences: Sequence[List[Any]],
+    est_sequences: Sequence[List[Any]],
+    vocab: Optional[Dict[str, int]] = None,
+    ngram_sizes: Tuple[int, ...] = (2,),
+    chunk_size: int = 8192,
+) -> Dict[str, np.ndarray]:
+    """
+    批量计算 GT / EST tool_sequence 之间的相似度指标（逐对，向量化）。
+
+    Parameters
+    ----------
+    gt_sequences, est_sequences : list[list[str]]
+        等长的两组 tool 名序列。
+    vocab : dict, optional
+        tool 名 -> id。为 None 时由两组序列自动构建；未登录的名字会被追加。
+    ngram_sizes : tuple[int]
+        需要计算 n-gram overlap 的 n。
+    chunk_size : int
+        Levenshtein/LCS 的 DP 按长度排序后分块计算，控制填充与内存。
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        gt_len, est_len, exact_match, levenshtein, levenshtein_sim, lcs, lcs_ratio,
+        set_precision, set_recall, set_f1, ngram{n}_overlap。
+    """
+    if len(gt_sequences) != len(est_sequences):
+        raise ValueError(f"gt_sequences ({len(gt_sequences)}) and est_sequences ({len(est_sequences)}) must have the same length.")
+    vocab = build_tool_vocab(list(vocab or {}), list(gt_sequences) + list(est_sequences))
+
+    n = len(gt_sequences)
+    g_codes, g_len = encode_sequences(gt_sequences, vocab, PAD_GT)
+    e_codes, e_len = encode_sequences(est_sequences, vocab, PAD_EST)
+
+    # 1) Levenshtein / LCS：按 max(len) 排序分块，减少填充
+    lev = np.zeros(n, dtype=np.int64)
+    lcs = np.zeros(n, dtype=np.int64)
+    order = np.argsort(np.maximum(g_len, e_len), kind="stable")
+    for start in range(0, n, chunk_size):
+        idx = order[start:start + chunk_size]
+        lg, le = g_len[idx], e_len[idx]
+        a = g_codes[idx, :int(lg.max(initial=0))]
+        b = e_codes[idx, :int(le.max(initial=0))]
+        lev[idx], lcs[idx] = _batched_levenshtein_lcs(a, lg, b, le)
+
+    both_empty = (g_len == 0) & (e_len == 0)
+    max_len = np.maximum(g_len, e_len)
+    metrics: Dict[str, np.ndarray] = {
+        "gt_len": g_len,
+        "est_len": e_len,
+        "exact_match": lev == 0,
+        "levenshtein": lev,
+        "levenshtein_sim": 1.0 - _safe_ratio(lev, max_len, np.zeros(n, dtype=bool)),
+        "lcs": lcs,
+        "lcs_ratio": _safe_ratio(2 * lcs, g_len + e_len, both_empty),
+    }
+
+    # 2) set precision / recall（按 tool 去重）
+    g_valid = np.arange(g_codes.shape[1]) < g_len[:, None]
+    e_valid = np.arange(e_codes.shape[1]) < e_len[:, None]
+    g_size, e_size, inter = _keyed_overlap(n, np.nonzero(g_valid)[0], g_codes[g_valid].astype(np.int64),
+                                           np.nonzero(e_valid)[0], e_codes[e_valid].astype(np.int64),
+                                           multiset=False)
+    precision = _safe_ratio(inter, e_size, both_empty)
+    recall = _safe_ratio(inter, g_size, both_empty)
+    metrics["set_precision"] = precision
+    metrics["set_recall"] = recall
+    metrics["set_f1"] = _safe_ratio(2 * precision * recall, precision + recall, both_empty)
+
+    # 3) n-gram overlap（Dice 系数，按多重集合截断计数）
+    base = max(len(vocab), 1)
+    for k in ngram_sizes:
+        pg, kg = _ngrams(g_codes, g_len, k, base)
+        pe, ke = _ngrams(e_codes, e_len, k, base)
+        gs, es, ov = _keyed_overlap(n, pg, kg, pe, ke, multiset=True)
+        no_grams = (gs == 0) & (es == 0)
+        metrics[f"ngram{k}_overlap"] = _safe_ratio(2 * ov, gs + es, no_grams & (lev == 0))
+    return metrics
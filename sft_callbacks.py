@@ -0,0 +1,106 @@
+import time
+from typing import Any, Dict, Optional
+
+from swift.llm import InferRequest
+from transformers import TrainerCallback
+
+from evaluate import build_es_record, build_gt_record, load_query_types, load_test_examples
+from generate_workflow_from_query import extract_tool_names
+from local_infer import LocalGenerator, compile_extractors
+from program_analyzer import PythonProgramAnalyzer
+from statistic import compare_report_sets, stratified_order
+
+class WorkflowEvalCallback(TrainerCallback):
+    """
+    训练中的低成本 workflow 质量评估。
+    每次 eval 后，在测试集的固定分层子集（按 query_type，stratified_order 的前 num_examples 条）上
+    greedy 生成，程序块一闭合即停止解码；用 PythonProgramAnalyzer + compare_report_sets 打分，
+    把 eval_workflow_valid_ratio / eval_workflow_exact_match_ratio 加入本次 eval 的 metrics
+    （trainer 据此选择 best checkpoint），并写入 TensorBoard 与 trainer_state 的 log_history。
+
+    template 需为推理模式（get_template 默认模式），不能复用 set_mode('train') 的训练模板。
+    """
+
+    def __init__(self, template, agent_prompt_meta: Dict[str, Any], tools_meta: Dict[str, Any], test_dataset,
+                 num_examples: int = 64, batch_size: int = 8, max_new_tokens: int = 512,
+                 type_source=None, seed: int = 42, log_dir: Optional[str] = None):
+        self.template = template
+        self.batch_size = batch_size
+        self.max_new_tokens = max_new_tokens
+        self.log_dir = log_dir
+        self.tool_names = extract_tool_names(tools_meta)
+        self.analyzer = PythonProgramAnalyzer(self.tool_names)
+        regex_extractors = agent_prompt_meta["target_output"]["regex_extractors"]
+        self.response_target_pattern = regex_extractors["prog_block"]["pattern"]
+        self.stop_patterns = compile_extractors(regex_extractors)
+
+        examples = load_test_examples(test_dataset)
+        query_types = load_query_types(test_dataset, examples, type_source)
+        idx = stratified_order(query_types, seed=seed)[:num_examples]
+        self.examples = [(examples[i][0], examples[i][1], query_types[i]) for i in idx]
+        # GT 只需分析一次
+        self.gt_records = []
+        for query, gt, query_type in self.examples:
+            record = build_gt_record(query, gt, self.response_target_pattern, self.analyzer)
+            if record is not None:
+                record["query_type"] = query_type
+                self.gt_records.append(record)
+        self._writer = None
+
+    def _tb_writer(self, args):
+        if self._writer is None:
+            from torch.utils.tensorboard import SummaryWriter
+            self._writer = SummaryWriter(log_dir=self.log_dir or args.logging_dir)
+        return self._writer
+
+    def evaluate_model(self, model) -> Dict[str, float]:
+        """在固定子集上生成并打分，返回 {workflow_valid_ratio, workflow_exact_match_ratio, ...}。"""
+        was_training = model.training
+        model.eval()
+        t0 = time.perf_counter()
+        try:
+            # 每次新建：权重在两次 eval 之间已更新，不能复用旧的前缀 KV
+            generator = LocalGenerator(model, self.template.tokenizer, self.template,
+                                       max_new_tokens=self.max_new_tokens)
+            requests = [InferRequest(messages=[{'role': 'user', 'content': query}]) for query, _, _ in self.examples]
+            # 训练时 config.use_cache 可能被关闭（gradient checkpointing / packing），生成时显式打开
+            responses, stats = generator.infer(requests, prefix_cache=False, batch_size=self.batch_size,
+                                               stop_patterns=self.stop_patterns, use_cache=True)
+        finally:
+            if was_training:
+                model.train()
+        results_es = []
+        for (query, gt, query_type), response in zip(self.examples, responses):
+            record = build_es_record(query, gt, response, self.response_target_pattern, self.analyzer)
+            record["query_type"] = query_type
+            results_es.append(record)
+        summary = compare_report_sets(self.gt_records, results_es, tool_names=self.tool_names,
+                                      join_key="prompt_hash")
+        return {
+            "workflow_valid_ratio": summary["est_summary"]["valid_ratio"],
+            "workflow_exact_match_ratio": summary["comparison"]["exact_match_ratio"],
+            "workflow_lcs_ratio": summary["comparison"]["similarity"]["lcs_ratio"],
+            "workflow_avg_generated_tokens": stats["avg_generated_tokens"],
+            "workflow_eval_seconds": time.perf_counter() - t0,
+        }
+
+    def on_evaluate(self, args, state, control, model=None, metrics=None, **kwargs):
+        if model is None or not self.examples:
+            return
+        results = self.evaluate_model(model)
+        logs = {f"eval_{k}": round(v, 4) for k, v in results.items()}
+        if metrics is not None:
+            # trainer 在 on_evaluate 之后用同一个 metrics 判断 best checkpoint
+            metrics.update(logs)
+        if state.is_world_process_zero:
+            writer = self._tb_writer(args)
+            for k, v in results.items():
+                writer.add_scalar(f"eval/{k}", v, state.global_step)
+            writer.flush()
+            state.log_history.append({**logs, "epoch": state.epoch, "step": state.global_step})
+            print(f"[workflow_eval] step {state.global_step}: " + ", ".join(f"{k}={v}" for k, v in logs.items()))
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
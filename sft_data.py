@@ -0,0 +1,188 @@
+import json
+import os
+import random
+import shutil
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from torch.utils.data import Dataset
+
+from merge_adapter import file_sha256
+from metrics_history import content_hash
+
+# mmb_sft 支持的 batch 组织方式
+BATCHING_MODES = ("pad", "packing", "group_by_length")
+DEFAULT_ENCODE_CACHE = "output/encode_cache"
+ENCODE_INFO = "encode_info.json"
+
+
+def length_grouped_indices(lengths: Sequence[int], batch_size: int, mega_batch_mult: int = 50,
+                           seed: int = 42) -> List[List[int]]:
+    """
+    与 transformers 的 LengthGroupedSampler 相同的分组方式：随机打乱后切成 mega batch，
+    mega batch 内按长度降序排列再切成 batch，使同一 batch 内样本长度相近、padding 最少。
+    """
+    indices = list(range(len(lengths)))
+    random.Random(seed).shuffle(indices)
+    mega_size = max(batch_size * mega_batch_mult, batch_size)
+    groups = []
+    for start in range(0, len(indices), mega_size):
+        mega = sorted(indices[start:start + mega_size], key=lambda i: lengths[i], reverse=True)
+        groups += [mega[i:i + batch_size] for i in range(0, len(mega), batch_size)]
+    return groups
+
+
+class LengthGroupedDataset(Dataset):
+    """
+    每个元素是一组长度相近的样本（即一个 batch），用法与 swift 的 PackingDataset 相同：
+    template.packing=True 时 data_collator 会把列表展开，再按组内最长样本 padding。
+    swift 的 DataLoaderMixin 不读取 group_by_length，因此在数据集层面分组；
+    组的顺序仍由 trainer 每个 epoch 重新打乱。
+    """
+
+    def __init__(self, template, dataset, batch_size: int = 4, mega_batch_mult: int = 50, seed: int = 42):
+        template.packing = True
+        self.template = template
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.lengths = list(dataset["length"])
+        self.groups = length_grouped_indices(self.lengths, batch_size, mega_batch_mult, seed)
+
+    def __getitem__(self, index: int) -> List[Dict[str, Any]]:
+        return [self.dataset[i] for i in self.groups[index]]
+
+    def __len__(self) -> int:
+        return len(self.groups)
+
+
+def batch_padding_stats(lengths: Sequence[int], groups: Sequence[Sequence[int]], capacity: int = 0) -> Dict[str, Any]:
+    """
+    给定每条样本长度与分组（batch 或 pack），统计真实 token 数与补齐后的 token 数。
+    capacity > 0 时每组按 capacity 计（packing 固定长度），否则按组内最长样本 × 组大小计。
+    """
+    real = padded = 0
+    for group in groups:
+        group_lengths = [lengths[i] for i in group]
+        real += sum(group_lengths)
+        padded += capacity if capacity > 0 else max(group_lengths, default=0) * len(group_lengths)
+    return {
+        "groups": len(groups),
+        "samples": sum(len(g) for g in groups),
+        "samples_per_group": sum(len(g) for g in groups) / len(groups) if groups else 0.0,
+        "real_tokens": real,
+        "padded_tokens": padded,
+        "padding_ratio": 1 - real / padded if padded else 0.0,
+    }
+
+
+def gradient_accumulation_for(samples_per_step: int, samples_per_batch: float) -> int:
+    """换成 packing / 分组后，保持每次 optimizer step 覆盖的样本数与原配置（batch 1 × 累积 16）大致相同。"""
+    return max(1, round(samples_per_step / max(samples_per_batch, 1e-6)))
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """词表 + special tokens + chat_template 的 hash；同名但词表不同（或改过模板）的 tokenizer 不会共用缓存。"""
+    return content_hash({
+        "vocab": tokenizer.get_vocab(),
+        "special_tokens": tokenizer.all_special_tokens,
+        "chat_template": getattr(tokenizer, "chat_template", None),
+    }, 16)
+
+
+def encode_cache_key(dataset_files: Sequence[str], template_name: str, tokenizer, max_length: int,
+                     **extra: Any) -> Optional[str]:
+    """
+    编码缓存的 key：数据文件内容 hash + template 名 + tokenizer 指纹 + max_length（+ extra，如切分比例与 seed）。
+    dataset_files 中有非本地文件（例如 hub 数据集名）时返回 None，表示不缓存。
+    """
+    if not all(os.path.isfile(p) for p in dataset_files):
+        return None
+    import swift
+    return content_hash({
+        "files": [file_sha256(p) for p in dataset_files],
+        "template": template_name,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "max_length": max_length,
+        "swift": swift.__version__,
+        **extra,
+    }, 16)
+
+
+def dir_size_bytes(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def load_encoded_dataset(
+    dataset_files: Sequence[str],
+    template,
+    template_name: str,
+    max_length: int,
+    split_dataset_ratio: float = 0.01,
+    seed: int = 42,
+    num_proc: Optional[int] = None,
+    cache_dir: Optional[str] = DEFAULT_ENCODE_CACHE,
+    logger=None,
+) -> Tuple[Any, Any, Dict[str, Any]]:
+    """
+    读取并编码 SFT 数据集，返回 (train_dataset, val_dataset, info)。
+    编码结果以 Arrow 格式缓存在 <cache_dir>/<key>，命中时直接 load_from_disk（mmap，不再读原始 jsonl、不再 tokenize）；
+    未命中时用 num_proc 个进程（默认全部 CPU 核）编码，先写临时目录再改名，中断不会留下半成品。
+    cache_dir=None 时不使用缓存。
+    """
+    from datasets import DatasetDict, load_from_disk
+    from swift.llm import EncodePreprocessor, load_dataset
+
+    log = logger.info if logger is not None else print
+    num_proc = num_proc or os.cpu_count() or 1
+    key = encode_cache_key(dataset_files, template_name, template.tokenizer, max_length, mode=template.mode,
+                           split_dataset_ratio=split_dataset_ratio, seed=seed) if cache_dir else None
+    path = os.path.join(cache_dir, key) if key else None
+
+    if path and os.path.isfile(os.path.join(path, ENCODE_INFO)):
+        t0 = time.perf_counter()
+        encoded = load_from_disk(path)
+        with open(os.path.join(path, ENCODE_INFO), "r", encoding="utf-8") as f:
+            info = json.load(f)
+        info.update({"cache": "hit", "path": path, "load_seconds": time.perf_counter() - t0})
+        log(f"[encode_cache] hit {path} ({info['size_mb']:.1f} MB, train={info['train_rows']}, "
+            f"val={info['val_rows']}, {info['load_seconds']:.2f}s)")
+        return encoded["train"], encoded["val"] if "val" in encoded else None, info
+
+    t0 = time.perf_counter()
+    train_dataset, val_dataset = load_dataset(list(dataset_files), split_dataset_ratio=split_dataset_ratio,
+                                              num_proc=num_proc, seed=seed)
+    train_dataset = EncodePreprocessor(template=template)(train_dataset, num_proc=num_proc)
+    if val_dataset is not None:
+        val_dataset = EncodePreprocessor(template=template)(val_dataset, num_proc=num_proc)
+    info: Dict[str, Any] = {
+        "cache": "miss" if path else "disabled",
+        "key": key,
+        "dataset_files": [os.path.abspath(p) if os.path.isfile(p) else p for p in dataset_files],
+        "template": template_name,
+        "max_length": max_length,
+        "num_proc": num_proc,
+        "train_rows": len(train_dataset),
+        "val_rows": len(val_dataset) if val_dataset is not None else 0,
+        "encode_seconds": time.perf_counter() - t0,
+        "created_at": time.time(),
+    }
+    if not path:
+        log(f"[encode_cache] disabled, encoded in {info['encode_seconds']:.1f}s with num_proc={num_proc}")
+        return train_dataset, val_dataset, info
+
+    tmp_dir = path + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    splits = {"train": train_dataset, **({"val": val_dataset} if val_dataset is not None else {})}
+    DatasetDict(splits).save_to_disk(tmp_dir)
+    info["size_mb"] = dir_size_bytes(tmp_dir) / 2 ** 20
+    with open(os.path.join(tmp_dir, ENCODE_INFO), "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_dir, path)
+    log(f"[encode_cache] miss, encoded in {info['encode_seconds']:.1f}s with num_proc={num_proc} -> "
+        f"{path} ({info['size_mb']:.1f} MB)")
+
+    # 返回 mmap 版本，与命中缓存时的行为一致，也释放编码时留在内存里的表
+    encoded = load_from_disk(path)
+    info["path"] = path
+    return encoded["train"], encoded["val"] if "val" in encoded else None, info
@@ -1,13 +1,144 @@
-from collections import Counter, defaultdict
-from typing import List, Dict, Any
+import base64
+import os
+import random
+import re
+from array import array
+from collections import Counter, defaultdict, deque
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+
+import numpy as np
+
+from metrics_history import MetricsHistory
+from report_store import load_reports, read_report_table, summarize_report_table, SUMMARY_COLUMNS
+from sequence_metrics import build_tool_vocab, sequence_similarity
+from utils import iter_jsonl, load_json, extract_tool_names, prompt_hash
+
+
+ERROR_TEMPLATE_PATTERNS = [
+    (re.compile(r"'[^']*'"), "'<name>'"),          # Variable 'foo' used before ... -> Variable '<name>' ...
+    (re.compile(r"\bline \d+"), "line <n>"),         # SyntaxError: ... (<unknown>, line 3)
+]
+POSITION_COLUMNS = ("report_index", "lineno", "col_offset")
+
+
+def _normalize_error_key(err_item: Any) -> str:
+    """归一化错误项为字符串 key"""
+    if isinstance(err_item, dict):
+        etype = str(err_item.get("type", "Error"))
+        emsg = str(err_item.get("message", "")) if err_item.get("message") is not None else ""
+        return f"{etype}: {emsg}" if emsg else etype
+    elif isinstance(err_item, str):
+        return f"Error: {err_item}"
+    else:
+        return f"Error: {repr(err_item)}"
+
+
+def template_error_key(key: str) -> str:
+    """把只在变量名/行号上不同的错误信息归并为同一个模板 key。"""
+    for pattern, repl in ERROR_TEMPLATE_PATTERNS:
+        key = pattern.sub(repl, key)
+    return key
+
+
+def _iter_error_occurrences(data: List[Dict[str, Any]]):
+    """逐个产出 (report_index, error_key, lineno, col_offset)；缺失的行列记为 -1。"""
+    for idx, item in enumerate(data):
+        report = item.get("report", {}) if isinstance(item, dict) else {}
+        errs = report.get("errors", []) if isinstance(report, dict) else []
+        if not isinstance(errs, list):
+            continue
+        for e in errs:
+            lineno = col = None
+            if isinstance(e, dict):
+                lineno, col = e.get("lineno"), e.get("col_offset")
+            yield idx, _normalize_error_key(e), -1 if lineno is None else int(lineno), -1 if col is None else int(col)
+
+
+def pack_int_column(values) -> str:
+    """int 序列 -> little-endian int32 的 base64 字符串（summary.json 中的列式位置存储）。"""
+    return base64.b64encode(np.asarray(values, dtype="<i4").tobytes()).decode("ascii")
 
-from utils import read_jsonl
 
+def unpack_int_column(packed: str) -> np.ndarray:
+    """pack_int_column 的逆操作。"""
+    return np.frombuffer(base64.b64decode(packed), dtype="<i4")
 
-def evaluate_from_reports(data: List[Dict[str, Any]], print_info=True) -> Dict[str, Any]:
+
+class _CompactErrorStats:
+    """
+    单个模板 key 的紧凑统计：计数、列式位置数组、原始 key 计数，
+    以及容量为 sample_size 的蓄水池样本（Algorithm R）。
+    """
+
+    def __init__(self, sample_size: int, rng: random.Random):
+        self.count = 0
+        self.columns = {c: array("i") for c in POSITION_COLUMNS}
+        self.raw_keys: Counter = Counter()
+        self.examples: List[Dict[str, Any]] = []
+        self.sample_size = sample_size
+        self.rng = rng
+
+    def add(self, idx: int, raw_key: str, lineno: int, col: int):
+        self.count += 1
+        for c, v in zip(POSITION_COLUMNS, (idx, lineno, col)):
+            self.columns[c].append(v)
+        self.raw_keys[raw_key] += 1
+        example = {"report_index": idx, "lineno": lineno, "col_offset": col, "message": raw_key}
+        if len(self.examples) < self.sample_size:
+            self.examples.append(example)
+        else:
+            j = self.rng.randrange(self.count)
+            if j < self.sample_size:
+                self.examples[j] = example
+
+    def to_dict(self, pack_positions: bool) -> Dict[str, Any]:
+        out = {
+            "count": self.count,
+            "reports": len(set(self.columns["report_index"])),
+            "variants": len(self.raw_keys),
+            "examples": sorted(self.examples, key=lambda x: x["report_index"]),
+        }
+        if pack_positions:
+            out["positions"] = {"encoding": "int32-le-base64",
+                                **{c: pack_int_column(v) for c, v in self.columns.items()}}
+        return out
+
+
+def export_error_positions(data: List[Dict[str, Any]], path: str) -> str:
+    """
+    无损的列式导出：每个错误出现位置一行，保存为 .npz
+    （key_id / template_id / report_index / lineno / col_offset 为 int32 列，keys / templates 为字符串表）。
+    用于需要完整位置信息、但不希望 summary.json 线性膨胀的场景。
+    """
+    key_ids: Dict[str, int] = {}
+    template_ids: Dict[str, int] = {}
+    cols = {c: array("i") for c in ("key_id", "template_id") + POSITION_COLUMNS}
+    for idx, key, lineno, col in _iter_error_occurrences(data):
+        kid = key_ids.setdefault(key, len(key_ids))
+        tid = template_ids.setdefault(template_error_key(key), len(template_ids))
+        for c, v in zip(cols, (kid, tid, idx, lineno, col)):
+            cols[c].append(v)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    np.savez_compressed(
+        path,
+        keys=np.array(list(key_ids), dtype=str),
+        templates=np.array(list(template_ids), dtype=str),
+        **{c: np.asarray(v, dtype=np.int32) for c, v in cols.items()},
+    )
+    return path
+
+
+def evaluate_from_reports(data: List[Dict[str, Any]], print_info=True, compact: bool = False,
+                          sample_size: int = 5, pack_positions: bool = True, seed: int = 0) -> Dict[str, Any]:
     """
     分析一组包含 'report' 字段的 JSON 对象列表，统计各类指标。
     增加了 error_ratio: 含有错误的 report 占比。
+
+    compact=True 时 error_summary 不再为每次出现保存一个 dict，而是：
+    - key 经 template_error_key 模板化（变量名/行号不同的错误归为一类）
+    - 保存 count、涉及的 report 数、列式打包的位置数组（pack_positions）
+    - 每个 key 至多 sample_size 条蓄水池样本
+    需要逐条位置时使用 export_error_positions 导出。
     """
     if not data:
         return {"count": 0, "message": "Empty data"}
@@ -20,17 +151,8 @@ def evaluate_from_reports(data: List[Dict[str, Any]], print_info=True) -> Dict[s
     vars_invalid_counts = []
     error_counter: Counter = Counter()
     error_positions: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
-
-    def _normalize_error_key(err_item: Any) -> str:
-        """归一化错误项为字符串 key"""
-        if isinstance(err_item, dict):
-            etype = str(err_item.get("type", "Error"))
-            emsg = str(err_item.get("message", "")) if err_item.get("message") is not None else ""
-            return f"{etype}: {emsg}" if emsg else etype
-        elif isinstance(err_item, str):
-            return f"Error: {err_item}"
-        else:
-            return f"Error: {repr(err_item)}"
+    rng = random.Random(seed)
+    compact_stats: Dict[str, _CompactErrorStats] = {}
 
     for idx, item in enumerate(data):
         report = item.get("report", {})
@@ -61,6 +183,14 @@ def evaluate_from_reports(data: List[Dict[str, Any]], print_info=True) -> Dict[s
             error_report_count += 1  # 新增统计：有错误的报告
             for e in errs:
                 key = _normalize_error_key(e)
+                if compact:
+                    stats = compact_stats.get(template_error_key(key))
+                    if stats is None:
+                        stats = compact_stats[template_error_key(key)] = _CompactErrorStats(sample_size, rng)
+                    lineno = e.get("lineno") if isinstance(e, dict) else None
+                    col = e.get("col_offset") if isinstance(e, dict) else None
+                    stats.add(idx, key, -1 if lineno is None else int(lineno), -1 if col is None else int(col))
+                    continue
                 error_counter.update([key])
                 pos = {"report_index": idx}
                 if isinstance(e, dict):
@@ -81,10 +211,16 @@ def evaluate_from_reports(data: List[Dict[str, Any]], print_info=True) -> Dict[s
     )
 
     # build detailed error summary
-    error_summary = {
-        key: {"count": count, "positions": error_positions[key]}
-        for key, count in error_counter.items()
-    }
+    if compact:
+        error_summary = {
+            key: stats.to_dict(pack_positions)
+            for key, stats in sorted(compact_stats.items(), key=lambda kv: -kv[1].count)
+        }
+    else:
+        error_summary = {
+            key: {"count": count, "positions": error_positions[key]}
+            for key, count in error_counter.items()
+        }
 
     # build summary
     summary = {
@@ -111,16 +247,155 @@ def evaluate_from_reports(data: List[Dict[str, Any]], print_info=True) -> Dict[s
     return {**summary, "error_summary": error_summary}
 
 
-def compare_report_sets(gt_reports: List[Dict[str, Any]], est_reports: List[Dict[str, Any]]) -> Dict[str, Any]:
+def _error_class(report: Dict[str, Any]) -> str:
+    """把一个 report 归入错误类别：no_report / no_error / 按错误类型去重排序后用 '+' 连接。"""
+    if not report:
+        return "no_report"
+    errs = report.get("errors", [])
+    if not isinstance(errs, list) or not errs:
+        return "no_error"
+    types = {str(e.get("type", "Error")) if isinstance(e, dict) else "Error" for e in errs}
+    return "+".join(sorted(types))
+
+
+def _group_means(labels: List[str], metrics: Dict[str, np.ndarray], keys: List[str]) -> Dict[str, Dict[str, Any]]:
+    """按标签分组，对 keys 中的逐对指标求均值（bincount 实现）。"""
+    groups, inv = np.unique(np.asarray(labels, dtype=object).astype(str), return_inverse=True)
+    counts = np.bincount(inv, minlength=len(groups))
+    out = {}
+    sums = {k: np.bincount(inv, weights=metrics[k].astype(float), minlength=len(groups)) for k in keys}
+    for gi, g in enumerate(groups):
+        out[str(g)] = {"pairs": int(counts[gi])}
+        for k in keys:
+            out[str(g)][k] = float(sums[k][gi] / counts[gi])
+    return out
+
+
+JOIN_KEEP_FIELDS = ("query_id", "query_type", "prompt_hash", "report")
+
+
+def report_join_key(rec: Dict[str, Any], key: str = "prompt_hash") -> Any:
     """
-    对比两组 reports（长度相同、逐条对应）：
+    取一条 report 记录的关联 key。
+    key='prompt_hash' 时优先使用记录里的 prompt_hash 字段，旧文件没有该字段则由 prompt 现算。
+    """
+    if key == "prompt_hash":
+        if rec.get("prompt_hash"):
+            return rec["prompt_hash"]
+        return prompt_hash(rec["prompt"]) if isinstance(rec.get("prompt"), str) else None
+    return rec.get(key)
+
+
+def _join_view(rec: Any) -> Any:
+    """只保留对比需要的字段（丢弃数 KB 的 prompt / response），降低 join 时的内存占用。"""
+    if isinstance(rec, dict) and "report" in rec:
+        return {k: rec[k] for k in JOIN_KEEP_FIELDS if k in rec}
+    return rec
+
+
+def _keyed_view(rec: Any, key: str) -> Any:
+    """_join_view 并补上 join key（旧文件没有 prompt_hash 字段时由 prompt 现算，prompt 本身随后被丢弃）。"""
+    view = _join_view(rec)
+    if view is not rec and key not in view:
+        k = report_join_key(rec, key)
+        if k is not None:
+            view[key] = k
+    return view
+
+
+def hash_join_reports(gt_reports: Iterable[Dict[str, Any]], est_reports: Iterable[Dict[str, Any]],
+                      key: str = "prompt_hash", build_side: Optional[str] = None
+                      ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    按稳定 key（prompt_hash 或 query_id）对 GT / EST 两组记录做 hash join，替代按位置对齐。
+
+    build_side ('gt' / 'est') 一侧整体放入内存构建 key -> [records]，另一侧逐条流式探测；
+    两侧都有 len() 且未指定时自动选较小的一侧。同一 key 多次出现时按出现顺序一一配对。
+    返回 (gt_matched, est_matched, join_info)，join_info 中记录两侧未匹配的 key。
+    """
+    if build_side is None:
+        try:
+            build_side = "gt" if len(gt_reports) <= len(est_reports) else "est"
+        except TypeError:
+            build_side = "gt"
+    build, probe = (gt_reports, est_reports) if build_side == "gt" else (est_reports, gt_reports)
+
+    table: Dict[Any, deque] = defaultdict(deque)
+    build_missing_key = 0
+    for rec in build:
+        k = report_join_key(rec, key)
+        if k is None:
+            build_missing_key += 1
+            continue
+        table[k].append(_join_view(rec))
+
+    build_matched, probe_matched, unmatched_probe = [], [], []
+    probe_missing_key = 0
+    for rec in probe:
+        k = report_join_key(rec, key)
+        if k is None:
+            probe_missing_key += 1
+            continue
+        bucket = table.get(k)
+        if bucket:
+            build_matched.append(bucket.popleft())
+            probe_matched.append(_join_view(rec))
+        else:
+            unmatched_probe.append(k)
+    unmatched_build = [k for k, bucket in table.items() for _ in bucket]
+
+    if build_side == "gt":
+        gt_matched, est_matched = build_matched, probe_matched
+        unmatched_gt, unmatched_est = unmatched_build, unmatched_probe
+        missing_gt, missing_est = build_missing_key, probe_missing_key
+    else:
+        gt_matched, est_matched = probe_matched, build_matched
+        unmatched_gt, unmatched_est = unmatched_probe, unmatched_build
+        missing_gt, missing_est = probe_missing_key, build_missing_key
+
+    join_info = {
+        "key": key,
+        "build_side": build_side,
+        "matched": len(gt_matched),
+        "unmatched_gt": len(unmatched_gt),
+        "unmatched_est": len(unmatched_est),
+        "missing_key_gt": missing_gt,
+        "missing_key_est": missing_est,
+        "unmatched_gt_keys": unmatched_gt,
+        "unmatched_est_keys": unmatched_est,
+    }
+    return gt_matched, est_matched, join_info
+
+
+def compare_report_sets(gt_reports: List[Dict[str, Any]], est_reports: List[Dict[str, Any]],
+                        tool_names: Optional[List[str]] = None, compact_errors: bool = False,
+                        history: Optional[MetricsHistory] = None,
+                        run_meta: Optional[Dict[str, Any]] = None,
+                        join_key: Optional[str] = None, build_side: Optional[str] = None) -> Dict[str, Any]:
+    """
+    对比两组 reports（默认要求长度相同、逐条对应；给出 join_key 时按 key 关联）：
     - 复用 evaluate_from_reports 打印并返回两组 summary
-    - 比较每条 report 的 tool_sequence：
+    - 比较每条 report 的 tool_sequence（见 sequence_metrics.sequence_similarity，批量向量化计算）：
         * 是否完全一致
         * EST 比 GT 多/少了多少个 tool（基于长度差）
+        * Levenshtein 距离、LCS ratio、set precision/recall、n-gram overlap
+    - 按 query_type 与 EST 错误类别分组汇总
     - 打印对比指标，并返回整体与逐条结果
+
+    tool_names 用于 tool 名的整数编码（一般为 extract_tool_names(tools_v1.json)），
+    未给出时由序列自动构建词表。
+    compact_errors 透传给 evaluate_from_reports(compact=...)，大规模运行时使用。
+    给出 history（MetricsHistory）时，把返回的 summary 连同 run_meta（model_id / checkpoint /
+    dataset_file / prompt_version / tools_hash 等）写入指标历史库。
+    join_key（'prompt_hash' / 'query_id'）不为 None 时两侧可为迭代器：先收集每条记录的精简视图，
+    两组 summary 在全部记录上计算（GT 失败的 EST 记录同样计入 valid_ratio，与 per_example_metrics 一致），
+    再用 hash_join_reports 关联，关联上的对只用于逐对比较；未匹配的记录数与 key 写入 comparison['join']。
     """
-    if len(gt_reports) != len(est_reports):
+    join_info = None
+    if join_key is not None:
+        gt_reports = [_keyed_view(r, join_key) for r in gt_reports]
+        est_reports = [_keyed_view(r, join_key) for r in est_reports]
+    elif len(gt_reports) != len(est_reports):
         raise ValueError(f"gt_reports ({len(gt_reports)}) and est_reports ({len(est_reports)}) must have the same length.")
 
     def _normalize_item(item: Any) -> Dict[str, Any]:
@@ -140,61 +415,75 @@ def compare_report_sets(gt_reports: List[Dict[str, Any]], est_reports: List[Dict
     est_norm = [_normalize_item(x) for x in est_reports]
 
     # 1) 打印并获取两个 summary（evaluate_from_reports 内部已负责打印）
-    gt_summary = evaluate_from_reports(gt_norm)
-    est_summary = evaluate_from_reports(est_norm)
-
-    # 2) 逐对比较 tool_sequence
-    per_pair = []
-    exact_match_count = 0
-    extra_sum = 0     # EST 相对 GT 多出来的个数（仅正差计入）
-    missing_sum = 0   # EST 相对 GT 缺少的个数（仅正差计入）
+    gt_summary = evaluate_from_reports(gt_norm, compact=compact_errors)
+    est_summary = evaluate_from_reports(est_norm, compact=compact_errors)
+    if join_key is not None:
+        gt_norm, est_norm, join_info = hash_join_reports(gt_norm, est_norm, key=join_key, build_side=build_side)
 
+    # 2) 批量比较 tool_sequence
     def _get_tools(report_item: Dict[str, Any]) -> List[Any]:
         r = report_item.get("report", {})
-        tools = r.get("tool_sequence", [])
+        tools = r.get("tool_sequence", []) if isinstance(r, dict) else []
         return tools if isinstance(tools, list) else []
 
-    for idx, (g_item, e_item) in enumerate(zip(gt_norm, est_norm)):
-        g_tools = _get_tools(g_item)
-        e_tools = _get_tools(e_item)
-
-        exact_match = (g_tools == e_tools)
-        if exact_match:
-            exact_match_count += 1
+    gt_seqs = [_get_tools(x) for x in gt_norm]
+    est_seqs = [_get_tools(x) for x in est_norm]
+    vocab = build_tool_vocab(tool_names)
+    m = sequence_similarity(gt_seqs, est_seqs, vocab=vocab)
 
-        # 以“长度差”衡量多/少的数量（不做集合去重，保持顺序敏感的长度定义）
-        diff = len(e_tools) - len(g_tools)
-        extra = diff if diff > 0 else 0
-        missing = (-diff) if diff < 0 else 0
+    # 以“长度差”衡量多/少的数量（不做集合去重，保持顺序敏感的长度定义）
+    diff = m["est_len"] - m["gt_len"]
+    m["extra_tools"] = np.maximum(diff, 0)      # EST 相对 GT 多出的数量
+    m["missing_tools"] = np.maximum(-diff, 0)   # EST 相对 GT 缺少的数量
 
-        extra_sum += extra
-        missing_sum += missing
+    n = len(gt_norm)
+    exact_match_count = int(m["exact_match"].sum())
 
-        per_pair.append({
-            "index": idx,
-            "gt_len": len(g_tools),
-            "est_len": len(e_tools),
-            "exact_match": exact_match,
-            "extra_tools": extra,      # EST 相对 GT 多出的数量
-            "missing_tools": missing,  # EST 相对 GT 缺少的数量
-        })
+    def _mean(k: str) -> float:
+        return float(m[k].mean()) if n > 0 else 0.0
 
-    n = len(gt_norm) if gt_norm else 0
     exact_match_ratio = (exact_match_count / n) if n > 0 else 0.0
-    avg_extra = (extra_sum / n) if n > 0 else 0.0
-    avg_missing = (missing_sum / n) if n > 0 else 0.0
+    avg_extra = _mean("extra_tools")
+    avg_missing = _mean("missing_tools")
+
+    per_pair_keys = ["gt_len", "est_len", "exact_match", "extra_tools", "missing_tools", "levenshtein",
+                     "lcs_ratio", "set_precision", "set_recall", "ngram2_overlap"]
+    columns = [m[k].tolist() for k in per_pair_keys]
+    per_pair = [dict(zip(["index"] + per_pair_keys, row)) for row in zip(range(n), *columns)]
 
-    # 3) 单独打印对比指标
+    # 3) 分组：query_type（优先取 GT 侧）与 EST 的错误类别
+    group_keys = ["exact_match", "levenshtein", "levenshtein_sim", "lcs_ratio",
+                  "set_precision", "set_recall", "set_f1", "ngram2_overlap"]
+    query_types = [g.get("query_type") or e.get("query_type") or "unknown" for g, e in zip(gt_norm, est_norm)]
+    error_classes = [_error_class(e.get("report", {})) for e in est_norm]
+    by_query_type = _group_means(query_types, m, group_keys) if n > 0 else {}
+    by_error_class = _group_means(error_classes, m, group_keys) if n > 0 else {}
+
+    similarity = {k: _mean(k) for k in group_keys if k != "exact_match"}
+
+    # 4) 单独打印对比指标
     print("\n=== Tool Sequence Comparison (GT vs EST) ===")
     print(f"{'pairs':30s}: {n}")
     print(f"{'exact_match_count':30s}: {exact_match_count}")
     print(f"{'exact_match_ratio':30s}: {exact_match_ratio:.4f}")
     print(f"{'avg_extra_tools (EST-GT)':30s}: {avg_extra:.4f}")
     print(f"{'avg_missing_tools (GT-EST)':30s}: {avg_missing:.4f}")
+    if join_info is not None:
+        print(f"{'join key':30s}: {join_info['key']}")
+        print(f"{'unmatched_gt':30s}: {join_info['unmatched_gt']}")
+        print(f"{'unmatched_est':30s}: {join_info['unmatched_est']}")
+    for k, v in similarity.items():
+        print(f"{'avg_' + k:30s}: {v:.4f}")
+    print("--- by query_type ---")
+    for g, v in by_query_type.items():
+        print(f"{g:30s}: pairs={v['pairs']}, exact_match={v['exact_match']:.4f}, lcs_ratio={v['lcs_ratio']:.4f}")
+    print("--- by est error class ---")
+    for g, v in by_error_class.items():
+        print(f"{g:30s}: pairs={v['pairs']}, exact_match={v['exact_match']:.4f}, lcs_ratio={v['lcs_ratio']:.4f}")
     print("============================================\n")
 
-    # 4) 返回汇总
-    return {
+    # 5) 返回汇总
+    result = {
         "gt_summary": gt_summary,
         "est_summary": est_summary,
         "comparison": {
@@ -203,14 +492,190 @@ def compare_report_sets(gt_reports: List[Dict[str, Any]], est_reports: List[Dict
             "exact_match_ratio": exact_match_ratio,
             "avg_extra_tools": avg_extra,
             "avg_missing_tools": avg_missing,
+            "similarity": similarity,
+            "by_query_type": by_query_type,
+            "by_error_class": by_error_class,
             "per_pair": per_pair,
         }
     }
+    if join_info is not None:
+        result["comparison"]["join"] = join_info
+    if history is not None:
+        history.record(result, **(run_meta or {}))
+    return result
+
+
+# ---------------- 自适应（顺序）评估 ----------------
+
+ADAPTIVE_METRICS = ("exact_match", "valid")
+
+
+def wilson_interval(successes: int, n: int, z: float = 1.96) -> Tuple[float, float]:
+    """二项比例的 Wilson score 置信区间（n 小或比例接近 0/1 时比正态近似稳定）。"""
+    if n == 0:
+        return 0.0, 1.0
+    p = successes / n
+    denom = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denom
+    half = z * np.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denom
+    return float(max(center - half, 0.0)), float(min(center + half, 1.0))
+
+
+def bootstrap_interval(values: np.ndarray, n_boot: int = 1000, alpha: float = 0.05,
+                       seed: int = 0) -> Tuple[float, float]:
+    """均值的 percentile bootstrap 区间（一次性生成 (n_boot, n) 的重采样下标，向量化计算）。"""
+    values = np.asarray(values, dtype=float)
+    if values.size == 0:
+        return 0.0, 1.0
+    rng = np.random.default_rng(seed)
+    means = values[rng.integers(0, values.size, size=(n_boot, values.size))].mean(axis=1)
+    low, high = np.quantile(means, [alpha / 2, 1 - alpha / 2])
+    return float(low), float(high)
+
+
+def stratified_order(groups: List[Any], seed: int = 0) -> List[int]:
+    """
+    按组（例如 query_type）分层的评估顺序：组内随机打乱，第 j 个元素排在 (j + 0.5) / 组大小 处，
+    因此任意前缀中各组占比都接近全集中的占比，提前停止时的估计不会偏向某一类。
+    """
+    rng = random.Random(seed)
+    by_group: Dict[Any, List[int]] = defaultdict(list)
+    for i, g in enumerate(groups):
+        by_group[g].append(i)
+    keyed = []
+    for gi, (g, idx) in enumerate(sorted(by_group.items(), key=lambda kv: str(kv[0]))):
+        rng.shuffle(idx)
+        keyed.extend(((j + 0.5) / len(idx), gi, i) for j, i in enumerate(idx))
+    return [i for _, _, i in sorted(keyed)]
+
+
+def per_example_metrics(gt_reports: List[Dict[str, Any]], est_reports: List[Dict[str, Any]],
+                        tool_names: Optional[List[str]] = None, join_key: str = "prompt_hash",
+                        metrics: Iterable[str] = ADAPTIVE_METRICS) -> Dict[str, np.ndarray]:
+    """
+    逐条指标值，用于置信区间：
+    exact_match / lcs_ratio / set_f1 在按 join_key 关联的 GT-EST 对上计算（与 compare_report_sets 一致），
+    valid 在全部 EST 记录上计算（与 est_summary.valid_ratio 一致）。
+    """
+    metrics = list(metrics)
+    out: Dict[str, np.ndarray] = {}
+    if "valid" in metrics:
+        out["valid"] = np.array([bool(isinstance(r.get("report"), dict) and r["report"].get("validity", False))
+                                 for r in est_reports], dtype=float)
+    pair_metrics = [k for k in metrics if k != "valid"]
+    if pair_metrics:
+        gt_matched, est_matched, _ = hash_join_reports(gt_reports, est_reports, key=join_key)
+
+        def _tools(rec: Dict[str, Any]) -> List[Any]:
+            r = rec.get("report")
+            tools = r.get("tool_sequence", []) if isinstance(r, dict) else []
+            return tools if isinstance(tools, list) else []
+
+        m = sequence_similarity([_tools(g) for g in gt_matched], [_tools(e) for e in est_matched],
+                                vocab=build_tool_vocab(tool_names))
+        for k in pair_metrics:
+            out[k] = m[k].astype(float)
+    return out
+
+
+def metric_intervals(values: Dict[str, np.ndarray], method: str = "wilson", z: float = 1.96,
+                     seed: int = 0) -> Dict[str, Dict[str, float]]:
+    """
+    各指标的均值与置信区间。method='wilson' 时对 0/1 指标用 Wilson 区间，其余指标（或 method='bootstrap'）用 bootstrap。
+    """
+    out = {}
+    for name, v in values.items():
+        v = np.asarray(v, dtype=float)
+        binary = v.size > 0 and bool(np.isin(v, (0.0, 1.0)).all())
+        if method == "wilson" and (binary or v.size == 0):
+            low, high = wilson_interval(int(v.sum()), v.size, z)
+        else:
+            low, high = bootstrap_interval(v, seed=seed)
+        out[name] = {"n": int(v.size), "mean": float(v.mean()) if v.size else 0.0,
+                     "low": low, "high": high, "width": high - low}
+    return out
+
+
+# ---------------- 推理性能汇总 ----------------
+
+PERF_KEYS = ("prompt_tokens", "generated_tokens", "ttft", "decode_seconds", "tokens_per_sec",
+             "batch_seconds", "batch_tokens_per_sec", "process_peak_rss_mb", "batch_peak_allocated_mb")
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    arr = np.asarray(values, dtype=float)
+    p50, p90, p99 = np.percentile(arr, [50, 90, 99])
+    return {"count": int(arr.size), "mean": float(arr.mean()), "p50": float(p50), "p90": float(p90), "p99": float(p99)}
+
+
+def perf_summary(records: Iterable[Dict[str, Any]], keys: Tuple[str, ...] = PERF_KEYS,
+                 group_key: str = "query_type") -> Dict[str, Any]:
+    """
+    汇总 results_es 中逐条的 perf 字段：整体与按 group_key（默认 query_type）分组的 mean / p50 / p90 / p99。
+    值为 None 的字段（例如 PtEngine 批量推理没有 TTFT 与逐条 tokens_per_sec）不参与统计；
+    batch_seconds / batch_tokens_per_sec 是 batch 级数值，同一 batch 的样本取值相同。
+    """
+    overall: Dict[str, List[float]] = defaultdict(list)
+    grouped: Dict[str, Dict[str, List[float]]] = defaultdict(lambda: defaultdict(list))
+    for rec in records:
+        perf = rec.get("perf")
+        if not isinstance(perf, dict):
+            continue
+        group = str(rec.get(group_key) or "unknown")
+        for k in keys:
+            v = perf.get(k)
+            if isinstance(v, (int, float)):
+                overall[k].append(v)
+                grouped[group][k].append(v)
+    return {
+        "overall": {k: _percentiles(v) for k, v in overall.items()},
+        f"by_{group_key}": {g: {k: _percentiles(v) for k, v in d.items()} for g, d in sorted(grouped.items())},
+    }
+
+
+# compare_report_sets 实际用到的列，列式文件只读取这些列
+COMPARE_COLUMNS = ["query_id", "query_type", "prompt_hash", "report_present", "report_empty", "validity", "tool_sequence",
+                   "vars_all", "vars_invalid", "errors_json"]
+
+
+def evaluate_from_store(path: str, print_info=True) -> Dict[str, Any]:
+    """
+    直接在列式 report 文件（.parquet / .arrow）上计算 evaluate_from_reports 的汇总指标，
+    只读取 SUMMARY_COLUMNS；需要 error_summary 时请用 evaluate_from_reports(load_reports(path))。
+    """
+    summary = summarize_report_table(read_report_table(path, SUMMARY_COLUMNS))
+    if print_info:
+        print("\n=== Report Evaluation Summary ===")
+        for k, v in summary.items():
+            if isinstance(v, float):
+                print(f"{k:30s}: {v:.4f}")
+            else:
+                print(f"{k:30s}: {v}")
+        print("=================================\n")
+    return summary
+
+
+def compare_report_files(gt_path: str, est_path: str, tool_names: Optional[List[str]] = None,
+                         compact_errors: bool = False, history: Optional[MetricsHistory] = None,
+                         run_meta: Optional[Dict[str, Any]] = None,
+                         join_key: Optional[str] = None) -> Dict[str, Any]:
+    """
+    对两个 report 文件（.jsonl 或列式文件）调用 compare_report_sets；列式文件只读取 COMPARE_COLUMNS。
+    给出 join_key 时按 key 做 hash join：两侧都是 .jsonl 时较小的文件放入内存，较大的文件逐行流式读取。
+    """
+    if join_key is not None and gt_path.endswith(".jsonl") and est_path.endswith(".jsonl"):
+        build_side = "gt" if os.path.getsize(gt_path) <= os.path.getsize(est_path) else "est"
+        gt_reports, est_reports = iter_jsonl(gt_path), iter_jsonl(est_path)
+    else:
+        build_side = None
+        gt_reports, est_reports = load_reports(gt_path, COMPARE_COLUMNS), load_reports(est_path, COMPARE_COLUMNS)
+    return compare_report_sets(gt_reports, est_reports, tool_names=tool_names, compact_errors=compact_errors,
+                               history=history, run_meta=run_meta, join_key=join_key, build_side=build_side)
+
 
 if __name__ == "__main__":
     input_file1 = f"dataset/qa_v3/results_generate_workflow.jsonl"
     input_file2 = f"dataset/qa_gpt-oss_v1/results_generate_workflow.jsonl"
 
-    results1 = read_jsonl(input_file1)
-    results2 = read_jsonl(input_file2)
-    report_summary = compare_report_sets(results1, results2)
+    tool_names = extract_tool_names(load_json("dataset/tools/tools_v1.json"))
+    report_summary = compare_report_files(input_file1, input_file2, tool_names=tool_names)
@@ -1,9 +1,177 @@
+import functools
+import hashlib
+import io
 import json
+import mmap
+import multiprocessing as mp
 import os
 from pathlib import Path
-from typing import Any, Union, List, Dict, Optional
+from typing import Any, Callable, Union, List, Dict, Optional, Iterable, Iterator, Tuple
 
+import numpy as np
+import orjson
 import yaml
+import zstandard as zstd
+
+# JSONL 读写的缓冲区大小
+JSONL_BUFFER = 1 << 20
+# OPT_NON_STR_KEYS：int 等非字符串 key 与 json.dumps 一样转成字符串；OPT_SERIALIZE_NUMPY：直接写 numpy 数组/标量
+ORJSON_OPTIONS = orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+# 小于该大小的文件 read_jsonl_parallel 直接单进程读取（进程启动与结果回传的开销大于解析本身）
+PARALLEL_MIN_BYTES = 64 << 20
+JSONL_INDEX_SUFFIX = ".idx.npz"
+
+# .zst 文件：按后缀透明压缩 / 解压（open_file）
+ZSTD_SUFFIX = ".zst"
+ZSTD_LEVEL = 3
+# 写入时每 ZSTD_FRAME_BYTES 未压缩字节结束一个独立帧，帧是随机访问与并行读取的最小单位
+ZSTD_FRAME_BYTES = 1 << 20
+# train_zstd_dictionary 训练的字典按 dict_id 保存在这里，读取时根据帧头中的 dict_id 自动加载
+ZSTD_DICT_DIR = "output/zstd_dicts"
+
+
+def is_zst(path: str) -> bool:
+    return str(path).endswith(ZSTD_SUFFIX)
+
+
+@functools.lru_cache(maxsize=None)
+def load_zstd_dict(dict_id: int, dict_dir: str = ZSTD_DICT_DIR) -> "zstd.ZstdCompressionDict":
+    path = os.path.join(dict_dir, f"{dict_id}.zdict")
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"zstd dictionary {dict_id} not found: {path} (see train_zstd_dictionary)")
+    with open(path, "rb") as f:
+        return zstd.ZstdCompressionDict(f.read())
+
+
+def _zstd_file_dict(path: str) -> Optional["zstd.ZstdCompressionDict"]:
+    """根据文件第一个帧头中的 dict_id 找到压缩时使用的字典；未使用字典或文件为空时返回 None。"""
+    with open(path, "rb") as f:
+        head = f.read(18)
+    if not head:
+        return None
+    dict_id = zstd.get_frame_parameters(head).dict_id
+    return load_zstd_dict(dict_id) if dict_id else None
+
+
+def _as_zstd_dict(zstd_dict: Union[None, str, "zstd.ZstdCompressionDict"]) -> Optional["zstd.ZstdCompressionDict"]:
+    if zstd_dict is None or isinstance(zstd_dict, zstd.ZstdCompressionDict):
+        return zstd_dict
+    with open(zstd_dict, "rb") as f:
+        return zstd.ZstdCompressionDict(f.read())
+
+
+class _ZstdFrameWriter(io.RawIOBase):
+    """zstd 流式写入，每写满 frame_bytes 未压缩字节就结束当前帧；write 按调用整体写入，不会把一次写入拆到两个帧。"""
+
+    def __init__(self, raw, cctx: "zstd.ZstdCompressor", frame_bytes: int = ZSTD_FRAME_BYTES):
+        self._raw = raw
+        self._writer = cctx.stream_writer(raw, closefd=False)
+        self._frame_bytes = frame_bytes
+        self._pending = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        if len(b):
+            self._writer.write(b)
+        self._pending += len(b)
+        if self._pending >= self._frame_bytes:
+            self._writer.flush(zstd.FLUSH_FRAME)
+            self._pending = 0
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            if self._pending:
+                self._writer.flush(zstd.FLUSH_FRAME)
+            # 不调用 self._writer.close()：它会在末尾再写一个空帧
+            self._raw.close()
+        super().close()
+
+
+def open_file(path: str, mode: str = "r", encoding: str = "utf-8",
+              zstd_dict: Union[None, str, "zstd.ZstdCompressionDict"] = None, level: int = ZSTD_LEVEL):
+    """
+    打开文件，路径以 .zst 结尾时透明地流式压缩 / 解压，其余情况等同于内置 open（1 MiB 缓冲）。
+    mode 支持 r / w / a 及对应的 rb / wb / ab。
+    - 写入：每 ZSTD_FRAME_BYTES 结束一个独立帧；追加（a）即在文件末尾追加新帧，多帧文件仍是合法的 zstd 文件
+    - zstd_dict：字典文件路径或 ZstdCompressionDict（见 train_zstd_dictionary），只在写入时需要；
+      追加且未指定时沿用文件已有的字典；读取时按帧头的 dict_id 自动从 ZSTD_DICT_DIR 加载
+    """
+    binary = "b" in mode
+    if not is_zst(path):
+        return open(path, mode, buffering=JSONL_BUFFER, **({} if binary else {"encoding": encoding}))
+    kind = mode.replace("b", "").replace("t", "")
+    if kind == "r":
+        dctx = zstd.ZstdDecompressor(dict_data=_zstd_file_dict(path))
+        f = io.BufferedReader(dctx.stream_reader(open(path, "rb"), read_across_frames=True, closefd=True),
+                              JSONL_BUFFER)
+    elif kind in ("w", "a"):
+        if zstd_dict is None and kind == "a" and os.path.isfile(path):
+            zstd_dict = _zstd_file_dict(path)
+        cctx = zstd.ZstdCompressor(level=level, dict_data=_as_zstd_dict(zstd_dict), write_checksum=True)
+        f = _ZstdFrameWriter(open(path, kind + "b"), cctx)
+    else:
+        raise ValueError(f"Unsupported mode for {path}: {mode}")
+    return f if binary else io.TextIOWrapper(f, encoding=encoding, write_through=True)
+
+
+def zstd_frame_bounds(buf, start: int = 0) -> List[Tuple[int, int]]:
+    """
+    只解析帧头与块头（不解压），返回 buf[start:] 中每个完整 zstd 帧的 (start, end) 字节范围。
+    末尾不完整的帧（写入中途崩溃）不计入。
+    """
+    bounds, pos, n = [], start, len(buf)
+    while pos + 8 <= n:
+        magic = int.from_bytes(buf[pos:pos + 4], "little")
+        if magic & 0xFFFFFFF0 == 0x184D2A50:  # skippable frame
+            end = pos + 8 + int.from_bytes(buf[pos + 4:pos + 8], "little")
+        else:
+            head = bytes(buf[pos:pos + 18])
+            try:
+                params = zstd.get_frame_parameters(head)
+                p = pos + zstd.frame_header_size(head)
+            except zstd.ZstdError:
+                break
+            while p + 3 <= n:
+                block = int.from_bytes(buf[p:p + 3], "little")
+                # 块头：bit0 = last block，bit1-2 = 类型（1 = RLE，只占 1 字节），其余为块大小
+                p += 3 + (1 if (block >> 1) & 3 == 1 else block >> 3)
+                if block & 1:
+                    break
+            else:
+                break
+            end = p + (4 if params.has_checksum else 0)
+        if end > n:
+            break
+        bounds.append((pos, end))
+        pos = end
+    return bounds
+
+
+def train_zstd_dictionary(paths: Iterable[str], dict_size: int = 112640, max_samples: int = 100000,
+                          dict_dir: str = ZSTD_DICT_DIR) -> str:
+    """
+    用若干文件的内容训练 zstd 字典（JSONL 每行一个样本，其他文件整个文件一个样本），
+    保存为 <dict_dir>/<dict_id>.zdict 并返回路径，可作为 write_jsonl / open_file 的 zstd_dict。
+    适用于单条记录很小、单独成帧或单独成文件的场景（例如逐条 query 的日志），大文件收益不明显。
+    """
+    samples = []
+    for path in paths:
+        with open_file(path, "rb") as f:
+            if ".jsonl" in os.path.basename(path):
+                samples += [line for line in f if line.strip()]
+            else:
+                samples.append(f.read())
+        if len(samples) >= max_samples:
+            break
+    zdict = zstd.train_dictionary(dict_size, samples[:max_samples])
+    os.makedirs(dict_dir, exist_ok=True)
+    out = os.path.join(dict_dir, f"{zdict.dict_id()}.zdict")
+    with open(out, "wb") as f:
+        f.write(zdict.as_bytes())
+    return out
 
 
 def json_to_log_lines(obj: Union[dict, list, str], indent: int = 0) -> str:
@@ -41,16 +209,17 @@ def json_to_log_lines(obj: Union[dict, list, str], indent: int = 0) -> str:
     return "\n".join(lines)
 
 
-def save_json_to_log(obj: Union[dict, list, str], path: str = "output.log"):
+def save_json_to_log(obj: Union[dict, list, str], path: str = "output.log", zstd_dict=None):
     """
     将 JSON 对象转换为多行字符串并保存到日志文件。
     如果文件不存在，会自动创建；如果目录不存在，会先创建目录。
+    path 以 .zst 结尾时压缩写入（每次调用追加一个帧），zstd_dict 见 open_file。
     """
     # 确保目录存在
     os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
 
     content = json_to_log_lines(obj)
-    with open(path, "a", encoding="utf-8") as f:
+    with open_file(path, "a", zstd_dict=zstd_dict) as f:
         f.write(content + "\n")
     return path
 
@@ -94,12 +263,13 @@ def save_dict_to_json(
     overwrite : bool, optional
         True 表示覆盖写入 JSON 文件；
         False 表示以 JSONL 格式追加写入一行。
+        path 以 .zst 结尾时压缩写入。
     """
     # 确保目录存在
     os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
 
     mode = "w" if overwrite else "a"
-    with open(path, mode, encoding="utf-8") as f:
+    with open_file(path, mode) as f:
         if overwrite:
             json.dump(data, f, ensure_ascii=False, indent=indent)
         else:
@@ -111,7 +281,7 @@ def load_json(path):
     Load a JSON file and return it as a Python object.
 
     Args:
-        path (str or Path): Path to the JSON file.
+        path (str or Path): Path to the JSON file (.zst is decompressed transparently).
 
     Returns:
         dict or list: Parsed JSON object.
@@ -120,7 +290,7 @@ def load_json(path):
     if not path.exists():
         raise FileNotFoundError(f"JSON file not found: {path}")
 
-    with open(path, "r", encoding="utf-8") as f:
+    with open_file(str(path), "r") as f:
         return json.load(f)
 
 def find_objects(data: List[Dict[str, Any]], key: str, value: Any) -> List[Dict[str, Any]]:
@@ -144,11 +314,48 @@ def find_objects(data: List[Dict[str, Any]], key: str, value: Any) -> List[Dict[
     return [obj for obj in data if obj.get(key) == value]
 
 def read_yaml_file(path: str):
-    """读取 YAML 文件，返回 Python 对象（dict 或 list）"""
-    with open(path, "r", encoding="utf-8") as f:
+    """读取 YAML 文件，返回 Python 对象（dict 或 list），支持 .zst"""
+    with open_file(path, "r") as f:
         data = yaml.safe_load(f)
     return data
 
+def dumps_jsonl_line(obj: Any) -> bytes:
+    """
+    把一条记录序列化为以换行结尾的 UTF-8 JSONL 行（orjson，输出与 json.dumps(ensure_ascii=False) 等价，
+    但不带多余空格）。orjson 不支持的对象（超过 64 位的整数等）回退到 json.dumps。
+    注意：NaN / Infinity 会被写成 null（json.dumps 写出的 NaN 不是合法 JSON）。
+    """
+    try:
+        return orjson.dumps(obj, option=ORJSON_OPTIONS)
+    except TypeError:
+        return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def loads_jsonl_line(line: Union[bytes, str]) -> Any:
+    """
+    解析一行 JSON；orjson 拒绝的输入（旧文件中 json.dumps 写出的 NaN 等）回退到 json.loads。
+    与 json.loads 的唯一差别：超过 64 位的整数解析为 float。
+    """
+    try:
+        return orjson.loads(line)
+    except orjson.JSONDecodeError:
+        return json.loads(line)
+
+
+def _parse_lines(lines: Iterable[bytes], encoding: str, skip_invalid: bool) -> Iterator[Any]:
+    # orjson 直接解析 UTF-8 字节，其他编码先解码
+    utf8 = encoding.lower().replace("-", "").replace("_", "") == "utf8"
+    for line in lines:
+        line = line.strip()
+        if not line:  # skip empty lines
+            continue
+        try:
+            yield loads_jsonl_line(line if utf8 else line.decode(encoding))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            if not skip_invalid:
+                raise
+
+
 def read_jsonl(path: str, encoding: str = "utf-8") -> List[Dict[str, Any]]:
     """
     Read a .jsonl (JSON Lines) file and return a list of JSON objects.
@@ -160,40 +367,331 @@ def read_jsonl(path: str, encoding: str = "utf-8") -> List[Dict[str, Any]]:
     Returns:
         List of dictionaries, one per line.
     """
-    data = []
-    with open(path, "r", encoding=encoding) as f:
-        for line in f:
-            line = line.strip()
-            if not line:  # skip empty lines
-                continue
-            data.append(json.loads(line))
-    return data
+    return list(iter_jsonl(path, encoding))
+
+def iter_jsonl(path: str, encoding: str = "utf-8", skip_invalid: bool = False) -> Iterator[Dict[str, Any]]:
+    """
+    逐行读取 .jsonl 文件的生成器版本（不把整个文件读入内存）。
+    语义与 read_jsonl 相同：跳过空行。
+    skip_invalid=True 时跳过无法解析的行（例如进程崩溃时只写了一半的最后一行）；
+    .zst 文件此时只读取完整的帧（与 JsonlIndex 一致），不完整的最后一帧中已能解压出的行也不会产出。
+    以二进制 + 大缓冲区读取，用 orjson 解析；.zst 文件流式解压。
+    """
+    if skip_invalid and is_zst(path):
+        yield from _parse_lines(_iter_complete_frame_lines(path), encoding, skip_invalid)
+        return
+    with open_file(path, "rb") as f:
+        yield from _parse_lines(_iter_raw_lines(f, skip_invalid), encoding, skip_invalid)
+
+
+def _iter_raw_lines(f, skip_invalid: bool) -> Iterator[bytes]:
+    try:
+        yield from f
+    except zstd.ZstdError:
+        if not skip_invalid:
+            raise
+
+
+def _iter_complete_frame_lines(path: str) -> Iterator[bytes]:
+    """逐帧解压 .zst 文件中的完整帧，产出以换行结束的行；末尾不完整的帧和未结束的行被丢弃。"""
+    if os.path.getsize(path) == 0:
+        return
+    dctx = zstd.ZstdDecompressor(dict_data=_zstd_file_dict(path))
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        tail = b""
+        for start, end in zstd_frame_bounds(mm):
+            try:
+                data = tail + _decompress_frames(mm[start:end], dctx)
+            except zstd.ZstdError:
+                return
+            lines = data.split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                yield line + b"\n"
+
+
+def _decompress_frames(buf, dctx: "zstd.ZstdDecompressor") -> bytes:
+    """解压一段由完整帧组成的字节（帧可以没有 content size）。"""
+    with dctx.stream_reader(io.BytesIO(buf), read_across_frames=True) as reader:
+        return reader.read()
+
+
+def _read_jsonl_range(args: Tuple[str, int, int, str, bool, Optional[Callable]]) -> List[Any]:
+    path, start, end, encoding, skip_invalid, map_fn = args
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = mm[start:end]
+    if is_zst(path):
+        data = _decompress_frames(data, zstd.ZstdDecompressor(dict_data=_zstd_file_dict(path)))
+    records = _parse_lines(iter(data.splitlines()), encoding, skip_invalid)
+    if map_fn is None:
+        return list(records)
+    return [r for r in map(map_fn, records) if r is not None]
+
+
+def jsonl_line_ranges(path: str, num_parts: int) -> List[Tuple[int, int]]:
+    """
+    把文件按字节大致均分为 num_parts 段，每个切点向后对齐到下一个换行，返回 [(start, end), ...]。
+    .zst 文件在帧边界切分（write_jsonl 写出的帧不会把一行拆到两个帧里）。
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    bounds = [0]
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if is_zst(path):
+            frames = zstd_frame_bounds(mm)
+            ends = [end for _, end in frames]
+            for k in range(1, num_parts):
+                cut = next((e for e in ends if e >= max(size * k // num_parts, bounds[-1] + 1)), None)
+                if cut is None:
+                    break
+                bounds.append(cut)
+            size = ends[-1] if ends else 0
+        else:
+            for k in range(1, num_parts):
+                cut = mm.find(b"\n", max(size * k // num_parts, bounds[-1]))
+                if cut < 0:
+                    break
+                bounds.append(cut + 1)
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+
+
+def read_jsonl_parallel(path: str, num_proc: Optional[int] = None, map_fn: Optional[Callable[[Any], Any]] = None,
+                        encoding: str = "utf-8", skip_invalid: bool = False,
+                        min_bytes: int = PARALLEL_MIN_BYTES) -> List[Any]:
+    """
+    多进程读取大 JSONL：按换行对齐切成 num_proc 段，每个进程 mmap 文件只解析自己的字节范围，结果按文件顺序拼接。
+    .zst 文件按帧切分，每个进程只解压自己的帧。
+    map_fn（须可 pickle，即模块级函数）在子进程中作用于每条记录，返回 None 的记录被丢弃；
+    只需要部分字段或做过滤时传 map_fn，可大幅减少回传主进程的数据量。
+    文件小于 min_bytes 或 num_proc=1 时在当前进程中读取，结果相同。
+    """
+    num_proc = num_proc or os.cpu_count() or 1
+    if num_proc <= 1 or os.path.getsize(path) < min_bytes:
+        records = iter_jsonl(path, encoding, skip_invalid)
+        return list(records) if map_fn is None else [r for r in map(map_fn, records) if r is not None]
+    tasks = [(path, start, end, encoding, skip_invalid, map_fn) for start, end in jsonl_line_ranges(path, num_proc)]
+    with mp.get_context("spawn").Pool(len(tasks)) as pool:
+        parts = pool.map(_read_jsonl_range, tasks)
+    return [r for part in parts for r in part]
+
+
+def prompt_hash(text: str) -> str:
+    """prompt 文本的稳定 key（sha1 前 16 位），用于 GT / EST 报告之间的关联。"""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
 
 def write_jsonl(
-    data: List[Dict[str, Any]],
+    data: Iterable[Dict[str, Any]],
     path: str,
-    append: bool = False
-) -> None:
+    append: bool = False,
+    zstd_dict=None
+) -> int:
     """
     将一组字典写入 JSONL (JSON Lines) 文件。
     若路径不存在，会自动创建目录。
 
     Parameters
     ----------
-    data : list[dict]
-        要写入的 JSON 对象列表。
+    data : Iterable[dict]
+        要写入的 JSON 对象列表，也可以是生成器（边生成边写，不在内存中攒整个列表）。
     path : str
-        输出文件路径，例如 "output/data.jsonl"。
+        输出文件路径，例如 "output/data.jsonl"；以 .zst 结尾时流式压缩写入。
     append : bool, optional
         是否追加写入。默认 False 表示覆盖。
+    zstd_dict : str or zstd.ZstdCompressionDict, optional
+        .zst 文件使用的压缩字典（见 train_zstd_dictionary）。
+
+    Returns
+    -------
+    int
+        写入的记录数。
     """
     # 确保目录存在
     os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
 
-    mode = "a" if append else "w"
-    with open(path, mode, encoding="utf-8") as f:
+    mode = "ab" if append else "wb"
+    n = 0
+    with open_file(path, mode, zstd_dict=zstd_dict) as f:
         for item in data:
-            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            f.write(dumps_jsonl_line(item))
+            n += 1
+    return n
+
+
+class JsonlIndex:
+    """
+    JSONL 文件的字节偏移索引，O(1) 读取第 i 条记录或按 id 读取记录，不需要解析整个文件。
+    索引保存在旁边的 <path>.idx.npz（offsets + 可选的 key 列），记录建索引时的文件大小与 mtime：
+    - 文件未变：直接加载
+    - 文件只被追加（变大）：只扫描新增部分并更新索引（evaluate 的增量写入即是这种情况）
+    - 其他变化：重建
+    key 为记录中用作 id 的字段（如 "prompt_hash"、"index"），值统一按 str 比较；重复 id 取第一条。
+
+    .zst 文件额外记录每个帧的压缩字节范围，offsets 为行在所属帧解压后数据中的偏移；
+    读取一条记录只需解压它所在的帧（最近一次解压的帧会被缓存，顺序访问时每帧只解压一次）。
+
+    Examples
+    --------
+    >>> idx = JsonlIndex("output/test_report_es.jsonl", key="prompt_hash")
+    >>> idx[10], idx.get("3f2a..."), len(idx)
+    """
+
+    def __init__(self, path: str, key: Optional[str] = None, save: bool = True):
+        self.path = path
+        self.key = key
+        self.index_path = path + JSONL_INDEX_SUFFIX
+        self.zst = is_zst(path)
+        self._key_to_row = None
+        self._dctx = zstd.ZstdDecompressor(dict_data=_zstd_file_dict(path)) if self.zst else None
+        self._frame_cache: Tuple[int, bytes] = (-1, b"")
+        stat = os.stat(path)
+        if self._load() and stat.st_size == self._size and stat.st_mtime_ns == self._mtime_ns:
+            return
+        if not (self._size and stat.st_size > self._size and self._tail_hash(self._size) == self._tail):
+            # 没有索引、key 不同，或文件被改写（而不是追加）：从头扫描
+            self._reset()
+        if self.zst:
+            self._scan_zst(self._size)
+        else:
+            self._scan(self._size)
+        self._mtime_ns, self._tail = stat.st_mtime_ns, self._tail_hash(self._size)
+        if save:
+            self._save()
+
+    def _reset(self):
+        self.offsets, self.keys = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=str)
+        self.line_frames, self.frames = np.zeros(0, dtype=np.int64), np.zeros((0, 2), dtype=np.int64)
+        self._size = 0
+
+    def _tail_hash(self, size: int, n: int = 4096) -> str:
+        """文件前 size 字节中最后 n 字节的 hash，用于判断文件是否只是被追加。"""
+        with open(self.path, "rb") as f:
+            f.seek(max(0, size - n))
+            return hashlib.sha1(f.read(min(n, size))).hexdigest()
+
+    def _load(self) -> bool:
+        self._reset()
+        self._mtime_ns, self._tail = 0, ""
+        if not os.path.isfile(self.index_path):
+            return False
+        with np.load(self.index_path) as data:
+            if str(data["key"]) != (self.key or ""):
+                return False
+            self.offsets, self.keys = data["offsets"], data["keys"]
+            self.line_frames, self.frames = data["line_frames"], data["frames"]
+            self._size, self._mtime_ns, self._tail = int(data["size"]), int(data["mtime_ns"]), str(data["tail"])
+        return True
+
+    def _save(self):
+        tmp = self.index_path + ".tmp.npz"
+        np.savez(tmp, offsets=self.offsets, keys=self.keys, line_frames=self.line_frames, frames=self.frames,
+                 key=self.key or "", size=self._size, mtime_ns=self._mtime_ns, tail=self._tail)
+        os.replace(tmp, self.index_path)
+
+    def _add(self, offsets: List[int], lines: List[bytes], line_frames: Optional[List[int]] = None):
+        self.offsets = np.concatenate([self.offsets, np.asarray(offsets, dtype=np.int64)])
+        if line_frames is not None:
+            self.line_frames = np.concatenate([self.line_frames, np.asarray(line_frames, dtype=np.int64)])
+        if self.key is not None and lines:
+            keys = []
+            for line in lines:
+                rec = loads_jsonl_line(line)
+                keys.append(str(rec.get(self.key)) if isinstance(rec, dict) else "")
+            self.keys = np.concatenate([self.keys, np.asarray(keys, dtype=str)])
+
+    def _scan(self, start: int):
+        """从字节 start 开始扫描非空行，追加其偏移（与 iter_jsonl 的行一一对应）。最后一行不完整时不计入。"""
+        offsets, lines = [], []
+        with open(self.path, "rb", buffering=JSONL_BUFFER) as f:
+            f.seek(start)
+            pos = start
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                if line.strip():
+                    offsets.append(pos)
+                    lines.append(line)
+                pos += len(line)
+        self._add(offsets, lines)
+        self._size = pos
+
+    def _scan_zst(self, start: int):
+        """
+        从压缩字节 start 开始逐帧解压，记录每个非空行所在的帧与帧内偏移。
+        跨帧的行记在起始帧上；最后一行未结束（或最后一帧不完整）时，从该行的起始帧起下次重新扫描。
+        """
+        if os.path.getsize(self.path) <= start:
+            # 空文件无法 mmap；没有新增字节时也无需扫描
+            return
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            new_frames = zstd_frame_bounds(mm, start)
+            first = len(self.frames)
+            offsets, lines, line_frames = [], [], []
+            pending = None  # [帧号, 帧内偏移, 已读到的行内容]
+            for k, (fs, fe) in enumerate(new_frames):
+                data = _decompress_frames(mm[fs:fe], self._dctx)
+                pos = 0
+                while pos < len(data):
+                    nl = data.find(b"\n", pos)
+                    end = len(data) if nl < 0 else nl + 1
+                    if pending is None:
+                        pending = [first + k, pos, b""]
+                    pending[2] += data[pos:end]
+                    if nl < 0:
+                        break
+                    if pending[2].strip():
+                        line_frames.append(pending[0])
+                        offsets.append(pending[1])
+                        lines.append(pending[2])
+                    pending = None
+                    pos = end
+        if pending is not None:
+            # 丢弃与未结束的行同帧的记录，下次从该帧重新扫描
+            keep = [i for i, fr in enumerate(line_frames) if fr < pending[0]]
+            offsets, lines, line_frames = [offsets[i] for i in keep], [lines[i] for i in keep], [line_frames[i] for i in keep]
+            new_frames = new_frames[:pending[0] - first]
+        self.frames = np.concatenate([self.frames, np.asarray(new_frames, dtype=np.int64).reshape(-1, 2)])
+        self._add(offsets, lines, line_frames)
+        self._size = int(self.frames[-1, 1]) if len(self.frames) else 0
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def read_at(self, offset: int) -> Dict[str, Any]:
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return loads_jsonl_line(f.readline())
+
+    def _frame(self, k: int) -> bytes:
+        if self._frame_cache[0] != k:
+            start, end = self.frames[k]
+            with open(self.path, "rb") as f:
+                f.seek(int(start))
+                self._frame_cache = (k, _decompress_frames(f.read(int(end - start)), self._dctx))
+        return self._frame_cache[1]
+
+    def __getitem__(self, i: int) -> Dict[str, Any]:
+        if not self.zst:
+            return self.read_at(int(self.offsets[i]))
+        k, pos = int(self.line_frames[i]), int(self.offsets[i])
+        line = self._frame(k)[pos:]
+        while b"\n" not in line and k + 1 < len(self.frames):
+            k += 1
+            line += self._frame(k)
+        return loads_jsonl_line(line.split(b"\n", 1)[0])
+
+    def get(self, record_id: Any, default: Any = None) -> Any:
+        """按 key 字段的值读取记录，不存在时返回 default。"""
+        if self.key is None:
+            raise ValueError("JsonlIndex was built without key; pass key=... to look up records by id")
+        if self._key_to_row is None:
+            self._key_to_row = {}
+            for row, k in enumerate(self.keys.tolist()):
+                self._key_to_row.setdefault(k, row)
+        row = self._key_to_row.get(str(record_id))
+        return default if row is None else self[row]
 
 
 def extract_tool_names(tools_json: Dict[str, Any]) -> List[str]: